@@ -1,10 +1,14 @@
 '''
 A3App.py
 
-Usage: python A3App.py path_to_scene_file
+Usage: python A3App.py [--mode MODE] [--workers N] [--tile-size N] [--accelerator NAME]
+                        [--profile json|pstats] path_to_scene_file
 example: python A3App.py ./scenes/sphere.xml
-If no command-line argument is provided then renders the default scene file specified in
+If no scene file is provided then renders the default scene file specified in
 the variable DEFAULT_SCENE_FILE.
+The optional arguments override the corresponding attributes of the <render>
+element, e.g. python A3App.py --mode vectorized --workers 4 ./scenes/sphere.xml
+renders the scene with 4 processes (see Scene.renderScene).
 
 Spyder IDE:
 press F6
@@ -26,8 +30,10 @@ unit-test files that are provided e.g. TestSphereIntersection.py, TestBoxInterse
 TestSceneNodeIntersection.py, and TestPlaneIntersection.py
 '''
 
-import os, sys
+import os
+import argparse
 from SceneParser import SceneParser
+from Scene import Scene
 
 
 DEFAULT_SCENE_FILE = './scenes/sphere.xml' 
@@ -44,17 +50,34 @@ def build_raytracer():
     cmd = python_path_prefix + 'python setup.py build_ext --inplace ' + compiler_opt
     os.system(cmd)
 
-def main(filename):
+def main(filename, mode = None, workers = None, tile_size = None, accelerator = None, profile = None):
     scene = SceneParser(filename).scene
     ## to disable showing images in matplotlib uncomment the following line
     #scene.render.bShowImage = False
+    if mode is not None:
+        scene.render.mode = mode
+    if workers is not None:
+        scene.render.workers = workers
+    if tile_size is not None:
+        scene.render.tileSize = tile_size
+    if accelerator is not None:
+        scene.render.accelerator = accelerator
+        scene.build_accelerator()
+    if profile is not None:
+        scene.render.profile = profile
     scene.renderScene()
   
   
 if __name__ == '__main__':
-    argv = sys.argv
-    filename = DEFAULT_SCENE_FILE
-    if len(argv) == 2:
-        filename = argv[1]
+    parser = argparse.ArgumentParser(description = 'Render an xml scene file.')
+    parser.add_argument('filename', nargs = '?', default = DEFAULT_SCENE_FILE)
+    parser.add_argument('--mode', choices = Scene.MODES, help = 'rendering mode')
+    parser.add_argument('--workers', type = int, 
+                        help = 'number of rendering processes, 0 uses all the CPUs')
+    parser.add_argument('--tile-size', type = int, help = 'size of the rendered tiles in pixels')
+    parser.add_argument('--accelerator', help = 'acceleration structure: bvh, grid, compiled or none')
+    parser.add_argument('--profile', choices = ['json', 'pstats'], 
+                        help = 'save a profile of the render next to the image')
+    args = parser.parse_args()
         
-    main(filename)
+    main(args.filename, args.mode, args.workers, args.tile_size, args.accelerator, args.profile)
@@ -0,0 +1,255 @@
+'''
+Bounding volume hierarchy (BVH) used for finding the nearest intersection
+without testing every object.
+
+The BVH is a binary tree of axis-aligned bounding boxes built over a list of
+intersectable objects that have a bounds() method (see Intersectable.py).
+Objects without bounds (i.e. bounds() returns None, e.g. Plane) can't be
+stored in the BVH and need to be tested separately.
+
+Traversal is done front-to-back: the child that is closer along the ray is
+visited first and a node is skipped when the ray enters its box further away
+than the nearest intersection found so far.
+'''
+
+from __future__ import division
+from Ray import IntersectionResult, IntersectionPacket
+import numpy as np
+
+# maximum number of objects in a leaf node
+MAX_LEAF_SIZE = 2
+
+# the boxes are slightly enlarged so that intersections that lie exactly on
+# the bounds of an object are not missed due to rounding errors
+BOUNDS_PADDING = 1e-7
+
+# used instead of 0 for the components of a ray direction so that no special
+# case is needed for rays that are parallel to a pair of box planes
+TINY_DIRECTION = 1e-30
+
+
+def safe_directions(directions):
+  ''' replaces the 0 components of the directions by TINY_DIRECTION '''
+  return np.where(directions == 0, TINY_DIRECTION, directions)
+
+def ray_box_interval(minPoint, maxPoint, origin, inv_direction):
+  '''
+  Slab test for a single ray given by its origin and 1/direction (python
+  sequences of 3 floats). Returns the (t_enter, t_exit) interval of the ray
+  inside the box, t_enter > t_exit when the box is missed.
+  '''
+  t_enter = -np.inf
+  t_exit = np.inf
+  for axis in range(3):
+    t0 = (minPoint[axis] - origin[axis]) * inv_direction[axis]
+    t1 = (maxPoint[axis] - origin[axis]) * inv_direction[axis]
+    if t0 > t1:
+      t0, t1 = t1, t0
+    if t0 > t_enter:
+      t_enter = t0
+    if t1 < t_exit:
+      t_exit = t1
+  return t_enter, t_exit
+
+def rays_box_interval(minPoint, maxPoint, origins, inv_directions):
+  ''' Same as ray_box_interval for arrays of rays of shape (N, 3) '''
+  t0 = (minPoint - origins) * inv_directions
+  t1 = (maxPoint - origins) * inv_directions
+  t_enter = np.max(np.minimum(t0, t1), axis = 1)
+  t_exit = np.min(np.maximum(t0, t1), axis = 1)
+  return t_enter, t_exit
+
+
+class BVHNode:
+  """
+
+  BVHNode class
+
+  A node of the BVH. Leaf nodes hold a list of objects, inner nodes hold two
+  children (left and right) which were split along axis: the objects of the
+  left child have smaller centers along that axis.
+
+  """
+  def __init__(self, minPoint, maxPoint):
+    self.minPoint = minPoint
+    self.maxPoint = maxPoint
+    # python floats are faster than small numpy arrays for the scalar traversal
+    self.minList = [float(x) for x in minPoint]
+    self.maxList = [float(x) for x in maxPoint]
+    self.objects = None
+    self.left = None
+    self.right = None
+    self.axis = 0
+
+  def is_leaf(self):
+    return self.objects is not None
+
+
+class BVH:
+  """
+
+  BVH class
+
+  Built from a list of intersectable objects which all have bounds. It has
+  the same intersect and intersect_many methods as the intersectable objects
+  and returns the nearest intersection with any of its objects.
+
+  """
+  def __init__(self, objects):
+    objects = list(objects)
+    assert(len(objects) > 0)
+    bounds = [obj.bounds() for obj in objects]
+    assert(all(b is not None for b in bounds))
+    minPoints = np.array([b[0] for b in bounds], dtype = float) - BOUNDS_PADDING
+    maxPoints = np.array([b[1] for b in bounds], dtype = float) + BOUNDS_PADDING
+    self.objects = objects
+    self.root = self.build(objects, minPoints, maxPoints, np.arange(len(objects)))
+
+  def build(self, objects, minPoints, maxPoints, index):
+    ''' Recursively builds the node containing the objects given by index '''
+    node = BVHNode(np.min(minPoints[index], axis = 0), np.max(maxPoints[index], axis = 0))
+    centers = (minPoints[index] + maxPoints[index]) / 2.
+    extent = np.max(centers, axis = 0) - np.min(centers, axis = 0)
+    if len(index) <= MAX_LEAF_SIZE or np.max(extent) <= 0:
+      node.objects = [objects[i] for i in index]
+      return node
+
+    # split at the median center along the axis where the centers are most spread
+    node.axis = int(np.argmax(extent))
+    half = len(index) // 2
+    order = np.argpartition(centers[:, node.axis], half)
+    node.left = self.build(objects, minPoints, maxPoints, index[order[:half]])
+    node.right = self.build(objects, minPoints, maxPoints, index[order[half:]])
+    return node
+
+  def bounds(self):
+    return self.root.minPoint, self.root.maxPoint
+
+  def intersect(self, ray):
+    '''
+    Returns the IntersectionResult of the nearest intersection of the ray
+    with the objects of the BVH.
+    '''
+    isect = IntersectionResult()
+    origin = [float(x) for x in ray.eyePoint]
+    direction = [float(x) for x in ray.viewDirection]
+    inv_direction = [1. / (d if d != 0 else TINY_DIRECTION) for d in direction]
+
+    stack = [self.root]
+    while len(stack) > 0:
+      node = stack.pop()
+      t_enter, t_exit = ray_box_interval(node.minList, node.maxList, origin, inv_direction)
+      # skip the node if it is missed, behind the ray or beyond the nearest intersection
+      if t_enter > t_exit or t_exit < 0 or t_enter > isect.t:
+        continue
+      if node.is_leaf():
+        for obj in node.objects:
+          result = obj.intersect(ray)
+          if result.t < isect.t:
+            isect = result
+      elif direction[node.axis] >= 0: # visit the near child first, i.e. push it last
+        stack.append(node.right)
+        stack.append(node.left)
+      else:
+        stack.append(node.left)
+        stack.append(node.right)
+    return isect
+
+  def intersect_many(self, origins, directions):
+    '''
+    Packet version of intersect. origins and directions are arrays of shape
+    (N, 3). Returns an IntersectionPacket (see Ray.py).
+    '''
+    isects = IntersectionPacket(len(origins))
+    inv_directions = 1. / safe_directions(directions)
+    self.intersect_node_many(self.root, origins, directions, inv_directions,
+                             np.arange(len(origins)), isects)
+    return isects
+
+  def intersect_node_many(self, node, origins, directions, inv_directions, index, isects):
+    '''
+    Intersects the rays given by index with the node and updates isects. Only
+    the rays that can have a nearer intersection inside the node are passed
+    on to its children.
+    '''
+    t_enter, t_exit = rays_box_interval(node.minPoint, node.maxPoint,
+                                        origins[index], inv_directions[index])
+    index = index[(t_enter <= t_exit) & (t_exit >= 0) & (t_enter <= isects.t[index])]
+    if len(index) == 0:
+      return
+    if node.is_leaf():
+      for obj in node.objects:
+        isects.update(obj.intersect_many(origins[index], directions[index]), index)
+      return
+    # visit the child that is in front for most of the rays first
+    children = [node.left, node.right]
+    if np.sum(directions[index, node.axis] >= 0) < len(index) / 2.:
+      children.reverse()
+    for child in children:
+      self.intersect_node_many(child, origins, directions, inv_directions, index, isects)
+
+  def occluded(self, ray, t_max):
+    '''
+    Any-hit query: True if any object of the BVH is intersected at a distance
+    t with EPS_DISTANCE < t < t_max. The traversal stops at the first such object.
+    '''
+    return self.get_occluder(ray, t_max) is not None
+
+  def get_occluder(self, ray, t_max):
+    ''' Same as occluded but returns the occluding object (or None) '''
+    origin = [float(x) for x in ray.eyePoint]
+    inv_direction = [1. / (d if d != 0 else TINY_DIRECTION) for d in ray.viewDirection]
+    stack = [self.root]
+    while len(stack) > 0:
+      node = stack.pop()
+      t_enter, t_exit = ray_box_interval(node.minList, node.maxList, origin, inv_direction)
+      if t_enter > t_exit or t_exit < 0 or t_enter >= t_max:
+        continue
+      if node.is_leaf():
+        for obj in node.objects:
+          if obj.occluded(ray, t_max):
+            return obj
+      else:
+        stack.append(node.right)
+        stack.append(node.left)
+    return None
+
+  def occluded_many(self, origins, directions, t_max):
+    ''' Packet version of occluded, t_max is an array of shape (N,) '''
+    return self.get_occluders_many(origins, directions, t_max)[0]
+
+  def get_occluders_many(self, origins, directions, t_max):
+    '''
+    Packet version of get_occluder. Returns a boolean array telling whether
+    each ray is occluded and an object array with the occluding objects.
+    '''
+    occluded = np.zeros(len(origins), dtype = bool)
+    occluders = np.empty(len(origins), dtype = object)
+    inv_directions = 1. / safe_directions(directions)
+    self.occluded_node_many(self.root, origins, directions, inv_directions, t_max,
+                            np.arange(len(origins)), occluded, occluders)
+    return occluded, occluders
+
+  def occluded_node_many(self, node, origins, directions, inv_directions, t_max, index, 
+                         occluded, occluders):
+    ''' Updates occluded for the rays given by index, occluded rays are not tested further '''
+    index = index[~occluded[index]]
+    if len(index) == 0:
+      return
+    t_enter, t_exit = rays_box_interval(node.minPoint, node.maxPoint,
+                                        origins[index], inv_directions[index])
+    index = index[(t_enter <= t_exit) & (t_exit >= 0) & (t_enter < t_max[index])]
+    if len(index) == 0:
+      return
+    if node.is_leaf():
+      for obj in node.objects:
+        hit = obj.occluded_many(origins[index], directions[index], t_max[index])
+        occluded[index[hit]] = True
+        occluders[index[hit]] = obj
+        index = index[~hit]
+        if len(index) == 0:
+          return
+      return
+    for child in (node.left, node.right):
+      self.occluded_node_many(child, origins, directions, inv_directions, t_max, index,
+                              occluded, occluders)
@@ -0,0 +1,139 @@
+'''
+BatchRender.py
+
+Usage: python BatchRender.py [--processes N] [--summary FILE] [--out-dir DIR]
+                             [--max-dim N] [--mode MODE] scene [scene ...]
+example: python BatchRender.py --processes 4 --max-dim 128 './scenes/*.xml'
+
+Renders many xml scene files without displaying them (matplotlib is never
+imported). The scenes can be given as files, glob patterns or directories
+(all the xml files below the directory). The scenes are rendered
+concurrently by a pool of processes, one scene per process at a time, and a
+JSON summary with the parse time, render time and rays per second of each
+scene is written to the summary file (batch_summary.json in the output
+directory by default).
+'''
+
+import os
+import sys
+import glob
+import json
+import time
+import fnmatch
+import argparse
+import multiprocessing
+from SceneParser import SceneParser
+from Scene import Scene
+
+def find_scene_files(patterns):
+    '''
+    Returns the sorted list of the xml files given by the list of file
+    names, glob patterns or directories (searched recursively).
+    '''
+    files = set()
+    for pattern in patterns:
+        for path in glob.glob(pattern) or [pattern]:
+            if os.path.isdir(path):
+                for root, subDirs, names in os.walk(path):
+                    files.update(os.path.join(root, name) for name in fnmatch.filter(names, '*.xml'))
+            else:
+                files.add(path)
+    return sorted(files)
+
+def render_scene_file(args):
+    '''
+    Parses and renders one scene file, args is the tuple (filename, out_dir,
+    max_dim, mode). Returns the summary of the scene as a dict, the error
+    message is kept in 'error' if the scene can't be rendered.
+    '''
+    filename, out_dir, max_dim, mode = args
+    result = {'scene': filename}
+    try:
+        start = time.time()
+        scene = SceneParser(filename).scene
+        result['parse_seconds'] = time.time() - start
+
+        render = scene.render
+        render.bShowImage = False
+        render.workers = 1 # the scenes are rendered in parallel instead of the tiles
+        if out_dir is not None:
+            render.OUTDIR_REL_PATH = out_dir
+        if mode is not None:
+            render.mode = mode
+        camera = render.camera
+        if max_dim is not None:
+            scale_factor = min(float(max_dim) / max(camera.imageWidth, camera.imageHeight), 1.)
+            camera.imageWidth = int(camera.imageWidth * scale_factor)
+            camera.imageHeight = int(camera.imageHeight * scale_factor)
+
+        start = time.time()
+        scene.renderScene()
+        result['render_seconds'] = time.time() - start
+        result['output'] = render.OUTDIR_REL_PATH + render.output
+        result['image_size'] = [camera.imageWidth, camera.imageHeight]
+        result['mode'] = render.mode
+        result['rays'] = scene.render_stats['samples']
+        result['rays_per_second'] = scene.render_stats['samples_per_second']
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    return result
+
+def batch_render(filenames, processes = 0, out_dir = None, max_dim = None, mode = None):
+    '''
+    Renders the scene files with a pool of processes (all the CPUs if
+    processes <= 0) and returns the summary, a dict with the list of the
+    results of render_scene_file in the order of filenames.
+    '''
+    if processes <= 0:
+        processes = multiprocessing.cpu_count()
+    processes = max(min(processes, len(filenames)), 1)
+    tasks = [(filename, out_dir, max_dim, mode) for filename in filenames]
+    start = time.time()
+    if processes == 1:
+        results = [render_scene_file(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(render_scene_file, tasks, chunksize = 1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    return {'processes': processes, 'seconds': time.time() - start,
+            'failed': sum(1 for result in results if 'error' in result), 'scenes': results}
+
+def main(patterns, processes = 0, summary_file = None, out_dir = None, max_dim = None, mode = None):
+    filenames = find_scene_files(patterns)
+    if out_dir is not None:
+        out_dir = os.path.join(out_dir, '')
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+    summary = batch_render(filenames, processes, out_dir, max_dim, mode)
+    if summary_file is None:
+        summary_file = os.path.join(out_dir or '.', 'batch_summary.json')
+    with open(summary_file, 'w') as f:
+        json.dump(summary, f, indent = 2, sort_keys = True)
+
+    for result in summary['scenes']:
+        if 'error' in result:
+            print('%s failed: %s' % (result['scene'], result['error']))
+        else:
+            print('%(scene)s: parsed in %(parse_seconds).2fs, rendered in %(render_seconds).2fs '
+                  '(%(rays_per_second).0f rays/s)' % result)
+    print('rendered %d scenes (%d failed) in %.2fs, summary written to %s' %
+          (len(summary['scenes']), summary['failed'], summary['seconds'], summary_file))
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Render many xml scene files in parallel.')
+    parser.add_argument('scenes', nargs = '+', help = 'xml scene files, glob patterns or directories')
+    parser.add_argument('--processes', type = int, default = 0,
+                        help = 'number of scenes rendered at the same time, 0 uses all the CPUs')
+    parser.add_argument('--summary', help = 'JSON summary file, default OUT_DIR/batch_summary.json')
+    parser.add_argument('--out-dir', help = 'directory of the rendered images, default from the scene')
+    parser.add_argument('--max-dim', type = int, help = 'scale the images down to this size')
+    parser.add_argument('--mode', choices = Scene.MODES, help = 'rendering mode')
+    args = parser.parse_args()
+
+    summary = main(args.scenes, args.processes, args.summary, args.out_dir, args.max_dim, args.mode)
+    sys.exit(1 if summary['failed'] else 0)
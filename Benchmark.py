@@ -0,0 +1,211 @@
+'''
+Benchmark.py
+
+Usage: python Benchmark.py [--cases NAME ...] [--baseline FILE] [--tolerance T]
+                           [--save-baseline] [--output FILE] [--mode MODE]
+                           [--accelerator NAME] [--repeat N]
+example: python Benchmark.py --cases objects-100 lights-16 --tolerance 0.2
+
+Measures the performance of the raytracer on synthetic scenes. The scenes
+are generated as xml files (see generate_scene_xml) with the same random
+objects for each run: spheres and boxes in nested nodes, a ground plane and
+1 to 16 lights. For each case the parse, build (of the accelerator) and
+render times are measured and the rendering throughput in rays (primary
+samples) per second is compared with the one stored in the baseline file.
+The run fails (exit status 1) if the throughput of a case is lower than
+(1 - tolerance) times the baseline. --save-baseline stores the results of
+the run as the new baseline instead. The baselines depend on the machine
+so they should be created on the machine running the benchmark.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import numpy as np
+from collections import OrderedDict
+from SceneParser import SceneParser
+from Scene import Scene
+
+DEFAULT_BASELINE_FILE = './benchmark_baseline.json'
+
+# name: (number of objects, number of lights), half of the objects are spheres
+CASES = OrderedDict([('objects-1', (1, 1)),
+                     ('objects-100', (100, 2)),
+                     ('objects-10k', (10000, 4)),
+                     ('objects-100k', (100000, 4)),
+                     ('lights-16', (100, 16))])
+DEFAULT_CASES = ['objects-1', 'objects-100', 'objects-10k', 'lights-16']
+
+MATERIALS = '''  <material name="red" diffuse="0.8 0.1 0.1" specular="0.5 0.5 0.5" hardness="20"/>
+  <material name="green" diffuse="0.1 0.8 0.1"/>
+  <material name="blue" diffuse="0.1 0.1 0.9" specular="0.2 0.2 0.2"/>
+  <material name="white" diffuse="0.9 0.9 0.9" specular="0 0 0"/>
+'''
+
+def format_vector(v):
+    return ' '.join('%.4f' % x for x in v)
+
+# the xml of an element is created by a function of the origin of its parent node
+def sphere_xml(center, radius, material):
+    return lambda origin: '<sphere center="%s" radius="%.4f"> <material ref="%s"/> </sphere>' % \
+                          (format_vector(center - origin), radius, material)
+
+def box_xml(center, half_size, material):
+    return lambda origin: '<box min="%s" max="%s"> <material ref="%s"/> </box>' % \
+                          (format_vector(center - half_size - origin), format_vector(center + half_size - origin), material)
+
+def node_xml(items):
+    ''' returns the (center, xml function) of a node containing the items (center, xml function) '''
+    center = np.mean([position for position, xml in items], axis = 0)
+    return center, lambda origin: '<node translation="%s">%s</node>' % \
+                                  (format_vector(center - origin), ''.join(xml(center) for position, xml in items))
+
+def generate_scene_xml(objects, lights, width = 64, height = 48, group_size = 10, seed = 0):
+    '''
+    Returns the xml of a scene with the given number of objects (spheres and
+    boxes in turn) at random positions in a 20 x 10 x 20 volume above a ground
+    plane, lit by lights point lights. The objects are grouped into nodes of
+    group_size objects, these nodes into nodes of group_size nodes and so on,
+    each node translates its children. The same seed gives the same scene.
+    '''
+    random = np.random.RandomState(seed)
+    extent = np.array([20., 10., 20.])
+    size = 0.5 * (extent.prod() / max(objects, 1)) ** (1. / 3.) # the objects fill about 1/8th of the volume
+    positions = (random.uniform(0., 1., (objects, 3)) - [0.5, 0., 0.5]) * extent + [0., size, 0.]
+    materials = ['red', 'green', 'blue']
+
+    items = []
+    for i, position in enumerate(positions):
+        material = materials[random.randint(len(materials))]
+        if i % 2 == 0:
+            items.append((position, sphere_xml(position, size, material)))
+        else:
+            items.append((position, box_xml(position, size * random.uniform(0.5, 1., 3), material)))
+    while len(items) > group_size:
+        items = [node_xml(items[start:start + group_size]) for start in range(0, len(items), group_size)]
+    surfaces = ''.join('  %s\n' % xml(np.zeros(3)) for position, xml in items)
+
+    lights_xml = ''
+    for i in range(lights):
+        angle = 2. * np.pi * i / lights
+        position = [15. * np.cos(angle), 15. + 5. * (i % 2), 15. * np.sin(angle)]
+        lights_xml += '  <light color="1 1 1" from="%s" power="%.4f"/>\n' % (format_vector(position), 1.2 / lights)
+
+    return '''<?xml version="1.0"?>
+<scene ambient="0.1 0.1 0.1">
+%s  <render output="benchmark.png" bgcolor="0.1 0.2 0.3" show_image="false" accelerator="none">
+    <camera from="0 18 30" to="0 2 0" up="0 1 0" fov="45" width="%d" height="%d"/>
+  </render>
+%s  <plane normal="0 1 0"> <material ref="white"/> <material2 ref="blue"/> </plane>
+%s</scene>
+''' % (MATERIALS, width, height, lights_xml, surfaces)
+
+def run_case(name, mode = 'vectorized', accelerator = 'bvh', repeat = 1, width = 64, height = 48):
+    '''
+    Generates, parses and renders the scene of the case and returns the
+    timings of the stages (the best render of repeat renders) and the
+    number of rays per second as a dict.
+    '''
+    objects, lights = CASES[name]
+    out_dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(out_dir, name + '.xml')
+        with open(filename, 'w') as f:
+            f.write(generate_scene_xml(objects, lights, width, height))
+
+        start = time.time()
+        scene = SceneParser(filename).scene
+        result = {'objects': objects, 'lights': lights, 'parse_seconds': time.time() - start}
+
+        render = scene.render
+        render.OUTDIR_REL_PATH = os.path.join(out_dir, '')
+        render.mode = mode
+        render.workers = 1
+        start = time.time()
+        scene.build_accelerator(accelerator)
+        result['build_seconds'] = time.time() - start
+
+        seconds = []
+        for i in range(repeat):
+            scene.renderScene()
+            seconds.append(scene.render_stats['seconds'])
+        result['render_seconds'] = min(seconds)
+        result['rays'] = scene.render_stats['samples']
+        result['rays_per_second'] = result['rays'] / result['render_seconds']
+        return result
+    finally:
+        shutil.rmtree(out_dir)
+
+def find_regressions(results, baseline, tolerance):
+    '''
+    Returns the list of (name, rays_per_second, baseline rays_per_second) of
+    the cases whose throughput is lower than (1 - tolerance) times the
+    baseline. The cases that aren't in the baseline are skipped.
+    '''
+    regressions = []
+    for name, result in results.items():
+        if name in baseline:
+            expected = baseline[name]['rays_per_second']
+            if result['rays_per_second'] < (1. - tolerance) * expected:
+                regressions.append((name, result['rays_per_second'], expected))
+    return regressions
+
+def main(cases = DEFAULT_CASES, baseline_file = DEFAULT_BASELINE_FILE, tolerance = 0.2, save_baseline = False,
+         output_file = None, mode = 'vectorized', accelerator = 'bvh', repeat = 3):
+    results = OrderedDict()
+    for name in cases:
+        results[name] = run_case(name, mode, accelerator, repeat)
+
+    print('%-14s %8s %7s %9s %9s %9s %12s' % ('case', 'objects', 'lights', 'parse(s)', 'build(s)',
+                                            'render(s)', 'rays/s'))
+    for name, result in results.items():
+        print('%-14s %8d %7d %9.3f %9.3f %9.3f %12.0f' % (name, result['objects'], result['lights'],
+              result['parse_seconds'], result['build_seconds'], result['render_seconds'],
+              result['rays_per_second']))
+    if output_file is not None:
+        with open(output_file, 'w') as f:
+            json.dump(results, f, indent = 2)
+
+    if save_baseline:
+        baseline = dict()
+        if os.path.exists(baseline_file):
+            with open(baseline_file) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f, indent = 2, sort_keys = True)
+        print('baseline saved to ' + baseline_file)
+        return []
+    if not os.path.exists(baseline_file):
+        print('no baseline ' + baseline_file + ', run with --save-baseline to create it')
+        return []
+
+    with open(baseline_file) as f:
+        regressions = find_regressions(results, json.load(f), tolerance)
+    for name, rays_per_second, expected in regressions:
+        print('REGRESSION %s: %.0f rays/s, baseline %.0f rays/s' % (name, rays_per_second, expected))
+    if not regressions:
+        print('no regressions (tolerance %.0f%%)' % (100. * tolerance))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the raytracer on synthetic scenes.')
+    parser.add_argument('--cases', nargs = '+', default = DEFAULT_CASES, choices = list(CASES),
+                        help = 'the benchmarked cases, default: ' + ' '.join(DEFAULT_CASES))
+    parser.add_argument('--baseline', default = DEFAULT_BASELINE_FILE, help = 'baseline JSON file')
+    parser.add_argument('--tolerance', type = float, default = 0.2,
+                        help = 'allowed relative loss of rays/s compared to the baseline')
+    parser.add_argument('--save-baseline', action = 'store_true', help = 'store the results as baseline')
+    parser.add_argument('--output', help = 'JSON file for the results')
+    parser.add_argument('--mode', default = 'vectorized', choices = Scene.MODES, help = 'rendering mode')
+    parser.add_argument('--accelerator', default = 'bvh', help = 'bvh, grid, compiled or none')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'number of renders, the best is kept')
+    args = parser.parse_args()
+
+    regressions = main(args.cases, args.baseline, args.tolerance, args.save_baseline, args.output,
+                       args.mode, args.accelerator, args.repeat)
+    sys.exit(1 if regressions else 0)
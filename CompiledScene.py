@@ -0,0 +1,242 @@
+'''
+Compiled (struct-of-arrays) form of the primitives of a scene.
+
+Instead of a list of Sphere, Box and Plane objects each holding small numpy
+arrays, CompiledScene stores all the sphere centers and radii, all the box
+corners and all the plane normals in contiguous float64 arrays. The
+materials are stored once in a material table and the primitives refer to
+them by index. A ray is then intersected with all the spheres (boxes, planes)
+in a single numpy operation instead of calling intersect on every object.
+
+Objects that are not primitives (i.e. SceneNode) are not compiled and are
+kept in the list CompiledScene.others.
+'''
+
+from __future__ import division
+from Intersectable import Sphere, Plane, Box, EPS_DISTANCE
+from BVH import safe_directions
+from Ray import IntersectionResult, IntersectionPacket
+import GeomTransform as GT
+import numpy as np
+
+# maximum number of (ray, primitive) pairs intersected at once by intersect_many,
+# larger packets are split into chunks of primitives to limit the memory use
+MAX_PAIRS_PER_CHUNK = 1 << 18
+
+# kinds of primitives, used in the results of nearest_hits
+SPHERE, BOX, PLANE = 0, 1, 2
+
+
+def sphere_distances(origins, directions, centers, radii):
+  '''
+  Intersection distances between N rays and S spheres as an array of shape
+  (N, S), inf where there's no intersection. The intersection is chosen in
+  the same way as in Sphere.intersect.
+  '''
+  p0pc = origins[:, np.newaxis, :] - centers
+  a = np.sum(directions * directions, axis = 1)[:, np.newaxis]
+  b = 2 * np.einsum('nk,nsk->ns', directions, p0pc)
+  squared_distances = np.sum(p0pc * p0pc, axis = 2)
+  discriminant = b**2 - 4*a*(squared_distances - radii**2)
+  sqrt_discriminant = np.sqrt(np.maximum(discriminant, 0))
+  t1 = (-b + sqrt_discriminant)/(2*a)
+  t2 = (-b - sqrt_discriminant)/(2*a)
+  outside = squared_distances > radii**2
+  dist1 = np.abs(t1) * np.sqrt(a)
+  dist2 = np.abs(t2) * np.sqrt(a)
+  t = np.where(dist1 < dist2,
+               np.where((dist1 > EPS_DISTANCE) & outside, t1, t2),
+               np.where((dist2 > EPS_DISTANCE) & outside, t2, t1))
+  return np.where((discriminant >= 0) & (t > EPS_DISTANCE), t, np.inf)
+
+def box_slabs(origins, inv_directions, minPoints, maxPoints):
+  ''' Entry and exit distances of the rays for the three pairs of planes of the boxes '''
+  t0 = (minPoints - origins) * inv_directions
+  t1 = (maxPoints - origins) * inv_directions
+  return np.minimum(t0, t1), np.maximum(t0, t1)
+
+def box_distances(origins, directions, minPoints, maxPoints):
+  '''
+  Intersection distances between N rays and B boxes as an array of shape
+  (N, B), inf where there's no intersection. The exit point is used for the
+  rays starting inside the box, as in Box.intersect.
+  '''
+  inv_directions = 1. / safe_directions(directions)
+  t_near, t_far = box_slabs(origins[:, np.newaxis, :], inv_directions[:, np.newaxis, :],
+                            minPoints, maxPoints)
+  tnear = np.max(t_near, axis = 2)
+  tfar = np.min(t_far, axis = 2)
+  t = np.where(tnear > EPS_DISTANCE, tnear, tfar)
+  return np.where((tnear <= tfar) & (tfar > EPS_DISTANCE), t, np.inf)
+
+def box_normals(origins, directions, minPoints, maxPoints):
+  ''' Normals at the intersections of K rays with K boxes (one box per ray) '''
+  t_near, t_far = box_slabs(origins, 1. / safe_directions(directions), minPoints, maxPoints)
+  rays = np.arange(len(origins))
+  entering = np.max(t_near, axis = 1) > EPS_DISTANCE
+  axis = np.where(entering, np.argmax(t_near, axis = 1), np.argmin(t_far, axis = 1))
+  sign = np.sign(directions[rays, axis])
+  normals = np.zeros((len(origins), 3))
+  normals[rays, axis] = np.where(entering, -sign, sign)
+  return normals
+
+def plane_distances(origins, directions, normals):
+  '''
+  Intersection distances between N rays and P planes through the origin as
+  an array of shape (N, P), inf where there's no intersection.
+  '''
+  parallel_check = np.dot(directions, normals.T)
+  parallel = parallel_check == 0
+  t = -np.dot(origins, normals.T) / np.where(parallel, 1., parallel_check)
+  return np.where(~parallel & (t > EPS_DISTANCE), t, np.inf)
+
+
+class CompiledScene:
+  """
+
+  CompiledScene class
+
+  Built from a list of surfaces (e.g. Scene.surfaces). It has the same
+  intersect, intersect_many and occluded methods as the intersectable
+  objects but only for the compiled primitives; the surfaces in others need
+  to be tested separately.
+
+  """
+  def __init__(self, surfaces):
+    spheres = [s for s in surfaces if isinstance(s, Sphere)]
+    boxes = [s for s in surfaces if isinstance(s, Box)]
+    planes = [s for s in surfaces if isinstance(s, Plane)]
+    self.others = [s for s in surfaces if not isinstance(s, (Sphere, Box, Plane))]
+    # the original objects, used for returning the occluders
+    self.objects = [spheres, boxes, planes]
+
+    # material table
+    self.materials = []
+    self.sphereCenters = np.array([s.center for s in spheres], dtype = float).reshape(-1, 3)
+    self.sphereRadii = np.array([s.radius for s in spheres], dtype = float)
+    self.sphereMaterials = np.array([self.get_material_index(s.material) for s in spheres], dtype = int)
+
+    self.boxMinPoints = np.array([b.minPoint for b in boxes], dtype = float).reshape(-1, 3)
+    self.boxMaxPoints = np.array([b.maxPoint for b in boxes], dtype = float).reshape(-1, 3)
+    self.boxMaterials = np.array([self.get_material_index(b.material) for b in boxes], dtype = int)
+
+    self.planeNormals = np.array([p.normal for p in planes], dtype = float).reshape(-1, 3)
+    self.planeMaterials = np.array([self.get_material_index(p.material) for p in planes], dtype = int)
+    # -1 for planes without checkerboard pattern
+    self.planeMaterials2 = np.array([-1 if p.material2 is None else self.get_material_index(p.material2)
+                                     for p in planes], dtype = int)
+
+    self.diffuse = np.array([m.diffuse[:3] for m in self.materials], dtype = float).reshape(-1, 3)
+    self.specular = np.array([m.specular[:3] for m in self.materials], dtype = float).reshape(-1, 3)
+    self.ambient = np.array([m.ambient[:3] for m in self.materials], dtype = float).reshape(-1, 3)
+    self.hardness = np.array([m.hardness for m in self.materials], dtype = float)
+
+  def get_material_index(self, material):
+    for i, m in enumerate(self.materials):
+      if m is material:
+        return i
+    self.materials.append(material)
+    return len(self.materials) - 1
+
+  def nearest_hits(self, origins, directions):
+    '''
+    For N rays given by arrays of shape (N, 3) returns the distance of the
+    nearest intersection with the compiled primitives (inf if there's none),
+    the kind of primitive (SPHERE, BOX or PLANE) and its index.
+    '''
+    N = len(origins)
+    t = np.full(N, np.inf)
+    kind = np.full(N, -1, dtype = int)
+    index = np.full(N, -1, dtype = int)
+    rays = np.arange(N)
+    primitives = [(SPHERE, len(self.sphereRadii),
+                   lambda o, d, s: sphere_distances(o, d, self.sphereCenters[s], self.sphereRadii[s])),
+                  (BOX, len(self.boxMaterials),
+                   lambda o, d, s: box_distances(o, d, self.boxMinPoints[s], self.boxMaxPoints[s])),
+                  (PLANE, len(self.planeMaterials),
+                   lambda o, d, s: plane_distances(o, d, self.planeNormals[s]))]
+    for primitive_kind, count, distances in primitives:
+      chunk = max(1, MAX_PAIRS_PER_CHUNK // max(N, 1))
+      for start in range(0, count, chunk):
+        chunk_t = distances(origins, directions, slice(start, start + chunk))
+        nearest = np.argmin(chunk_t, axis = 1)
+        nearest_t = chunk_t[rays, nearest]
+        closer = nearest_t < t
+        t[closer] = nearest_t[closer]
+        kind[closer] = primitive_kind
+        index[closer] = start + nearest[closer]
+    return t, kind, index
+
+  def nearest_hit(self, ray):
+    ''' Single ray version of nearest_hits, returns (t, primitive) '''
+    t, kind, index = self.nearest_hits(ray.eyePoint[np.newaxis, :], ray.viewDirection[np.newaxis, :])
+    if kind[0] < 0:
+      return np.inf, None
+    return t[0], self.objects[kind[0]][index[0]]
+
+  def intersect(self, ray):
+    '''
+    Returns the IntersectionResult of the nearest compiled primitive. Only
+    the distances are computed for all the primitives, the result itself is
+    computed by the nearest one.
+    '''
+    t, primitive = self.nearest_hit(ray)
+    if primitive is None:
+      return IntersectionResult()
+    return primitive.intersect(ray)
+
+  def intersect_many(self, origins, directions):
+    '''
+    Packet version of intersect. Returns an IntersectionPacket whose material
+    indices refer to the material table of the compiled scene.
+    '''
+    isects = IntersectionPacket(len(origins))
+    isects.materials = list(self.materials)
+    t, kind, index = self.nearest_hits(origins, directions)
+    hit = np.nonzero(kind >= 0)[0]
+    isects.t[hit] = t[hit]
+    isects.p[hit] = origins[hit] + directions[hit] * t[hit, np.newaxis]
+
+    spheres = hit[kind[hit] == SPHERE]
+    sphere_index = index[spheres]
+    isects.n[spheres] = GT.normalize_many(isects.p[spheres] - self.sphereCenters[sphere_index])
+    isects.material_index[spheres] = self.sphereMaterials[sphere_index]
+
+    boxes = hit[kind[hit] == BOX]
+    box_index = index[boxes]
+    isects.n[boxes] = box_normals(origins[boxes], directions[boxes],
+                                  self.boxMinPoints[box_index], self.boxMaxPoints[box_index])
+    isects.material_index[boxes] = self.boxMaterials[box_index]
+
+    planes = hit[kind[hit] == PLANE]
+    plane_index = index[planes]
+    isects.n[planes] = self.planeNormals[plane_index]
+    p = isects.p[planes]
+    checker = np.ceil(p[:,0]) % 2 == np.ceil(p[:,2]) % 2
+    materials2 = self.planeMaterials2[plane_index]
+    isects.material_index[planes] = np.where(checker | (materials2 < 0),
+                                             self.planeMaterials[plane_index], materials2)
+    return isects
+
+  def occluded(self, ray, t_max):
+    return self.nearest_hit(ray)[0] < t_max
+
+  def get_occluder(self, ray, t_max):
+    ''' the primitive occluding the ray before t_max (or None) '''
+    t, primitive = self.nearest_hit(ray)
+    return primitive if t < t_max else None
+
+  def occluded_many(self, origins, directions, t_max):
+    return self.nearest_hits(origins, directions)[0] < t_max
+
+  def get_occluders_many(self, origins, directions, t_max):
+    '''
+    Returns a boolean array telling whether each ray is occluded before t_max
+    and an object array with the occluding primitives.
+    '''
+    t, kind, index = self.nearest_hits(origins, directions)
+    occluded = t < t_max
+    occluders = np.empty(len(origins), dtype = object)
+    for i in np.nonzero(occluded)[0]:
+      occluders[i] = self.objects[kind[i]][index[i]]
+    return occluded, occluders
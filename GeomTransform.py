@@ -15,6 +15,13 @@ def normalize(vec):
         vec = vec / n
     return vec
 
+def normalize_many(vecs):
+    '''normalize each vector along the last axis of the array vecs'''
+    vecs = np.array(vecs, dtype = float)
+    n = np.sqrt(np.sum(vecs * vecs, axis = -1))
+    n = np.where(np.abs(n) <= 1e-12, 1., n)
+    return vecs / n[..., np.newaxis]
+
 def scale(scale_vec):
     S = np.eye(4)
     S[:3,:3] = np.diag(np.array(scale_vec))
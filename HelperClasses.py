@@ -1,7 +1,6 @@
 import os
 import numpy as np
 from PIL import Image
-from matplotlib import pyplot as plt
 import GeomTransform as GT
 import math
 
@@ -18,6 +17,9 @@ class Camera:
   These variables are necessary for creating rays from the camera position.
 
   """
+  MAX_CACHED_DIRECTIONS = 1 << 21 # pixels, i.e. 48MB of ray directions
+  # the attributes the projection-view parameters depend on, see update
+  PARAMETERS = ('pointFrom', 'pointTo', 'up', 'fov', 'near', 'imageWidth', 'imageHeight')
 
   def __init__(self, params = {}):
       ''' SceneParser takes the camera specification like the following from the xml file
@@ -61,7 +63,82 @@ class Camera:
       assert(np.linalg.norm(self.cameraXAxis) > 0.) # we don't want the camera coordinate system to collapse
       self.cameraXAxis = GT.normalize(self.cameraXAxis)
       self.cameraYAxis = GT.normalize(np.cross(self.cameraXAxis,self.cameraZAxis))
-    
+
+      # Compute the camera-to-world transformation once so that ray creation
+      # doesn't have to rebuild and invert it for every pixel
+      R = np.eye(4)
+      R[:3,0] = self.cameraXAxis
+      R[:3,1] = self.cameraYAxis
+      R[:3,2] = self.cameraZAxis
+      T = np.eye(4)
+      T[:3,3] = -self.pointFrom
+      self.cameraToWorld = np.linalg.inv(np.dot(np.transpose(R), T))
+
+      # the ray directions are computed when they are first needed
+      self.rayBasis = None
+      self.rayDirections = None
+      self.changed = False
+
+  def __setattr__(self, name, value):
+      self.__dict__[name] = value
+      if name in self.PARAMETERS:
+          self.__dict__['changed'] = True
+
+  def __getstate__(self):
+      # the ray directions are recomputed by each worker process instead of being sent
+      state = dict(self.__dict__)
+      state['rayDirections'] = None
+      return state
+
+  def update(self):
+      '''
+      Recomputes the projection-view parameters (and drops the cached ray
+      directions) if any of PARAMETERS was assigned since they were computed.
+      Changing the arrays pointFrom, pointTo or up in place isn't noticed,
+      assign new arrays instead.
+      '''
+      if self.changed:
+          self.imageSize = (self.imageWidth, self.imageHeight)
+          self.__compute_projection_view_parameters__()
+
+  def get_ray_basis(self):
+      '''
+      Returns the arrays (rowVectors, colVectors) of shape (imageHeight, 3) and
+      (imageWidth, 3) such that the direction of the ray through the pixel
+      (row, col) is normalize(rowVectors[row] + colVectors[col]). It's the
+      cameraToWorld transformation of the pixel in camera coordinates minus
+      pointFrom, split into the parts depending on the column and on the row.
+      '''
+      self.update()
+      if self.rayBasis is None:
+          C = self.cameraToWorld
+          cols = np.arange(self.imageWidth)
+          rows = np.arange(self.imageHeight)
+          cam_x = cols*(self.right-self.left)/self.imageWidth + self.left
+          cam_y = rows*-(self.top-self.bottom)/self.imageHeight + self.top
+          colVectors = cam_x[:, np.newaxis] * C[:3,0]
+          rowVectors = cam_y[:, np.newaxis] * C[:3,1] + (self.near * C[:3,2] + C[:3,3] - self.pointFrom)
+          self.rayBasis = (rowVectors, colVectors)
+      return self.rayBasis
+
+  def get_ray_directions(self, rows, cols):
+      '''
+      Returns the normalized directions of the rays through the pixels given by
+      the integer arrays (or integers) rows and cols, see get_ray_basis. For
+      images up to MAX_CACHED_DIRECTIONS pixels the directions of all the
+      pixels are computed once (rayDirections) and reused until the camera
+      changes, otherwise they are computed from the basis.
+      '''
+      self.update()
+      if self.rayDirections is not None:
+          return self.rayDirections[rows, cols]
+      rowVectors, colVectors = self.get_ray_basis()
+      if self.imageWidth * self.imageHeight > self.MAX_CACHED_DIRECTIONS:
+          return GT.normalize_many(rowVectors[rows] + colVectors[cols])
+      self.rayDirections = GT.normalize_many(rowVectors[:, np.newaxis] + colVectors)
+      self.rayDirections.flags.writeable = False
+      return self.rayDirections[rows, cols]
+
 class Render:
   """
 
@@ -82,11 +159,22 @@ class Render:
       self.camera = params.get('camera', Camera())
       self.output = params.get('output', 'render.png')
       self.bgcolor = np.array(params.get('bgcolor', [0.0,0.0,0.0]))
-      self.samples = int(params.get('samples', 1))
-      self.jitter = True if params.get('jitter', 'false').upper() is 'TRUE' else False
-      self.eyepoints = int(params.get('eyepoints', 1))
-      self.lensSize = float(params.get('lensSize', .2))
+      self.samples = int(params.get('samples', 1)) # samples per pixel along each axis, see getSampleOffsets
+      self.jitter = True if params.get('jitter', 'false').upper() == 'TRUE' else False
+      self.eyepoints = int(params.get('eyepoints', 1)) # lens samples per pixel sample, see getLensOffsets
+      self.lensSize = float(params.get('lensSize', .2)) # diameter of the camera's lens
       self.bShowImage = True if params.get('show_image', 'true').upper() == 'TRUE' else False
+      self.mode = params.get('mode', 'scalar') # see Scene.renderScene for the rendering modes
+      self.tileSize = int(params.get('tileSize', 64)) # size of the tiles used by the vectorized renderer
+      self.workers = int(params.get('workers', 1)) # number of processes rendering the tiles, <= 0 uses all the CPUs
+      self.shadowCache = True if params.get('shadowCache', 'false').upper() == 'TRUE' else False # see Scene.ShadowCache
+      self.accelerator = params.get('accelerator', 'bvh') # bvh, grid, compiled or none, see Scene.build_accelerator
+      self.flatten = True if params.get('flatten', 'false').upper() == 'TRUE' else False # see SceneNode.flatten
+      self.adaptiveThreshold = float(params.get('adaptiveThreshold', 0.1)) # contrast of the pixels refined by Scene.render_adaptive
+      self.timeBudget = float(params.get('timeBudget', 0.)) # seconds for Scene.render_progressive, 0 is unlimited
+      self.gamma = float(params.get('gamma', 1.)) # gamma correction applied by getImage
+      self.profile = params.get('profile', 'none') # none, json or pstats, see Scene.renderScene
+      self.heatmap = True if params.get('heatmap', 'false').upper() == 'TRUE' else False # scalar mode only, see Scene.save_cost_heatmap
       self.OUTDIR_REL_PATH = params.get('out_dir_rel_path', self.OUTDIR_REL_PATH)
       
       #print(params)
@@ -96,19 +184,57 @@ class Render:
         os.makedirs(self.OUTDIR_REL_PATH)
         
   def init(self, width, height):
-    self.image = Image.new("RGB",(width, height) ,"black")
+    ''' 
+    Clears the framebuffer, a float32 array of shape (height, width, 3) that
+    keeps the colors of the pixels until they are converted by getImage.
+    '''
+    self.framebuffer = np.zeros((height, width, 3), dtype = np.float32)
+    self.image = None
     
   def setPixel(self, pixel, color):
     """
     Set the pixel to the value. Here color is considered to be floating-point
     """
     #assert(np.all(color <= 1.0) and np.all(0. <= color))
-    ''' PIL's putpixel requires the 2nd argument to be a tuple of unsigned 8 bit integers'''
-    #self.image.putpixel(pixel, tuple(np.uint32(color * 255)))
     if type(color) is not np.ndarray: # this shouldn't happen if everything is done correctly
         print(pixel, color)
-    self.image.putpixel(pixel, (int(color[0] * 255), int(color[1] * 255), int(color[2] * 255)))
+    self.framebuffer[pixel[1], pixel[0]] = color
+
+  def setTile(self, tile, colors):
+    """
+    Set all the pixels of a tile (left, top, right, bottom), e.g. a whole
+    row of the image. colors is a floating-point array of shape (height,
+    width, 3) of the tile.
+    """
+    left, top, right, bottom = tile
+    self.framebuffer[top:bottom, left:right] = colors
+
+  def getImage(self):
+    '''
+    Returns the framebuffer as an 8 bit RGB PIL image. The colors are clamped
+    to [0, 1], gamma corrected (color ** (1 / gamma)) and scaled to [0, 255]
+    for all the pixels at once.
+    '''
+    colors = np.clip(self.framebuffer, 0., 1.)
+    if self.gamma != 1.:
+        colors **= 1. / self.gamma
+    return Image.fromarray(np.trunc(colors * 255).astype(np.uint8), "RGB")
         
+  def saveFalseColor(self, values, filename):
+    '''
+    Saves the array values of shape (height, width) as a false colour PNG
+    image: 0 is dark blue and the largest value (or the 99th percentile if
+    there are a few much larger values) is red, through cyan, green and
+    yellow.
+    '''
+    values = np.asarray(values, dtype = float)
+    top = max(np.percentile(values, 99), 1e-12)
+    scaled = np.clip(values / top, 0., 1.)
+    anchors = [0., 0.25, 0.5, 0.75, 1.]
+    colors = np.array([[0., 0., 0.5], [0., 1., 1.], [0., 1., 0.], [1., 1., 0.], [1., 0., 0.]])
+    rgb = np.dstack([np.interp(scaled, anchors, colors[:, channel]) for channel in range(3)])
+    Image.fromarray(np.trunc(rgb * 255).astype(np.uint8), "RGB").save(filename, "PNG")
+
   def getPixel(self):
       ''' 
       Generator that returns a pixel. A pixel is a python list with the 
@@ -117,7 +243,89 @@ class Render:
       for row in range(self.camera.imageSize[1]):
           for col in range(self.camera.imageSize[0]):
               yield [col, row]
-      
+
+  def getPixelGrid(self, tile = None):
+      '''
+      Returns the (rows, cols) coordinate arrays of all the pixels in a tile.
+      A tile is given as a (left, top, right, bottom) box in the same way as
+      PIL does it (right and bottom are excluded). If tile is None then the
+      whole image is used. Both arrays have shape (height, width) of the tile.
+      '''
+      if tile is None:
+          tile = (0, 0, self.camera.imageSize[0], self.camera.imageSize[1])
+      left, top, right, bottom = tile
+      return np.mgrid[top:bottom, left:right]
+
+  def getSamplesPerPixel(self):
+      ''' the number of rays traced per pixel '''
+      if self.isDepthOfField():
+          return self.samples * self.samples * self.eyepoints
+      return self.samples * self.samples
+
+  def isSupersampled(self):
+      ''' False if a single ray goes through each pixel (see create_ray) '''
+      return self.samples > 1 or self.jitter or self.isDepthOfField()
+
+  def isDepthOfField(self):
+      ''' True if the rays start on the camera's lens, see getLensOffsets '''
+      return self.eyepoints > 1 and self.lensSize > 0.
+
+  def getSampleOffsets(self, shape, random = np.random):
+      '''
+      Returns the offsets (row_offsets, col_offsets) of the samples from the
+      coordinates of the pixels for an array of pixels of the given shape.
+      Both arrays have shape shape + (getSamplesPerPixel(),). The pixel is 
+      divided into samples x samples cells (strata) centered at the pixel's
+      coordinates and there is one sample per cell: at the center of the cell,
+      or at a random position in the cell (drawn from random, e.g. a numpy
+      RandomState) if jitter is set.
+      '''
+      n = self.samples
+      strata_rows, strata_cols = np.mgrid[0:n, 0:n].reshape(2, -1)
+      shape = tuple(shape) + (n * n,)
+      if self.jitter:
+          u = random.uniform(0., 1., (2,) + shape)
+      else:
+          u = np.full((2,) + shape, 0.5)
+      return (strata_rows + u[0]) / n - 0.5, (strata_cols + u[1]) / n - 0.5
+
+  def getLensOffsets(self, shape, random = np.random):
+      '''
+      Returns the positions (x, y) of the eyepoints on the lens, a disk of
+      diameter lensSize centered at the camera's eye, in camera coordinates.
+      Both arrays have shape shape + (eyepoints,). The disk is divided into
+      eyepoints rings of the same area and there is one eyepoint per ring,
+      rotated by the golden angle from the one of the previous ring. If
+      jitter is set the eyepoints are at random positions in their ring and
+      the pattern is randomly rotated (drawn from random), otherwise all the
+      samples use the same eyepoints.
+      '''
+      n = self.eyepoints
+      shape = tuple(shape) + (n,)
+      if self.jitter:
+          u = random.uniform(0., 1., shape)
+          phi = random.uniform(0., 2. * np.pi, shape[:-1] + (1,))
+      else:
+          u = np.full(shape, 0.5)
+          phi = np.zeros(shape[:-1] + (1,))
+      radius = 0.5 * self.lensSize * np.sqrt((np.arange(n) + u) / n)
+      angle = np.arange(n) * (np.pi * (3. - np.sqrt(5.))) + phi
+      return radius * np.cos(angle), radius * np.sin(angle)
+
+  def getTile(self, tileSize = None):
+      '''
+      Generator that returns the image tiles of size tileSize x tileSize (the
+      tiles on the right and bottom border may be smaller). A tile is a tuple
+      (left, top, right, bottom), see getPixelGrid. Render.tileSize is used
+      by default.
+      '''
+      if tileSize is None:
+          tileSize = self.tileSize
+      width, height = self.camera.imageSize
+      for top in range(0, height, tileSize):
+          for left in range(0, width, tileSize):
+              yield (left, top, min(left + tileSize, width), min(top + tileSize, height))
+
   def save(self):
     '''
     save the rendered image to a file and also display it using matplotlib
@@ -125,6 +333,7 @@ class Render:
     '''
     try:
         print('saving image to ' + self.OUTDIR_REL_PATH + self.output + ' ...')
+        self.image = self.getImage()
         self.image.save(self.OUTDIR_REL_PATH + self.output, "PNG")
         print('done.')
     except:
@@ -132,6 +341,7 @@ class Render:
     
     try:
         if self.bShowImage is True:
+            from matplotlib import pyplot as plt # only imported when it's used, e.g. not by BatchRender
             plt.imshow(self.image)
             plt.title('Finished rendering.\nImage stored in ' + self.OUTDIR_REL_PATH + self.output)
             plt.show()
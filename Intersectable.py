@@ -1,6 +1,7 @@
 from __future__ import division # consider all division as floating point division
 from HelperClasses import Material
-from Ray import Ray, IntersectionResult
+from Ray import Ray, IntersectionResult, IntersectionPacket
+from BVH import BVH, BOUNDS_PADDING, TINY_DIRECTION, safe_directions, ray_box_interval, rays_box_interval
 import GeomTransform as GT
 import numpy as np
 import math
@@ -25,6 +26,18 @@ class Sphere:
       self.material = params.get('material', Material())
       self.radius = float(params.get('radius', 1.0))
       self.center = np.array(params.get('center', [0., 0., 0.]))
+
+  def bounds(self, M = None):
+      ''' 
+      Axis-aligned bounding box of the sphere as a (minPoint, maxPoint) pair.
+      If the 4x4 affine transformation M is given, the box is the (tight) box 
+      of the transformed sphere, i.e. of an ellipsoid.
+      '''
+      if M is None:
+        return self.center - self.radius, self.center + self.radius
+      center = np.dot(M[:3,:3], self.center) + M[:3,3]
+      half_size = self.radius * np.sqrt(np.sum(M[:3,:3]**2, axis = 1))
+      return center - half_size, center + half_size
   
   def intersect(self, ray):
       ''' 
@@ -53,52 +66,101 @@ class Sphere:
       intersection point, the normal at the intersection and material of the 
       object at the intersection point.
       '''
-      isect = IntersectionResult() # by default isect corresponds to no intersection
-      
       global EPS_DISTANCE # use this for testing if a variable is close to 0
       #TODO ===== BEGIN SOLUTION HERE =====
 
-      # solving for t using the method from http://www.csee.umbc.edu/~olano/435f02/ray-sphere.html
-      p0pc = ray.eyePoint - self.center
-      v = ray.viewDirection
-      a = np.dot(v,v)
-      b = np.dot(2*v, p0pc)
-      c = np.dot(p0pc, p0pc) - self.radius**2
-      discriminant = b**2 - 4*a*c
-
-      # there are no intersections if discriminant < 0, so ignore this case
-      # (since isect has that by default)
-      
-      if discriminant >= 0 :
-
-        distsphere = np.linalg.norm(ray.eyePoint-self.center)
-        
-        t1 = (-b + np.sqrt(discriminant))/(2*a)
-        t2 = (-b - np.sqrt(discriminant))/(2*a)
-
-
-
-        # find the closest to ray's origin
-        dist1 = np.linalg.norm(ray.getPoint(t1)-ray.eyePoint)
-        dist2 = np.linalg.norm(ray.getPoint(t2)-ray.eyePoint)
+      # Single quadratic a t^2 + 2 half_b t + c = 0 solved with python floats,
+      # only the IntersectionResult of a hit is created (the default one
+      # corresponds to no intersection).
+      ox, oy, oz = ray.eyePoint.tolist()
+      vx, vy, vz = ray.viewDirection.tolist()
+      cx, cy, cz = self.center.tolist()
+      px, py, pz = ox - cx, oy - cy, oz - cz
+      a = vx*vx + vy*vy + vz*vz
+      half_b = vx*px + vy*py + vz*pz
+      c = px*px + py*py + pz*pz - self.radius**2
+      discriminant = half_b*half_b - a*c
+
+      # there are no intersections if discriminant < 0
+      if discriminant < 0 or a == 0:
+        return IntersectionResult()
+      sqrt_discriminant = math.sqrt(discriminant)
+      t1 = (-half_b + sqrt_discriminant) / a
+      t2 = (-half_b - sqrt_discriminant) / a
+
+      # take the root closest to the ray's origin, unless it is the origin
+      # itself or the origin is inside (or on) the sphere
+      norm_v = math.sqrt(a)
+      dist1 = abs(t1) * norm_v
+      dist2 = abs(t2) * norm_v
+      outside = c > 0
+      if dist1 < dist2:
+        t = t1 if dist1 > EPS_DISTANCE and outside else t2
+      else:
+        t = t2 if dist2 > EPS_DISTANCE and outside else t1
+      if t <= EPS_DISTANCE:
+        return IntersectionResult()
+      # ===== END SOLUTION HERE =====
+      # the point and the normal are only computed for the nearest hit
+      return IntersectionResult(t, primitive = self, ray = ray)
 
+  def get_normal(self, isect):
+      ''' normal at the point of the intersection isect returned by intersect '''
+      return (isect.p - self.center) / self.radius
 
+  def get_material(self, isect):
+      return self.material
 
-        if dist1 < dist2:
-          t = t1 if dist1 > EPS_DISTANCE and distsphere > self.radius else t2 
-        else:
-          t = t2 if dist2 > EPS_DISTANCE and distsphere > self.radius else t1
+  def intersect_many(self, origins, directions):
+      '''
+      Packet version of intersect. origins and directions are arrays of shape
+      (N, 3) holding N rays in the same coordinate system as the sphere. The
+      intersections are chosen in the same way as in intersect.
+      output: IntersectionPacket (see Ray.py)
+      '''
+      isects = IntersectionPacket(len(origins))
 
-        if (t > EPS_DISTANCE) :
-          p = ray.getPoint(t)
+      p0pc = origins - self.center
+      v = directions
+      a = np.sum(v * v, axis = 1)
+      b = 2 * np.sum(v * p0pc, axis = 1)
+      c = np.sum(p0pc * p0pc, axis = 1) - self.radius**2
+      discriminant = b**2 - 4*a*c
 
-          isect.t = t 
-          isect.p = p
-          isect.material = self.material
-          isect.n = GT.normalize(isect.p - self.center)
+      index = np.nonzero(discriminant >= 0)[0]
+      if len(index) == 0:
+        return isects
+      a, b, c = a[index], b[index], c[index]
+      sqrt_discriminant = np.sqrt(discriminant[index])
+      t1 = (-b + sqrt_discriminant)/(2*a)
+      t2 = (-b - sqrt_discriminant)/(2*a)
+
+      # same choice of t as in intersect
+      outside = np.sqrt(c + self.radius**2) > self.radius
+      dist1 = np.abs(t1) * np.sqrt(a)
+      dist2 = np.abs(t2) * np.sqrt(a)
+      t = np.where(dist1 < dist2,
+                   np.where((dist1 > EPS_DISTANCE) & outside, t1, t2),
+                   np.where((dist2 > EPS_DISTANCE) & outside, t2, t1))
+
+      valid = t > EPS_DISTANCE
+      index, t = index[valid], t[valid]
+      isects.t[index] = t
+      isects.p[index] = origins[index] + directions[index] * t[:, np.newaxis]
+      isects.n[index] = GT.normalize_many(isects.p[index] - self.center)
+      isects.material_index[index] = isects.get_material_index(self.material)
+      return isects
+
+  def occluded(self, ray, t_max):
+      ''' 
+      Any-hit query used for shadow rays: True if the ray intersects the 
+      sphere at a distance t with EPS_DISTANCE < t < t_max.
+      '''
+      return self.intersect(ray).t < t_max
 
-      # ===== END SOLUTION HERE ===== 
-      return isect
+  def occluded_many(self, origins, directions, t_max):
+      ''' Packet version of occluded, t_max is an array of shape (N,) '''
+      return self.intersect_many(origins, directions).t < t_max
 
 
 class Plane:
@@ -125,6 +187,10 @@ class Plane:
           self.material2 = material_list[1]
       #print(params)
       #print(self.normal, self.material, self.material2)
+
+  def bounds(self, M = None):
+      ''' planes are unbounded '''
+      return None
     
   def intersect(self, ray):
     ''' 
@@ -155,10 +221,8 @@ class Plane:
     object at the intersection point. For checkerboard planes you need to 
     decide which of the two materials to use at the intersection point.
     '''
-    isect = IntersectionResult()
-
     global EPS_DISTANCE # use this for testing if a variable is close to 0
-    #TODO ===== BEGIN SOLUTION HERE =====  
+    #TODO ===== BEGIN SOLUTION HERE =====
 
     parallel_check = np.dot(self.normal, ray.viewDirection)
     # if you're not parallel (i.e. you have an intersection)
@@ -166,18 +230,59 @@ class Plane:
       t = - np.dot(self.normal, ray.eyePoint) / parallel_check
       # if the ray does not go away from the plane
       if t > EPS_DISTANCE:
-        isect.t = t
-        isect.p = ray.getPoint(t)
-        isect.n = self.normal
-        isect.material = self.material
-        if self.material2 is not None: 
-          if np.ceil(isect.p[0]) % 2 == np.ceil(isect.p[2])%2:
-            isect.material = self.material
-          else:
-            isect.material = self.material2
-
-    # ===== END SOLUTION HERE ===== 
-    return isect
+        # the material is only chosen for the nearest hit, see get_material
+        return IntersectionResult(t, primitive = self, ray = ray)
+
+    # ===== END SOLUTION HERE =====
+    return IntersectionResult()
+
+  def get_normal(self, isect):
+    return self.normal
+
+  def get_material(self, isect):
+    ''' material at the point of the intersection isect returned by intersect '''
+    if self.material2 is not None:
+      if np.ceil(isect.p[0]) % 2 != np.ceil(isect.p[2]) % 2:
+        return self.material2
+    return self.material
+
+  def intersect_many(self, origins, directions):
+    '''
+    Packet version of intersect. origins and directions are arrays of shape
+    (N, 3) holding N rays in the same coordinate system as the plane.
+    output: IntersectionPacket (see Ray.py)
+    '''
+    isects = IntersectionPacket(len(origins))
+
+    parallel_check = np.dot(directions, self.normal)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+      t = -np.dot(origins, self.normal) / parallel_check
+    index = np.nonzero((parallel_check != 0) & (t > EPS_DISTANCE))[0]
+    if len(index) == 0:
+      return isects
+    t = t[index]
+    isects.t[index] = t
+    isects.p[index] = p = origins[index] + directions[index] * t[:, np.newaxis]
+    isects.n[index] = self.normal
+    first = isects.get_material_index(self.material)
+    if self.material2 is not None:
+      second = isects.get_material_index(self.material2)
+      checker = np.ceil(p[:,0]) % 2 == np.ceil(p[:,2]) % 2
+      isects.material_index[index] = np.where(checker, first, second)
+    else:
+      isects.material_index[index] = first
+    return isects
+
+  def occluded(self, ray, t_max):
+    ''' 
+    Any-hit query used for shadow rays: True if the ray intersects the 
+    plane at a distance t with EPS_DISTANCE < t < t_max.
+    '''
+    return self.intersect(ray).t < t_max
+
+  def occluded_many(self, origins, directions, t_max):
+    ''' Packet version of occluded, t_max is an array of shape (N,) '''
+    return self.intersect_many(origins, directions).t < t_max
     
 class Box:
   """
@@ -196,39 +301,18 @@ class Box:
       assert(np.all(self.minPoint <= self.maxPoint))
       #print(self.minPoint, self.maxPoint, self.material)
 
-  def plane_intersect(self,ray,normal,d):
-    isect = IntersectionResult()
-
-    global EPS_DISTANCE # use this for testing if a variable is close to 0
-
-    parallel_check = np.dot(normal, ray.viewDirection)
-    # if you're not parallel (i.e. you have an intersection)
-    if parallel_check != 0:
-      t = (d - np.dot(normal, ray.eyePoint)) / parallel_check
-      # if the ray does not go away from the plane
-      if t > EPS_DISTANCE:
-        isect.t = t
-        isect.p = ray.getPoint(t)
-        isect.n = normal
-        isect.material = self.material
-
-    return isect
+  def bounds(self, M = None):
+      ''' 
+      Axis-aligned bounding box as a (minPoint, maxPoint) pair. If the 4x4
+      affine transformation M is given, the box is the (tight) box of the
+      transformed box.
+      '''
+      if M is None:
+        return self.minPoint.copy(), self.maxPoint.copy()
+      center = np.dot(M[:3,:3], (self.minPoint + self.maxPoint) / 2.) + M[:3,3]
+      half_size = np.dot(np.abs(M[:3,:3]), (self.maxPoint - self.minPoint) / 2.)
+      return center - half_size, center + half_size
 
-  def within_bounds(self, point):
-    # is_in_range = False
-    # if (point[0] >= self.minPoint[0] - EPS_DISTANCE and 
-    #   point[0] <= self.maxPoint[0] + EPS_DISTANCE and
-    #   point[1] >= self.minPoint[1] - EPS_DISTANCE and
-    #   point[1] <= self.maxPoint[1] + EPS_DISTANCE and 
-    #   point[2] >= self.minPoint[2] - EPS_DISTANCE and 
-    #   point[2] <= self.maxPoint[2] + EPS_DISTANCE):
-    #   is_in_range = True 
-    # return is_in_range
-    for i in range(3):
-      if point[i] < self.minPoint[i] - EPS_DISTANCE or point[i] > self.maxPoint[i] + EPS_DISTANCE:
-        return False
-    return True
-      
   def intersect(self, ray):
     """
       The box can be viewed as the intersection of 6 planes. The following code
@@ -248,45 +332,109 @@ class Box:
     intersection point, the normal at the intersection and material of the 
     object at the intersection point.
     '''
-    isect = IntersectionResult()
-    
     global EPS_DISTANCE # use this for testing if a variable is close to 0
-    # tmin and tmax are temporary variables to keep track of the order of the
-    # plane intersections.  The ray will pass through at least a set of parallel
-    # planes. tmin is the last intersection of the first planes of each set, and
-    # tmax is the first intersection of the last planes of each set. 
-    tmax = np.inf
-    tmin = -np.inf
+    # tnear and tfar keep track of the order of the plane intersections. The
+    # ray will pass through at least a set of parallel planes. tnear is the
+    # last intersection of the first planes of each set (the slab test, see
+    # intersect_many), and tfar is the first intersection of the last planes
+    # of each set. Only the IntersectionResult of a hit is created.
     
     #TODO ===== BEGIN SOLUTION HERE =====
 
-    normals = [ [1,0,0], [-1,0,0], [0,1,0], [0,-1,0], [0,0,1], [0,0,-1] ]
-    ds = [normals[0][0]*self.maxPoint[0],
-      normals[1][0]*self.minPoint[0],
-      normals[2][1]*self.maxPoint[1],
-      normals[3][1]*self.minPoint[1],
-      normals[4][2]*self.maxPoint[2],
-      normals[5][2]*self.minPoint[2]]
-    # ds = [abs(self.maxPoint[0]),
-    #   abs(self.minPoint[0]),
-    #   abs(self.maxPoint[1]),
-    #   abs(self.minPoint[1]),
-    #   abs(self.maxPoint[2]),
-    #   abs(self.minPoint[2])]
-
-    min_t = np.inf
-    # go through each plane and collect its intersect information
-    for (normal, d) in zip(normals, ds):
-      thisplane = self.plane_intersect(ray,normal,d)
-      # now make sure you only consider those within bounds
-      if self.within_bounds(thisplane.p):
-        # with t >= EPS_DISTANCE and < min
-        if thisplane.t > EPS_DISTANCE and thisplane.t < min_t:
-          isect = thisplane
-          min_t = thisplane.t
+    origin = ray.eyePoint.tolist()
+    direction = ray.viewDirection.tolist()
+    tnear, tfar = -np.inf, np.inf
+    near_axis = far_axis = 0
+    for axis, lo, hi in zip((0, 1, 2), self.minPoint.tolist(), self.maxPoint.tolist()):
+      o, v = origin[axis], direction[axis]
+      if v == 0:
+        # parallel to the pair of planes, always or never between them
+        if o < lo - EPS_DISTANCE or o > hi + EPS_DISTANCE:
+          return IntersectionResult()
+        continue
+      t0, t1 = (lo - o) / v, (hi - o) / v
+      if t0 > t1:
+        t0, t1 = t1, t0
+      if t0 > tnear:
+        tnear, near_axis = t0, axis
+      if t1 < tfar:
+        tfar, far_axis = t1, axis
+    if tnear > tfar or tfar <= EPS_DISTANCE or tfar == np.inf:
+      return IntersectionResult()
+
+    # use the exit point for rays starting inside (or on) the box
+    if tnear > EPS_DISTANCE:
+      t, axis, side = tnear, near_axis, -1.
+    else:
+      t, axis, side = tfar, far_axis, 1.
+    # the normal is only computed for the nearest hit, see get_normal
+    detail = (axis, side if direction[axis] > 0 else -side)
 
     # ===== END SOLUTION HERE =====
-    return isect
+    return IntersectionResult(t, primitive = self, ray = ray, detail = detail)
+
+  def get_normal(self, isect):
+    ''' normal of the face given by the (axis, sign) detail of isect '''
+    n = np.zeros(3)
+    axis, sign = isect.detail
+    n[axis] = sign
+    return n
+
+  def get_material(self, isect):
+    return self.material
+
+  def intersect_many(self, origins, directions):
+    '''
+    Packet version of intersect. origins and directions are arrays of shape
+    (N, 3) holding N rays in the same coordinate system as the box.
+    Instead of intersecting the 6 planes the slab test is used: the ray
+    enters the box at the last of the near plane intersections (tnear) and
+    leaves it at the first of the far plane intersections (tfar).
+    output: IntersectionPacket (see Ray.py)
+    '''
+    isects = IntersectionPacket(len(origins))
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+      t_min_planes = (self.minPoint - origins) / directions
+      t_max_planes = (self.maxPoint - origins) / directions
+    t_near = np.minimum(t_min_planes, t_max_planes)
+    t_far = np.maximum(t_min_planes, t_max_planes)
+    # rays parallel to a pair of planes are either always or never between them
+    parallel = directions == 0
+    inside = (origins >= self.minPoint - EPS_DISTANCE) & (origins <= self.maxPoint + EPS_DISTANCE)
+    t_near[parallel] = np.where(inside[parallel], -np.inf, np.inf)
+    t_far[parallel] = np.where(inside[parallel], np.inf, -np.inf)
+
+    near_axis = np.argmax(t_near, axis = 1)
+    far_axis = np.argmin(t_far, axis = 1)
+    rays = np.arange(len(origins))
+    tnear = t_near[rays, near_axis]
+    tfar = t_far[rays, far_axis]
+
+    index = np.nonzero((tnear <= tfar) & (tfar > EPS_DISTANCE))[0]
+    if len(index) == 0:
+      return isects
+    # use the exit point for rays starting inside (or on) the box
+    entering = tnear[index] > EPS_DISTANCE
+    t = np.where(entering, tnear[index], tfar[index])
+    axis = np.where(entering, near_axis[index], far_axis[index])
+    direction_sign = np.sign(directions[index, axis])
+    isects.t[index] = t
+    isects.p[index] = origins[index] + directions[index] * t[:, np.newaxis]
+    isects.n[index, axis] = np.where(entering, -direction_sign, direction_sign)
+    isects.material_index[index] = isects.get_material_index(self.material)
+    return isects
+
+  def occluded(self, ray, t_max):
+    ''' 
+    Any-hit query used for shadow rays: True if the ray intersects the 
+    box at a distance t with EPS_DISTANCE < t < t_max.
+    '''
+    return self.intersect(ray).t < t_max
+
+  def occluded_many(self, origins, directions, t_max):
+    ''' Packet version of occluded, t_max is an array of shape (N,) '''
+    return self.intersect_many(origins, directions).t < t_max
     
 class SceneNode:
   """
@@ -298,10 +446,16 @@ class SceneNode:
   and translations.  The intersection ray will be transformed to find the intersection
   in the transformed space, and the intersection result is transformed back to
   the original coordinate space.  It performs a test for all its children.
+  If build_accelerator has been called the children with bounds are stored
+  in a BVH and only the unbounded children are tested one by one.
   
   """
   def __init__(self, M = np.eye(4), params = None):
     self.children = []
+    self.accelerator = None # see build_accelerator
+    self.unbounded_children = []
+    self.cachedBounds = None # see bounds
+    self.cachedBoundsKey = None
     self.M = M
     if params is not None:
         rot_angles = np.array(params.get('rotation', [0., 0., 0.]))
@@ -315,7 +469,112 @@ class SceneNode:
         
     self.Minv = np.linalg.inv(self.M)
     #print(self.M, self.Minv)
+
+  def bounds(self, M = None):
+    '''
+    Tight axis-aligned bounding box of the node in its parent's coordinate
+    system as a (minPoint, maxPoint) pair, or None if any of the children is
+    unbounded. The box takes the rotation, translation and scale of M into
+    account for each child. If the 4x4 affine transformation M is given, 
+    the box of the node transformed by M is returned instead.
+    The box in the parent's coordinate system is cached until M, Minv or
+    the children list of the node are replaced or the number of children
+    changes. Call invalidate_bounds after changing them in place.
+    '''
+    if M is not None:
+      return self.compute_bounds(np.dot(M, self.M))
+    key = (id(self.M), id(self.children), len(self.children))
+    if self.cachedBoundsKey != key:
+      self.cachedBounds = self.compute_bounds(self.M)
+      self.cachedBoundsKey = key
+    return self.cachedBounds
+
+  def invalidate_bounds(self):
+    self.cachedBoundsKey = None
+
+  def compute_bounds(self, M):
+    ''' union of the boxes of the children transformed by M '''
+    children_bounds = [child.bounds(M) for child in self.children]
+    if len(children_bounds) == 0 or any(b is None for b in children_bounds):
+      return None
+    return np.min([b[0] for b in children_bounds], axis = 0), \
+           np.max([b[1] for b in children_bounds], axis = 0)
+
+  def rays_hitting_bounds(self, origins, directions):
+    ''' indices of the rays of a packet that hit the bounding box of the node '''
+    bounds = self.bounds()
+    if bounds is None:
+      return np.arange(len(origins))
+    t_enter, t_exit = rays_box_interval(bounds[0] - BOUNDS_PADDING, bounds[1] + BOUNDS_PADDING,
+                                        origins, 1. / safe_directions(directions))
+    return np.nonzero((t_enter <= t_exit) & (t_exit >= 0))[0]
+
+  def is_missed_by(self, ray):
+    ''' cheap test for rays that miss the bounding box of the node '''
+    bounds = self.bounds()
+    if bounds is None:
+      return False
+    inv_direction = [1. / (d if d != 0 else TINY_DIRECTION) for d in ray.viewDirection]
+    t_enter, t_exit = ray_box_interval(bounds[0] - BOUNDS_PADDING, bounds[1] + BOUNDS_PADDING,
+                                       ray.eyePoint, inv_direction)
+    return t_enter > t_exit or t_exit < 0
+
+  def build_accelerator(self, shared = None):
+    '''
+    Stores the children that have bounds in a BVH, this node's child nodes
+    are processed first. Needs to be called again if the children change.
+    Nodes that share the same children list (see the ref nodes in
+    SceneParser.process_node) also share the BVH: shared is a dictionary
+    mapping id(children) to (children, accelerator, unbounded_children)
+    that is filled by the calls with the same dictionary.
+    '''
+    if shared is None:
+      shared = dict()
+    key = id(self.children)
+    if key not in shared:
+      for child in self.children:
+        if isinstance(child, SceneNode):
+          child.build_accelerator(shared)
+      bounded = [child for child in self.children if child.bounds() is not None]
+      if len(bounded) > 1:
+        unbounded = [child for child in self.children if child.bounds() is None]
+        shared[key] = (self.children, BVH(bounded), unbounded)
+      else:
+        shared[key] = (self.children, None, [])
+    children, self.accelerator, self.unbounded_children = shared[key]
+
+  def get_intersectable_children(self):
+    ''' The objects that need to be intersected for finding the nearest child intersection '''
+    if self.accelerator is None:
+      return self.children
+    return [self.accelerator] + self.unbounded_children
     
+  def flatten(self, M = None):
+    '''
+    Collapses the hierarchy below this node into a list of Instance objects,
+    one per primitive, holding the composite transformation of all the nodes
+    above the primitive. M is the transformation of this node's parent
+    (identity by default). Intersecting the instances gives the same result
+    as intersecting the node, see Scene.build_accelerator.
+    '''
+    M = self.M if M is None else np.dot(M, self.M)
+    instances = []
+    for child in self.children:
+      if isinstance(child, SceneNode):
+        instances.extend(child.flatten(M))
+      else:
+        instances.append(Instance(child, M))
+    return instances
+
+  def transform_ray(self, ray):
+    ''' 
+    Transforms the ray to the children's coordinate system. The direction is
+    not normalized so that the distance t along the ray stays the same.
+    '''
+    origin = np.dot(self.Minv[:3,:3], ray.eyePoint) + self.Minv[:3,3]
+    direction = np.dot(self.Minv[:3,:3], ray.viewDirection)
+    return Ray(origin, direction)
+
   def intersect(self, ray):
     ''' 
     Implement intersection between the ray and the current object and 
@@ -327,6 +586,9 @@ class SceneNode:
     isect = IntersectionResult()
     
     global EPS_DISTANCE # use this for testing if a variable is close to 0  
+    # no need to transform rays that miss the node's bounding box
+    if self.is_missed_by(ray):
+      return isect
     #TODO ===== BEGIN SOLUTION HERE =====
 
     # invEye = [ray.eyePoint[0], ray.eyePoint[1], ray.eyePoint[2], 1.0]
@@ -373,26 +635,198 @@ class SceneNode:
 
     inverse_ray = Ray(invEye[:-1], invDir[:-1])
 
-    # now find the intersection
-    min_t = np.inf
-    for child in self.children:
-      
+    # now find the intersection, only the nearest one is transformed back to
+    # world coordinates (see get_normal, t and therefore p stay the same)
+    for child in self.get_intersectable_children():
       temp_isect = child.intersect(inverse_ray)
-      
-      # transform the intersection back to world coordinates
-      temp_p = np.ones(4)
-      temp_p[:-1] = temp_isect.p 
-      temp_isect.p = np.dot(self.M, temp_p)[:-1]
-
-      # update the normal also
-      temp_n = np.ones(4)
-      temp_n[:-1] = temp_isect.n
-      temp_isect.n = GT.normalize(np.dot(self.Minv.T, temp_n)[:-1])
-      
       # decide to accept or reject the intersection
-      if temp_isect.t < min_t and temp_isect.t > EPS_DISTANCE:
-        min_t = temp_isect.t 
-        isect = temp_isect 
+      if temp_isect.t < isect.t and temp_isect.t > EPS_DISTANCE:
+        isect = temp_isect
+    if isect.t < np.inf:
+      isect = IntersectionResult(isect.t, primitive = self, ray = ray, detail = isect)
 
     # ===== END SOLUTION HERE =====
-    return isect  
\ No newline at end of file
+    return isect
+
+  def get_normal(self, isect):
+    ''' 
+    normal of the intersection isect returned by intersect, the normal of the
+    child's intersection (isect.detail) transformed by the inverse transpose of M
+    '''
+    return GT.normalize(np.dot(self.Minv[:3,:3].T, isect.detail.n))
+
+  def get_material(self, isect):
+    return isect.detail.material
+
+  def intersect_many(self, origins, directions):
+    '''
+    Packet version of intersect. origins and directions are arrays of shape
+    (N, 3). The whole packet is transformed to the children's coordinate
+    system once, the nearest child intersections are found and then 
+    transformed back to the original coordinate space.
+    output: IntersectionPacket (see Ray.py)
+    '''
+    isects = IntersectionPacket(len(origins))
+    # only the rays that hit the node's bounding box need to be transformed
+    rays = self.rays_hitting_bounds(origins, directions)
+    if len(rays) == 0:
+      return isects
+
+    # as in intersect, the direction is not normalized so that t stays the same
+    inv_origins = np.dot(origins[rays], self.Minv[:3,:3].T) + self.Minv[:3,3]
+    inv_directions = np.dot(directions[rays], self.Minv[:3,:3].T)
+
+    children_isects = IntersectionPacket(len(rays))
+    for child in self.get_intersectable_children():
+      children_isects.update(child.intersect_many(inv_origins, inv_directions))
+
+    # transform the intersections back to the original coordinates
+    index = np.nonzero(children_isects.material_index >= 0)[0]
+    children_isects.p[index] = np.dot(children_isects.p[index], self.M[:3,:3].T) + self.M[:3,3]
+    children_isects.n[index] = GT.normalize_many(np.dot(children_isects.n[index], self.Minv[:3,:3]))
+    isects.update(children_isects, rays)
+    return isects
+
+  def occluded(self, ray, t_max):
+    '''
+    Any-hit query used for shadow rays: True if any child is intersected at
+    a distance t with EPS_DISTANCE < t < t_max. Stops at the first such child.
+    '''
+    if self.is_missed_by(ray):
+      return False
+    inverse_ray = self.transform_ray(ray)
+    for child in self.get_intersectable_children():
+      if child.occluded(inverse_ray, t_max):
+        return True
+    return False
+
+  def occluded_many(self, origins, directions, t_max):
+    ''' 
+    Packet version of occluded, t_max is an array of shape (N,). A ray is
+    not tested against the remaining children once it is occluded.
+    '''
+    occluded = np.zeros(len(origins), dtype = bool)
+    rays = self.rays_hitting_bounds(origins, directions)
+    inv_origins = np.dot(origins[rays], self.Minv[:3,:3].T) + self.Minv[:3,3]
+    inv_directions = np.dot(directions[rays], self.Minv[:3,:3].T)
+    active = np.arange(len(rays))
+    for child in self.get_intersectable_children():
+      if len(active) == 0:
+        break
+      hit = child.occluded_many(inv_origins[active], inv_directions[active], t_max[rays[active]])
+      occluded[rays[active[hit]]] = True
+      active = active[~hit]
+    return occluded
+
+
+class Instance:
+  """
+
+  Instance class
+
+  A primitive (Sphere, Plane or Box) together with the composite
+  transformation M of all the scene nodes above it (see SceneNode.flatten).
+  Minv and the normal matrix are computed once, so a ray is transformed once
+  per instance instead of once per level of the hierarchy.
+
+  """
+  def __init__(self, primitive, M):
+    self.primitive = primitive
+    self.M = M
+    self.Minv = np.linalg.inv(M)
+    # normals are transformed by the inverse transpose of M
+    self.normalMatrix = self.Minv[:3,:3].T
+
+  def bounds(self, M = None):
+    if M is not None:
+      return self.primitive.bounds(np.dot(M, self.M))
+    return self.primitive.bounds(self.M)
+
+  def transform_ray(self, ray):
+    ''' same as SceneNode.transform_ray, t stays the same '''
+    origin = np.dot(self.Minv[:3,:3], ray.eyePoint) + self.Minv[:3,3]
+    direction = np.dot(self.Minv[:3,:3], ray.viewDirection)
+    return Ray(origin, direction)
+
+  def intersect(self, ray):
+    isect = self.primitive.intersect(self.transform_ray(ray))
+    if isect.t < np.inf:
+      # as for SceneNode, only the normal of the nearest hit is transformed
+      isect = IntersectionResult(isect.t, primitive = self, ray = ray, detail = isect)
+    return isect
+
+  def get_normal(self, isect):
+    return GT.normalize(np.dot(self.normalMatrix, isect.detail.n))
+
+  def get_material(self, isect):
+    return isect.detail.material
+
+  def intersect_many(self, origins, directions):
+    ''' Packet version of intersect, see SceneNode.intersect_many '''
+    isects = self.primitive.intersect_many(np.dot(origins, self.Minv[:3,:3].T) + self.Minv[:3,3],
+                                           np.dot(directions, self.Minv[:3,:3].T))
+    index = np.nonzero(isects.material_index >= 0)[0]
+    isects.p[index] = np.dot(isects.p[index], self.M[:3,:3].T) + self.M[:3,3]
+    isects.n[index] = GT.normalize_many(np.dot(isects.n[index], self.normalMatrix.T))
+    return isects
+
+  def occluded(self, ray, t_max):
+    return self.primitive.occluded(self.transform_ray(ray), t_max)
+
+  def occluded_many(self, origins, directions, t_max):
+    return self.primitive.occluded_many(np.dot(origins, self.Minv[:3,:3].T) + self.Minv[:3,3],
+                                        np.dot(directions, self.Minv[:3,:3].T), t_max)
+
+
+class MaterialOverride:
+  """
+
+  MaterialOverride class
+
+  Wraps an intersectable that is shared between several scene nodes (see the
+  ref nodes in SceneParser.process_node) and replaces its material and/or
+  material2 in the intersection results, so that a node referring to a
+  shared child list can change the materials without copying the children.
+
+  """
+  def __init__(self, child, material = None, material2 = None):
+    self.child = child
+    # the materials of the child that are replaced
+    self.childMaterial = getattr(child, 'material', None)
+    self.childMaterial2 = getattr(child, 'material2', None)
+    self.material = self.childMaterial if material is None else material
+    self.material2 = self.childMaterial2 if material2 is None else material2
+
+  def override(self, material):
+    ''' the material replacing the given material of the child '''
+    if material is self.childMaterial:
+      return self.material
+    if material is self.childMaterial2:
+      return self.material2
+    return material
+
+  def bounds(self, M = None):
+    return self.child.bounds(M)
+
+  def intersect(self, ray):
+    isect = self.child.intersect(ray)
+    if isect.t < np.inf:
+      isect = IntersectionResult(isect.t, primitive = self, ray = ray, detail = isect)
+    return isect
+
+  def get_normal(self, isect):
+    return isect.detail.n
+
+  def get_material(self, isect):
+    return self.override(isect.detail.material)
+
+  def intersect_many(self, origins, directions):
+    isects = self.child.intersect_many(origins, directions)
+    isects.materials = [self.override(material) for material in isects.materials]
+    return isects
+
+  def occluded(self, ray, t_max):
+    return self.child.occluded(ray, t_max)
+
+  def occluded_many(self, origins, directions, t_max):
+    return self.child.occluded_many(origins, directions, t_max)
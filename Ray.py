@@ -1,7 +1,7 @@
 import numpy as np
 import GeomTransform as GT
 
-class Ray:
+class Ray(object):
   """
   
   Ray
@@ -20,7 +20,11 @@ class Ray:
   getPoint(self, t)
   The method getPoint(t) returns the point according to the above line equation.
   
+  Rays are created for every pixel, shadow ray and scene node so the class uses
+  __slots__ instead of a dictionary for its attributes.
+  
   """
+  __slots__ = ('eyePoint', 'viewDirection')
     
   def __init__(self, eyePoint = [0.0, 0.0, 0.0], viewDirection=[0.0, 0.0, 0.0]):
     self.eyePoint = np.array(eyePoint)
@@ -33,7 +37,7 @@ class Ray:
     return self.eyePoint + self.viewDirection * t
 
 
-class IntersectionResult:
+class IntersectionResult(object):
   """
   
   IntersectionResult
@@ -43,13 +47,58 @@ class IntersectionResult:
   looking at the value of t.  Also, it holds the normal of the intersected surface and
   the material, both required to compute the lighting.
   
+  Most of the intersections found while searching for the nearest one are
+  discarded, so an intersectable only stores t, itself (primitive), the ray and
+  whatever it needs later (detail) for a hit. The point p = ray.getPoint(t), the
+  normal n and the material are computed on first use, the last two by calling
+  primitive.get_normal(isect) and primitive.get_material(isect). They can also be
+  given directly to the constructor or assigned. Without arguments the result
+  corresponds to no intersection: t = inf, p and n are the shared (read-only)
+  ZeroVec3 and material is None.
+  
   """
+  __slots__ = ('t', 'primitive', 'ray', 'detail', '_p', '_n', '_material')
   ZeroVec3 = np.array([0.0, 0.0, 0.0])
-  def __init__(self):
-    self.n = self.ZeroVec3
-    self.p = self.ZeroVec3
-    self.material = None
-    self.t = np.inf
+  ZeroVec3.flags.writeable = False
+  def __init__(self, t = np.inf, p = None, n = None, material = None, 
+               primitive = None, ray = None, detail = None):
+    self._n = n
+    self._p = p
+    self._material = material
+    self.t = t
+    self.primitive = primitive
+    self.ray = ray
+    self.detail = detail
+    
+  @property
+  def p(self):
+    if self._p is None:
+      self._p = self.ZeroVec3 if self.primitive is None else self.ray.getPoint(self.t)
+    return self._p
+    
+  @p.setter
+  def p(self, p):
+    self._p = p
+    
+  @property
+  def n(self):
+    if self._n is None:
+      self._n = self.ZeroVec3 if self.primitive is None else self.primitive.get_normal(self)
+    return self._n
+    
+  @n.setter
+  def n(self, n):
+    self._n = n
+    
+  @property
+  def material(self):
+    if self._material is None and self.primitive is not None:
+      self._material = self.primitive.get_material(self)
+    return self._material
+    
+  @material.setter
+  def material(self, material):
+    self._material = material
     
   def __str__(self):
     return 'n : ' + str(self.n) + ' , p : ' + str(self.p) + ' , t : ' + str(self.t)
@@ -59,3 +108,57 @@ class IntersectionResult:
     return self.t < np.inf and self.t > 1e-9
   
     
+
+
+class IntersectionPacket:
+  """
+  
+  IntersectionPacket
+  
+  The packet version of IntersectionResult. It holds the intersection results
+  of N rays at once in numpy arrays: t has shape (N,), p and n have shape (N, 3).
+  Instead of a material per ray it holds the index of the material 
+  (material_index) in the packet's list of materials (materials). As with
+  IntersectionResult, t = inf, p = n = 0 and material_index = -1 when the ray
+  doesn't intersect anything.
+  
+  """
+  def __init__(self, N):
+    self.t = np.full(N, np.inf)
+    self.p = np.zeros((N, 3))
+    self.n = np.zeros((N, 3))
+    self.material_index = np.full(N, -1, dtype = int)
+    self.materials = []
+    
+  def __len__(self):
+    return len(self.t)
+    
+  def is_valid_intersection(self):
+    ''' boolean array, see IntersectionResult.is_valid_intersection '''
+    return (self.t < np.inf) & (self.t > 1e-9)
+    
+  def get_material_index(self, material):
+    ''' index of material in the list of materials, it is added if needed '''
+    for i, m in enumerate(self.materials):
+      if m is material:
+        return i
+    self.materials.append(material)
+    return len(self.materials) - 1
+    
+  def update(self, other, index = None):
+    '''
+    Keep the nearest intersection for each ray. other is an IntersectionPacket
+    for the rays given by the integer array index (all the rays if index is None).
+    '''
+    if index is None:
+      index = np.arange(len(self.t))
+    closer = other.t < self.t[index]
+    if not np.any(closer):
+      return
+    selected = index[closer]
+    self.t[selected] = other.t[closer]
+    self.p[selected] = other.p[closer]
+    self.n[selected] = other.n[closer]
+    # the last entry maps material_index -1 to -1
+    remap = np.array([self.get_material_index(m) for m in other.materials] + [-1], dtype = int)
+    self.material_index[selected] = remap[other.material_index[closer]]
@@ -0,0 +1,251 @@
+'''
+Profiling of the renderer, see RenderProfile.
+'''
+from __future__ import division
+from Intersectable import Sphere, Plane, Box, SceneNode, Instance, MaterialOverride
+from BVH import BVH
+from UniformGrid import UniformGrid
+from CompiledScene import CompiledScene
+import json
+import marshal
+import time
+import types
+
+# the stages of a render and the methods of Scene (or Render for 'image')
+# whose time is counted for the stage
+STAGES = [('camera_rays', ['create_ray', 'create_rays', 'create_sample_rays']),
+          ('intersection', ['get_nearest_object_intersection', 'get_nearest_object_intersections']),
+          ('shadow_rays', ['get_visible_lights', 'get_visible_lights_many']),
+          ('shading', ['blinn_phong_shading_per_light', 'blinn_phong_shading_per_light_many']),
+          ('image', ['setPixel', 'setTile', 'save']),
+          ('tiles', ['render_tile', 'render_pixel_rays', 'render_pixel_samples'])]
+
+# the classes whose intersection tests are counted and their test methods
+INTERSECTABLE_CLASSES = [Sphere, Plane, Box, SceneNode, Instance, MaterialOverride, BVH, UniformGrid, CompiledScene]
+TEST_METHODS = ['intersect', 'intersect_many', 'occluded', 'occluded_many', 'get_occluder', 'get_occluders_many']
+
+class RenderProfile(object):
+  """
+
+  RenderProfile class
+
+  Instrumentation of a render (<render profile="json"> or "pstats", see
+  Scene.renderScene). While a render is profiled, i.e. between instrument and
+  restore, the methods of the stages (see STAGES) and the intersection tests
+  of the intersectable classes are replaced by wrappers that count the rays
+  and the tests and measure the time of the calls. Nothing is replaced when
+  profiling is disabled so it doesn't cost anything. The counters of the
+  worker processes are collected in the same way as the ones of ShadowCache.
+
+  The rays are counted by type: 'camera' for the rays of create_ray(s) and
+  'shadow' for each light tested by get_visible_lights(_many), including the
+  ones answered by the ShadowCache. The tests are counted per ray and per
+  class of the tested object (a packet of N rays is N tests). The objects
+  compiled into a CompiledScene are counted as tests of the CompiledScene.
+
+  Only the calls on the profiled scene, its Render and the objects reachable
+  from the scene are counted, the wrappers pass the other calls (e.g. of
+  another scene rendered at the same time) on to the replaced methods.
+
+  """
+  def __init__(self):
+    self.reset_counts()
+    self.reset_stack()
+    self.originals = dict() # (class, method name) -> method replaced by this profile, see instrument
+    self.objects = set()    # ids of the profiled objects, see get_object_ids
+
+  def reset_counts(self):
+    self.rays = {'camera': 0, 'shadow': 0}
+    self.tests = dict()    # class name -> number of rays tested
+    self.stages = dict((stage, 0.) for stage, methods in STAGES) # seconds
+    self.tiles = []        # {'method', 'tile', 'seconds'} of each rendered tile
+    self.functions = dict() # (file, line, name) -> [calls, seconds, cumulative seconds, {caller: calls}]
+
+  def reset_stack(self):
+    self.stack = []        # [key, seconds of the children] of the calls in progress
+    self.active = dict()   # key or stage or id of a tested object -> number of calls in progress
+
+  def __getstate__(self):
+    # the methods and the ids only make sense in this process
+    state = dict(self.__dict__)
+    del state['stack'], state['active'], state['originals'], state['objects']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.reset_stack()
+    self.originals = dict()
+    self.objects = set()
+
+  def instrument(self, scene, stages = True):
+    '''
+    Replaces the profiled methods of the classes of the scene (and of its
+    Render) and of the intersectable classes by wrappers counting into this
+    profile. If stages is False only the intersection tests are counted.
+    Methods replaced by another profile are wrapped again, the calls are
+    then passed on to the wrappers of the other profile. Does nothing if
+    the profile is already instrumented, e.g. in a worker process forked
+    from the main process.
+    '''
+    if len(self.originals) > 0:
+      return
+    self.objects = get_object_ids(scene)
+    hooks = [(cls, TEST_METHODS, None) for cls in INTERSECTABLE_CLASSES]
+    if stages:
+      hooks += [(scene.render.__class__ if stage == 'image' else scene.__class__, methods, stage)
+                for stage, methods in STAGES]
+    for cls, methods, stage in hooks:
+      for name in methods:
+        if name in cls.__dict__:
+          self.originals[(cls, name)] = cls.__dict__[name]
+          setattr(cls, name, self.wrap(cls, name, stage))
+
+  def restore(self):
+    '''
+    Puts back the methods replaced by this profile. A method that was
+    wrapped again by another profile since then is put back when that
+    profile is restored, until then the wrapper of this profile passes the
+    calls on without counting them.
+    '''
+    for (cls, name), method in self.originals.items():
+      if getattr(cls.__dict__[name], 'profile', None) is self:
+        # skip the wrappers of the profiles restored in the meantime
+        while getattr(method, 'profile', None) is not None and len(method.profile.originals) == 0:
+          method = method.original
+        setattr(cls, name, method)
+    self.originals.clear()
+    self.objects = set()
+
+  def wrap(self, cls, name, stage):
+    method = self.originals[(cls, name)]
+    function = method
+    while hasattr(function, 'original'): # wrapper of another profile
+      function = function.original
+    code = function.__code__
+    key = (code.co_filename, code.co_firstlineno, cls.__name__ + '.' + name)
+    profile = self
+    def profiled(*args, **kwargs):
+      if id(args[0]) not in profile.objects:
+        return method(*args, **kwargs)
+      return profile.call(method, key, stage, args, kwargs)
+    profiled.__name__ = name
+    profiled.__doc__ = function.__doc__
+    profiled.profile = self
+    profiled.original = method
+    return profiled
+
+  def call(self, method, key, stage, args, kwargs):
+    ''' calls the original method and records the call '''
+    name = key[2].split('.')[-1]
+    obj = id(args[0])
+    counted = stage is None and obj not in self.active # tests done by another test of the object aren't counted
+    for active in [key, stage, obj]:
+      self.active[active] = self.active.get(active, 0) + 1
+    self.stack.append([key, 0.])
+    start = time.time()
+    try:
+      result = method(*args, **kwargs)
+    finally:
+      seconds = time.time() - start
+      children = self.stack.pop()[1]
+      caller = self.stack[-1][0] if len(self.stack) > 0 else None
+      if caller is not None:
+        self.stack[-1][1] += seconds
+      for active in [key, stage, obj]:
+        self.active[active] -= 1
+        if self.active[active] == 0:
+          del self.active[active]
+
+      function = self.functions.setdefault(key, [0, 0., 0., dict()])
+      function[0] += 1
+      function[1] += seconds - children
+      if key not in self.active: # recursive calls are only counted once
+        function[2] += seconds
+      if caller is not None:
+        function[3][caller] = function[3].get(caller, 0) + 1
+      if stage is not None and stage not in self.active:
+        self.stages[stage] += seconds
+        if stage == 'tiles':
+          tile = args[1] if len(args[1]) == 4 else args[1][0]
+          self.tiles.append({'method': name, 'tile': list(tile), 'seconds': seconds})
+
+    if counted:
+      class_name = args[0].__class__.__name__
+      self.tests[class_name] = self.tests.get(class_name, 0) + (len(args[1]) if name.endswith('many') else 1)
+    elif name == 'create_ray':
+      self.rays['camera'] += 1
+    elif name == 'create_rays':
+      self.rays['camera'] += result[1].size // 3
+    elif name == 'get_visible_lights':
+      self.rays['shadow'] += len(args[0].lights)
+    elif name == 'get_visible_lights_many':
+      self.rays['shadow'] += len(args[0].lights) * len(args[1])
+    return result
+
+  def get_test_count(self):
+    ''' the total number of intersection tests '''
+    return sum(self.tests.values())
+
+  def take_counts(self):
+    ''' returns the counters and resets them, used for collecting the counts of the workers '''
+    counts = (self.rays, self.tests, self.stages, self.tiles, self.functions)
+    self.reset_counts()
+    return counts
+
+  def add_counts(self, counts):
+    rays, tests, stages, tiles, functions = counts
+    for totals, values in [(self.rays, rays), (self.tests, tests), (self.stages, stages)]:
+      for name, value in values.items():
+        totals[name] = totals.get(name, 0) + value
+    self.tiles.extend(tiles)
+    for key, (calls, seconds, cumulative, callers) in functions.items():
+      function = self.functions.setdefault(key, [0, 0., 0., dict()])
+      function[0] += calls
+      function[1] += seconds
+      function[2] += cumulative
+      for caller, caller_calls in callers.items():
+        function[3][caller] = function[3].get(caller, 0) + caller_calls
+
+  def get_stats(self):
+    ''' the profile as a dict that can be saved as JSON '''
+    functions = [{'name': name, 'file': filename, 'line': line, 'calls': calls, 'seconds': seconds,
+                  'cumulative_seconds': cumulative}
+                 for (filename, line, name), (calls, seconds, cumulative, callers) in self.functions.items()]
+    functions.sort(key = lambda function: -function['seconds'])
+    return {'rays': self.rays, 'intersection_tests': self.tests, 'stages': self.stages,
+            'tiles': self.tiles, 'functions': functions}
+
+  def dump_json(self, filename):
+    with open(filename, 'w') as f:
+      json.dump(self.get_stats(), f, indent = 2, sort_keys = True)
+
+  def dump_stats(self, filename):
+    '''
+    Saves the calls of the profiled methods in the format of cProfile, it
+    can be loaded with pstats.Stats(filename).
+    '''
+    stats = dict((key, (calls, calls, seconds, cumulative, callers))
+                 for key, (calls, seconds, cumulative, callers) in self.functions.items())
+    with open(filename, 'wb') as f:
+      marshal.dump(stats, f)
+
+def get_object_ids(scene):
+  '''
+  Returns the set of the ids of the scene, its Render and all the objects
+  reachable from the scene through the attributes of the objects and the
+  lists, tuples and dicts they contain (e.g. the surfaces, the children of
+  the nodes and the objects of the accelerators).
+  '''
+  NOT_WALKED = (type, types.ClassType, types.ModuleType, types.FunctionType, types.MethodType, RenderProfile)
+  ids = set()
+  stack = [scene]
+  while len(stack) > 0:
+    value = stack.pop()
+    if isinstance(value, (list, tuple)):
+      stack.extend(value)
+    elif isinstance(value, dict):
+      stack.extend(value.values())
+    elif hasattr(value, '__dict__') and not isinstance(value, NOT_WALKED) and id(value) not in ids:
+      ids.add(id(value))
+      stack.extend(value.__dict__.values())
+  return ids
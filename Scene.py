@@ -11,14 +11,115 @@ the ./scenes/ folder you should use A3App.py (see the comments in that file).
 '''
 
 from __future__ import division
-from Ray import Ray, IntersectionResult
+from Ray import Ray, IntersectionResult, IntersectionPacket
 from HelperClasses import Camera, Render, Light, Material
+from Intersectable import SceneNode
+from BVH import BVH
+from CompiledScene import CompiledScene
+from UniformGrid import UniformGrid
+from RenderProfile import RenderProfile
 import GeomTransform as GT
 
+import os
 import math
+import multiprocessing
+import time
 import numpy as np
 
 
+# Scene rendered by a worker process of the tile renderer (see Scene.map_tiles).
+# It is set once when the worker process starts instead of being sent with
+# every tile.
+worker_scene = None
+
+def init_render_worker(scene):
+  global worker_scene
+  worker_scene = scene
+  scene.take_worker_stats() # the counts copied from the main process are already there
+  if scene.profile is not None:
+    scene.profile.instrument(scene, scene.render.profile != 'none')
+
+def render_worker_task(args):
+  method_name, tile = args
+  result = getattr(worker_scene, method_name)(tile)
+  return tile, result, worker_scene.take_worker_stats()
+
+
+class ShadowCache:
+  """
+
+  ShadowCache class
+
+  Remembers for each light the object that last occluded a shadow ray towards
+  it. Shadow rays of neighbouring pixels are usually blocked by the same 
+  object, so testing that object first often avoids traversing the scene.
+  Each process has its own cache since each worker has its own copy of the
+  scene. For packets of rays the few objects that occluded most rays of the
+  previous packet are tested first.
+
+  """
+  # number of occluders remembered per light for packets of rays
+  PACKET_OCCLUDERS = 4
+
+  def __init__(self):
+    self.occluders = dict() # light -> list of last occluders
+    self.lookups = 0 # number of shadow rays that used the cache
+    self.hits = 0    # number of shadow rays found occluded by a cached occluder
+
+  def occluded(self, scene, light, ray, t_max):
+    ''' Same as scene.occluded for a shadow ray towards light '''
+    self.lookups += 1
+    for occluder in self.occluders.get(light, []):
+      if occluder.occluded(ray, t_max):
+        self.hits += 1
+        return True
+    occluder = scene.get_occluder(ray.eyePoint, ray.viewDirection, t_max)
+    if occluder is not None:
+      self.occluders[light] = [occluder]
+    return occluder is not None
+
+  def occluded_many(self, scene, light, origins, directions, t_max):
+    ''' Same as scene.occluded_many for a packet of shadow rays towards light '''
+    occluded = np.zeros(len(origins), dtype = bool)
+    active = np.arange(len(origins))
+    for occluder in self.occluders.get(light, []):
+      if len(active) == 0:
+        break
+      hit = occluder.occluded_many(origins[active], directions[active], t_max[active])
+      occluded[active[hit]] = True
+      active = active[~hit]
+    self.lookups += len(origins)
+    self.hits += len(origins) - len(active)
+    if len(active) == 0:
+      return occluded
+
+    occluded[active], occluders = scene.get_occluders_many(origins[active], directions[active], t_max[active])
+    # remember the objects that occluded the most rays
+    counts = dict()
+    for occluder in occluders[occluded[active]]:
+      counts[occluder] = counts.get(occluder, 0) + 1
+    if len(counts) > 0:
+      ranked = sorted(counts.keys(), key = lambda occluder: -counts[occluder])
+      self.occluders[light] = ranked[:self.PACKET_OCCLUDERS]
+    return occluded
+
+  def hit_rate(self):
+    return self.hits / self.lookups if self.lookups > 0 else 0.
+
+  def stats(self):
+    return {'lookups': self.lookups, 'hits': self.hits, 'hit_rate': self.hit_rate()}
+
+  def take_counts(self):
+    ''' returns the counters and resets them, used for collecting the counts of the workers '''
+    counts = (self.lookups, self.hits)
+    self.lookups = self.hits = 0
+    return counts
+
+  def add_counts(self, counts):
+    self.lookups += counts[0]
+    self.hits += counts[1]
+
+
 class Scene:
   """
     
@@ -29,17 +130,103 @@ class Scene:
   properly initialized.
   
   """
+  # acceleration structures, see build_accelerator
+  ACCELERATORS = ('bvh', 'grid', 'compiled', 'none')
+  # rendering modes, see renderScene
+  MODES = ('scalar', 'vectorized', 'adaptive', 'progressive')
     
   def __init__(self, render = Render()):
     self.render = render # The camera will be set by the parser.
     self.lights = [] #empty lists of lights, needs to be populated by the parser.
     self.surfaces = [] #empty list of surfaces, needs to be populated by the parser.
+    self.accelerator = None # BVH or CompiledScene over the surfaces, see build_accelerator
+    self.other_surfaces = [] # surfaces that are not in the accelerator
+    self.flattened_surfaces = None # surfaces with the scene nodes flattened if Render.flatten is set
+    self.shadow_cache = None # ShadowCache used by the shadow rays if Render.shadowCache is set
+    self.render_stats = None # samples, seconds and samples_per_second of the last renderScene
+    self.profile = None # RenderProfile of the last renderScene if Render.profile or Render.heatmap is set
+    self.pixel_costs = None # costs of the pixels of the last renderScene if Render.heatmap is set, see add_pixel_cost
     self.ambient = np.array([0.1, 0.1, 0.1]) # scene ambient value can be overridden by the xml file spec
   
   def set_params(self, params):
       self.ambient = np.array(params.get('ambient', self.ambient))
       # force scene ambient to have 3 values (some xmls have 4)
       self.ambient = self.ambient[:3]
+
+  def build_accelerator(self, kind = None):
+      '''
+      Builds the acceleration structure given by kind (Render.accelerator by
+      default):
+        'bvh'      - a bounding volume hierarchy (BVH) over the surfaces that
+                     have bounds. Surfaces without bounds (planes) are kept in
+                     a separate list that is always tested.
+        'grid'     - same as 'bvh' with a UniformGrid instead of the BVH
+                     (see UniformGrid.py).
+        'compiled' - a CompiledScene holding the spheres, boxes and planes in
+                     arrays (see CompiledScene.py). Scene nodes are stored
+                     in a separate BVH.
+        'none'     - all the surfaces are tested one by one.
+      The children of the scene nodes always get a BVH (unless kind is 'none'),
+      which is shared by the nodes with the same children (see SceneNode.build_accelerator).
+      Together with the BVH over the scene nodes' bounds this gives a two-level
+      structure for scenes with many transformed copies of the same node.
+      If Render.flatten is set the scene nodes are first replaced by their
+      instances (see flatten_surfaces) and the structure is built over those.
+      This is called by the SceneParser once the scene is parsed and needs to
+      be called again if the surfaces change.
+      '''
+      if kind is None:
+          kind = self.render.accelerator
+      if kind not in self.ACCELERATORS:
+          raise ValueError('Unknown accelerator ' + kind)
+      self.accelerator = None
+      self.other_surfaces = []
+      self.flattened_surfaces = self.flatten_surfaces() if self.render.flatten else None
+      if kind == 'none':
+          return
+      surfaces = self.get_surfaces()
+      shared = dict() # the scene nodes with the same children share their BVH
+      for surface in surfaces:
+          if isinstance(surface, SceneNode):
+              surface.build_accelerator(shared)
+      if kind == 'compiled':
+          self.accelerator = CompiledScene(surfaces)
+          # the scene nodes get their own BVH over their bounds
+          nodes = self.accelerator.others
+          if len(nodes) > 1 and all(node.bounds() is not None for node in nodes):
+              nodes = [BVH(nodes)]
+          self.other_surfaces = nodes
+          return
+      bounded = [surface for surface in surfaces if surface.bounds() is not None]
+      if len(bounded) > 1:
+          self.accelerator = UniformGrid(bounded) if kind == 'grid' else BVH(bounded)
+          self.other_surfaces = [surface for surface in surfaces if surface.bounds() is None]
+
+  def flatten_surfaces(self):
+      '''
+      The surfaces with each scene node replaced by one Instance per primitive
+      below it (see SceneNode.flatten), so that a ray is transformed once per
+      primitive instead of once per level of the scene node hierarchy.
+      '''
+      surfaces = []
+      for surface in self.surfaces:
+          if isinstance(surface, SceneNode):
+              surfaces.extend(surface.flatten())
+          else:
+              surfaces.append(surface)
+      return surfaces
+
+  def get_surfaces(self):
+      ''' The surfaces, flattened by build_accelerator if Render.flatten is set '''
+      if self.flattened_surfaces is None:
+          return self.surfaces
+      return self.flattened_surfaces
+
+  def get_intersectable_surfaces(self):
+      ''' The objects that need to be intersected for finding the nearest intersection '''
+      if self.accelerator is None:
+          return self.get_surfaces()
+      return [self.accelerator] + self.other_surfaces
       
 #----- Implement create_ray
   def create_ray(self,row,col):
@@ -63,32 +250,107 @@ class Scene:
 
       #TODO ====== BEGIN SOLUTION ======
 
+      # the directions through the pixels are precomputed by the camera
+      if row == int(row) and col == int(col) and \
+         0 <= row < cam.imageHeight and 0 <= col < cam.imageWidth:
+          ray.viewDirection = cam.get_ray_directions(int(row), int(col))
+          return ray
+      cam.update()
+
       # get the camera coordinates
       cam_x = col*(cam.right-cam.left)/cam.imageWidth + cam.left
       cam_y = row*-(cam.top-cam.bottom)/cam.imageHeight + cam.top
       cam_z = cam.near
 
-      xa = cam.cameraXAxis
-      ya = cam.cameraYAxis
-      za = cam.cameraZAxis
-      R = [ [xa[0], ya[0], za[0], 0],
-            [xa[1], ya[1], za[1], 0],
-            [xa[2], ya[2], za[2], 0],
-            [0, 0, 0, 1] ]
-      T = [ [1, 0, 0, -cam.pointFrom[0]], 
-            [0, 1, 0, -cam.pointFrom[1]],
-            [0, 0, 1, -cam.pointFrom[2]],
-            [0, 0, 0, 1] ]
-
-      cam_to_world = np.linalg.inv(np.dot(np.transpose(R),T))
-
-      world_pixels = np.dot( cam_to_world, [cam_x, cam_y, cam_z, 1] )
+      # the camera-to-world matrix is computed once by the Camera
+      world_pixels = np.dot( cam.cameraToWorld, [cam_x, cam_y, cam_z, 1] )
       #world_pixels = world_pixels/world_pixels[3]
       ray.viewDirection = GT.normalize(world_pixels[0:3] - ray.eyePoint)
 
       # ===== END SOLUTION =====
       return ray    
 
+  def create_rays(self, rows = None, cols = None, lens = None):
+      '''
+      Vectorized version of create_ray. rows and cols are arrays (of the same
+      shape) containing the image coordinates of the pixels. If they are not
+      given then the rays for the whole image are created, see
+      Render.getPixelGrid for getting the coordinates of a tile.
+      Returns the ray origins and the ray directions as two numpy arrays of
+      shape rows.shape + (3,), e.g. (imageHeight, imageWidth, 3) for the whole
+      image. Each ray is the same as the one returned by create_ray(row, col).
+      If the eyepoints lens = (x, y) are given the rays start on the lens
+      instead, see focus_rays.
+      '''
+      cam = self.render.camera
+      cam.update()
+      if rows is None or cols is None:
+          rows, cols = self.render.getPixelGrid()
+      rows, cols = np.broadcast_arrays(np.asarray(rows), np.asarray(cols))
+
+      origins = np.empty(rows.shape + (3,))
+      origins[...] = cam.pointFrom
+      # the rays through pixels are looked up in the camera's directions
+      if rows.dtype.kind in 'iu' and cols.dtype.kind in 'iu' and \
+         np.all((rows >= 0) & (rows < cam.imageHeight) & (cols >= 0) & (cols < cam.imageWidth)):
+          if lens is not None:
+              return self.focus_rays(cam.get_ray_directions(rows, cols), *lens)
+          return origins, cam.get_ray_directions(rows, cols)
+
+      rows, cols = np.broadcast_arrays(np.asarray(rows, dtype = float),
+                                       np.asarray(cols, dtype = float))
+
+      # camera coordinates of all the pixels
+      cam_x = cols*(cam.right-cam.left)/cam.imageWidth + cam.left
+      cam_y = rows*-(cam.top-cam.bottom)/cam.imageHeight + cam.top
+      cam_z = cam.near
+
+      # world coordinates, i.e. cameraToWorld * [cam_x, cam_y, cam_z, 1]
+      C = cam.cameraToWorld
+      world_pixels = cam_x[..., np.newaxis] * C[:3,0] + \
+                     cam_y[..., np.newaxis] * C[:3,1] + (cam_z * C[:3,2] + C[:3,3])
+
+      directions = GT.normalize_many(world_pixels - cam.pointFrom)
+      if lens is not None:
+          return self.focus_rays(directions, *lens)
+      return origins, directions
+
+  def focus_rays(self, directions, lens_x, lens_y):
+      '''
+      Thin lens depth of field: returns the origins and directions of the rays
+      starting at the eyepoints (lens_x, lens_y) of the lens (see 
+      Render.getLensOffsets) that go through the point where the ray with the
+      given direction from the camera's eye meets the focal plane. The focal
+      plane is perpendicular to the lookat direction and contains pointTo. 
+      The arrays are broadcast, e.g. directions of shape (N, 1, 3) and
+      eyepoints of shape (N, eyepoints) give rays of shape (N, eyepoints, 3).
+      '''
+      cam = self.render.camera
+      focal_distance = np.linalg.norm(cam.pointTo - cam.pointFrom)
+      focus = directions * (focal_distance / np.dot(directions, cam.lookat))[..., np.newaxis]
+      offsets = lens_x[..., np.newaxis] * cam.cameraXAxis + lens_y[..., np.newaxis] * cam.cameraYAxis
+      return cam.pointFrom + offsets, GT.normalize_many(focus - offsets)
+
+  def create_sample_rays(self, rows, cols, random = np.random):
+      '''
+      Creates the rays of all the samples of the pixels given by the integer 
+      arrays rows and cols: the samples in the pixel (see 
+      Render.getSampleOffsets) times the eyepoints on the lens for depth of
+      field (see Render.getLensOffsets). The jittered positions are drawn 
+      from random. Returns the origins and directions as two arrays of shape
+      rows.shape + (Render.getSamplesPerPixel(), 3).
+      '''
+      row_offsets, col_offsets = self.render.getSampleOffsets(rows.shape, random)
+      sample_rows = rows[..., np.newaxis] + row_offsets
+      sample_cols = cols[..., np.newaxis] + col_offsets
+      if not self.render.isDepthOfField():
+          return self.create_rays(sample_rows, sample_cols)
+      # all the eyepoints of all the samples at once
+      lens = self.render.getLensOffsets(sample_rows.shape, random)
+      origins, directions = self.create_rays(sample_rows[..., np.newaxis], sample_cols[..., np.newaxis], lens)
+      shape = rows.shape + (self.render.getSamplesPerPixel(), 3)
+      return origins.reshape(shape), directions.reshape(shape)
+
 #----- Implement blinn_phong_shading      
   def blinn_phong_shading_per_light(self,viewer_direction,light,isect):
       '''
@@ -121,6 +383,23 @@ class Scene:
       # ===== END SOLUTION HERE =====
       return color
 
+  def blinn_phong_shading_per_light_many(self, viewer_directions, light, p, n, diffuse, specular, hardness):
+      '''
+      Vectorized version of blinn_phong_shading_per_light for N intersection
+      points. viewer_directions, p (intersection points), n (normalized
+      normals), diffuse and specular are arrays of shape (N, 3) and hardness
+      has shape (N,). Returns the colors as an array of shape (N, 3).
+      '''
+      l = GT.normalize_many(light.pointFrom - p)
+      H = GT.normalize_many(l + viewer_directions)
+      light_color = light.color*light.power
+
+      n_dot_l = np.maximum(np.sum(n * l, axis = 1), 0)
+      I_diffuse = light_color * diffuse * n_dot_l[:, np.newaxis]
+      H_dot_n = np.sum(H * n, axis = 1)
+      I_specular = light_color * specular * np.power(H_dot_n, hardness)[:, np.newaxis]
+      return I_diffuse + I_specular
+
 #----- Implement get_nearest_object_intersection
   def get_nearest_object_intersection(self,ray):
       ''' 
@@ -142,7 +421,7 @@ class Scene:
       # loop through intersectable objects in the scene
       # do the ray, get the t
       # if t is smaller, nearest_intersection is that one
-      for surface in self.surfaces:
+      for surface in self.get_intersectable_surfaces():
         r = surface.intersect(ray)
         # print r.t
         if r.t < nearest_intersection.t:
@@ -155,6 +434,17 @@ class Scene:
       #If there was no intersection then it should have the same initial values.
       return nearest_intersection 
 
+  def get_nearest_object_intersections(self, origins, directions):
+      '''
+      Packet version of get_nearest_object_intersection. origins and directions
+      are arrays of shape (N, 3). Returns an IntersectionPacket (see Ray.py)
+      containing the nearest intersection of each ray.
+      '''
+      isects = IntersectionPacket(len(origins))
+      for surface in self.get_intersectable_surfaces():
+        isects.update(surface.intersect_many(origins, directions))
+      return isects
+
 #----- Implement get_visible_lights  
   def get_visible_lights(self, isect):
       ''' 
@@ -176,7 +466,6 @@ class Scene:
       # and then check that get_nearest_object_intersection with that ray is the light
       for light in self.lights:
         ray = Ray(isect.p, GT.normalize(light.pointFrom - isect.p))
-        nearest_isect = self.get_nearest_object_intersection(ray)
         # find time of intersection with the light
         # note that p_intersect = ray_start + t*ray_dir
         # so t = (p_intersect - ray_start)/ray_dir
@@ -186,14 +475,85 @@ class Scene:
           light_t = (light.pointFrom[1] - isect.p[1])/ray.viewDirection[1]
         else:
           light_t = (light.pointFrom[2] - isect.p[2])/ray.viewDirection[2]  
-        # consider the light if it is closer than the first object you hit
-        if light_t <= nearest_isect.t:
+        # consider the light if no object is hit before reaching it. Only
+        # whether there is such an object matters, not which one is nearest
+        if self.shadow_cache is not None:
+          occluded = self.shadow_cache.occluded(self, light, ray, light_t)
+        else:
+          occluded = self.occluded(ray.eyePoint, ray.viewDirection, light_t)
+        if not occluded:
           visibleLights.append(light)
 
       # ===== END SOLUTION HERE =====
       return visibleLights
 
-  def renderScene(self):
+  def get_visible_lights_many(self, points):
+      '''
+      Vectorized version of get_visible_lights for an array of N points of
+      shape (N, 3). Returns a boolean array of shape (len(self.lights), N)
+      telling whether each light is visible from each point.
+      '''
+      visible = np.zeros((len(self.lights), len(points)), dtype = bool)
+      for i, light in enumerate(self.lights):
+        to_light = light.pointFrom - points
+        light_t = np.sqrt(np.sum(to_light * to_light, axis = 1))
+        directions = GT.normalize_many(to_light)
+        if self.shadow_cache is not None:
+          visible[i] = ~self.shadow_cache.occluded_many(self, light, points, directions, light_t)
+        else:
+          visible[i] = ~self.occluded_many(points, directions, light_t)
+      return visible
+
+  def occluded(self, origin, direction, t_max):
+      '''
+      Any-hit query for shadow rays: True if the ray from origin along
+      direction intersects any surface at a distance t < t_max. Unlike
+      get_nearest_object_intersection it stops at the first such surface.
+      '''
+      return self.get_occluder(origin, direction, t_max) is not None
+
+  def get_occluder(self, origin, direction, t_max):
+      ''' Same as occluded but returns the occluding object (or None) '''
+      ray = Ray(origin, direction)
+      for surface in self.get_intersectable_surfaces():
+        if isinstance(surface, (BVH, UniformGrid, CompiledScene)):
+          occluder = surface.get_occluder(ray, t_max)
+          if occluder is not None:
+            return occluder
+        elif surface.occluded(ray, t_max):
+          return surface
+      return None
+
+  def occluded_many(self, origins, directions, t_max):
+      '''
+      Packet version of occluded. origins and directions have shape (N, 3)
+      and t_max has shape (N,). Returns a boolean array of shape (N,). Rays
+      that are occluded are not tested against the remaining surfaces.
+      '''
+      return self.get_occluders_many(origins, directions, t_max)[0]
+
+  def get_occluders_many(self, origins, directions, t_max):
+      '''
+      Packet version of get_occluder. Returns a boolean array telling whether
+      each ray is occluded and an object array with the occluding objects.
+      '''
+      occluded = np.zeros(len(origins), dtype = bool)
+      occluders = np.empty(len(origins), dtype = object)
+      active = np.arange(len(origins))
+      for surface in self.get_intersectable_surfaces():
+        if len(active) == 0:
+          break
+        if isinstance(surface, (BVH, UniformGrid, CompiledScene)):
+          hit, hit_occluders = surface.get_occluders_many(origins[active], directions[active], t_max[active])
+          occluders[active[hit]] = hit_occluders[hit]
+        else:
+          hit = surface.occluded_many(origins[active], directions[active], t_max[active])
+          occluders[active[hit]] = surface
+        occluded[active[hit]] = True
+        active = active[~hit]
+      return occluded, occluders
+
+  def renderScene(self, mode = None):
     """
     
     The method renderScene is called once to draw all the pixels of the scene.  For each
@@ -204,43 +564,413 @@ class Scene:
     light, the shadow and the diffuse and specular lighting contributions can be computed
     and summed up for all lights.
     
+    mode selects how the pixels are rendered (Render.mode is used by default):
+    'scalar' renders the pixels one by one (render_scalar), 'vectorized' does
+    each of the above steps for all the pixels of a tile at once (render_vectorized).
+    The tiles are rendered in parallel when Render.workers is not 1. With
+    Render.samples > 1 or Render.jitter each pixel is the average of several
+    rays (see Render.getSampleOffsets), with Render.eyepoints > 1 these
+    rays start on a lens of diameter Render.lensSize for depth of field 
+    (see create_sample_rays). 'adaptive' renders the tiles in the
+    same way but only supersamples the pixels at edges (render_adaptive).
+    'progressive' renders coarse previews first and refines them until
+    Render.timeBudget runs out (render_progressive).
+    The number of samples traced per second is printed and kept in render_stats.
+    With Render.profile set to 'json' or 'pstats' the render is profiled (see
+    RenderProfile) and the profile is saved next to the image. With 
+    Render.heatmap the cost of each pixel is recorded during the render and
+    saved too (save_cost_heatmap), this only works in the 'scalar' mode.
+    
     """
+    if mode is None:
+        mode = self.render.mode
+    if mode not in self.MODES:
+        raise ValueError('Unknown render mode ' + mode)
+    if self.render.heatmap and mode != 'scalar':
+        # the packets of rays of the other modes don't know the cost of each ray
+        raise ValueError('The cost heatmap needs the scalar mode, not ' + mode)
     
     # Initialize the renderer.
+    self.render.camera.update()
     self.render.init(self.render.camera.imageWidth, self.render.camera.imageHeight)
+    self.shadow_cache = ShadowCache() if self.render.shadowCache else None
+    # the heatmap needs the intersection tests to be counted even without profiling
+    self.profile = RenderProfile() if self.render.profile != 'none' or self.render.heatmap else None
+    self.pixel_costs = np.zeros((self.render.camera.imageHeight, self.render.camera.imageWidth, 2)) \
+                       if self.render.heatmap else None
     
+    try:
+        # restored in any case, e.g. when a worker process raises an exception
+        if self.profile is not None:
+            self.profile.instrument(self, self.render.profile != 'none')
+        # the render method replaces render_stats if it doesn't trace all the samples
+        self.render_stats = {'samples': self.render.camera.imageWidth * self.render.camera.imageHeight *
+                                        self.render.getSamplesPerPixel()}
+        start = time.time()
+        getattr(self, 'render_' + mode)()
+        seconds = max(time.time() - start, 1e-9)
+        self.render_stats['seconds'] = seconds
+        self.render_stats['samples_per_second'] = self.render_stats['samples'] / seconds
+        print('rendered %(samples)d samples in %(seconds).2fs (%(samples_per_second).0f samples/s)' % 
+              self.render_stats)
+        
+        if self.shadow_cache is not None:
+            print('shadow cache: %(hits)d hits in %(lookups)d lookups (hit rate %(hit_rate).3f)' % 
+                  self.shadow_cache.stats())
+        self.render.save()  
+    finally:
+        if self.profile is not None:
+            self.profile.restore()
+
+    if self.render.profile != 'none':
+        filename = self.render.OUTDIR_REL_PATH + self.render.output
+        if self.render.profile == 'pstats':
+            filename += '.prof'
+            self.profile.dump_stats(filename)
+        else:
+            filename += '.profile.json'
+            self.profile.dump_json(filename)
+        print('profile: %(camera)d camera rays, %(shadow)d shadow rays' % self.profile.rays + 
+              ', saved to ' + filename)
+    if self.render.heatmap:
+        self.save_cost_heatmap()
+
+  def render_scalar(self):
+    ''' 
+    Renders the image one pixel at a time. When the render is supersampled
+    the samples of the pixel (see create_sample_rays) are traced one at a
+    time and averaged.
+    '''
+    random = np.random.RandomState(0) # same jittered samples for each render
     for pixel in self.render.getPixel():
         '''
         pixel is a list containing the image coordinate of a pixel i.e. 
         pixel = [col, row] 
         '''
-       
-        # create a ray from the eye position and goes through the pixel
-        ray = self.create_ray(pixel[1], pixel[0])
-        
-        # set the default color to the background color
-        color = self.render.bgcolor
-        
-        nearest_isect = self.get_nearest_object_intersection(ray)
-
-        if nearest_isect.is_valid_intersection(): # valid intersection
-            color = self.ambient[:3] * nearest_isect.material.ambient[:3] # ambient color is used when the point is in shadow
-            # get a list of light sources that are visible from the nearest intersection point
-            visible_lights = self.get_visible_lights(nearest_isect)
-            nearest_isect.n = GT.normalize(nearest_isect.n) # ensure that the returned normals are normalized
-            if len(visible_lights) > 0: # light-shadow
-                '''
-                Compute the color based on the material found in nearest_isect.material
-                and the light sources visible from nearest_isect.p position.
-                '''
-                for light in visible_lights:
-                    color += self.blinn_phong_shading_per_light(-ray.viewDirection, light, nearest_isect)
+        start = self.get_cost()
+        color = self.trace_pixel(pixel[1], pixel[0], random)
+        self.add_pixel_cost(pixel[1], pixel[0], start)
         
         #At this point color should be a floating-point numpy array of 3 elements
         #and is the final color of the pixel.
         self.render.setPixel(pixel, color)
-        
-    self.render.save()  
+
+  def trace_pixel(self, row, col, random):
+    ''' Computes the color of the pixel (row, col) for render_scalar '''
+    if self.render.isSupersampled():
+        origins, directions = self.create_sample_rays(np.array([row]), np.array([col]), random)
+        return np.mean([self.trace(Ray(origin, direction))
+                        for origin, direction in zip(origins[0], directions[0])], axis = 0)
+    # create a ray from the eye position and goes through the pixel
+    return self.trace(self.create_ray(row, col))
+
+  def get_cost(self):
+    '''
+    Returns the number of intersection tests and the time so far when the 
+    costs of the pixels are recorded (Render.heatmap), otherwise None. See
+    add_pixel_cost.
+    '''
+    if self.pixel_costs is None:
+        return None
+    return self.profile.get_test_count(), time.time()
+
+  def add_pixel_cost(self, row, col, start):
+    '''
+    Adds the intersection tests (counted as in RenderProfile) and the time
+    since start (returned by get_cost) to the cost of the pixel (row, col) 
+    in pixel_costs, an array of shape (height, width, 2). Does nothing if
+    the costs aren't recorded. The times include the overhead of counting 
+    the tests.
+    '''
+    if start is not None:
+        tests, seconds = self.get_cost()
+        self.pixel_costs[row, col] += (tests - start[0], seconds - start[1])
+
+  def save_cost_heatmap(self):
+    '''
+    Saves the costs of the pixels (see add_pixel_cost) next to the image: 
+    the raw array as <output>_cost.npy and false colour images of the
+    intersection tests and of the time as <output>_cost_tests.png and
+    <output>_cost_time.png (see Render.saveFalseColor).
+    '''
+    costs = self.pixel_costs
+    base = self.render.OUTDIR_REL_PATH + os.path.splitext(self.render.output)[0] + '_cost'
+    np.save(base + '.npy', costs)
+    self.render.saveFalseColor(costs[..., 0], base + '_tests.png')
+    self.render.saveFalseColor(costs[..., 1], base + '_time.png')
+    print('cost heatmap: %.0f intersection tests in %.2fs, saved to %s_*' % 
+          (np.sum(costs[..., 0]), np.sum(costs[..., 1]), base))
+
+  def trace(self, ray):
+    ''' Computes the color of the ray, see render_scalar '''
+    # set the default color to the background color
+    color = self.render.bgcolor
+    
+    nearest_isect = self.get_nearest_object_intersection(ray)
+
+    if nearest_isect.is_valid_intersection(): # valid intersection
+        color = self.ambient[:3] * nearest_isect.material.ambient[:3] # ambient color is used when the point is in shadow
+        # get a list of light sources that are visible from the nearest intersection point
+        visible_lights = self.get_visible_lights(nearest_isect)
+        nearest_isect.n = GT.normalize(nearest_isect.n) # ensure that the returned normals are normalized
+        if len(visible_lights) > 0: # light-shadow
+            '''
+            Compute the color based on the material found in nearest_isect.material
+            and the light sources visible from nearest_isect.p position.
+            '''
+            for light in visible_lights:
+                color += self.blinn_phong_shading_per_light(-ray.viewDirection, light, nearest_isect)
+    return color
+
+  def render_vectorized(self):
+    ''' Renders the image one tile at a time, see render_tile '''
+    for tile, colors in self.map_tiles('render_tile', self.render.getTile()):
+        self.render.setTile(tile, colors)
+
+  def map_tiles(self, method_name, tiles):
+    '''
+    Generator that calls the method named method_name for each tile and
+    returns the pairs (tile, result) in the order they are finished. When
+    Render.workers is not 1 the tiles are processed by a pool of worker 
+    processes. The scene is sent to each worker only once when the pool
+    starts.
+    '''
+    workers = self.render.workers
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+    if workers == 1:
+        for tile in tiles:
+            yield tile, getattr(self, method_name)(tile)
+        return
+
+    pool = multiprocessing.Pool(workers, init_render_worker, (self,))
+    try:
+        for tile, result, stats in pool.imap_unordered(render_worker_task, 
+                                                       [(method_name, tile) for tile in tiles]):
+            self.add_worker_stats(stats)
+            yield tile, result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+  def take_worker_stats(self):
+    ''' 
+    Returns the statistics (e.g. counters) collected by a worker process
+    since the last call, they are added to the main process' scene by 
+    add_worker_stats.
+    '''
+    stats = dict()
+    if self.shadow_cache is not None:
+        stats['shadow_cache'] = self.shadow_cache.take_counts()
+    if self.profile is not None:
+        stats['profile'] = self.profile.take_counts()
+    return stats
+
+  def add_worker_stats(self, stats):
+    if 'shadow_cache' in stats:
+        self.shadow_cache.add_counts(stats['shadow_cache'])
+    if 'profile' in stats:
+        self.profile.add_counts(stats['profile'])
+
+  def render_tile(self, tile):
+    '''
+    Renders the pixels of the tile (left, top, right, bottom) at once and
+    returns their colors as an array of shape (height, width, 3). The
+    result is the same as rendering the pixels with render_scalar (except
+    for the jittered sample positions).
+    '''
+    rows, cols = self.render.getPixelGrid(tile)
+    if not self.render.isSupersampled():
+        return self.render_pixel_rays((tile, rows, cols))
+    return self.render_pixel_samples((tile, rows, cols))
+
+  def render_pixel_rays(self, pixels):
+    '''
+    Renders the pixels given by the tuple (tile, rows, cols), see 
+    render_pixel_samples, with one ray through each pixel.
+    '''
+    tile, rows, cols = pixels
+    origins, directions = self.create_rays(rows, cols)
+    colors = self.trace_many(origins.reshape(-1, 3), directions.reshape(-1, 3))
+    return colors.reshape(rows.shape + (3,))
+
+  def render_pixel_samples(self, pixels):
+    '''
+    Renders the supersampled pixels given by the tuple (tile, rows, cols),
+    where rows and cols are arrays of the same shape with the coordinates of
+    pixels of the tile, and returns their colors as an array of shape
+    rows.shape + (3,). All the samples (see create_sample_rays) are traced
+    at once. The jittered samples are drawn from a random generator seeded
+    with the tile so that they don't depend on the worker rendering it.
+    '''
+    tile, rows, cols = pixels
+    origins, directions = self.create_sample_rays(rows, cols, np.random.RandomState(tile))
+    colors = self.trace_many(origins.reshape(-1, 3), directions.reshape(-1, 3))
+    return np.mean(colors.reshape(origins.shape), axis = -2)
+
+  def render_adaptive(self):
+    '''
+    Adaptive anti-aliasing: renders the image with one ray per pixel (see
+    render_pixel_rays), then only the pixels with a high contrast to one of
+    their neighbours (see get_high_contrast_pixels) are rendered again with
+    Render.samples x Render.samples samples (see render_pixel_samples). Both
+    passes are done one tile at a time as in render_vectorized. The number 
+    of refined pixels is kept in render_stats.
+    '''
+    width, height = self.render.camera.imageSize
+    image = np.empty((height, width, 3))
+    batches = []
+    for tile in self.render.getTile():
+        rows, cols = self.render.getPixelGrid(tile)
+        batches.append((tile, rows, cols))
+    for (tile, rows, cols), colors in self.map_tiles('render_pixel_rays', batches):
+        image[rows, cols] = colors
+
+    refine = self.get_high_contrast_pixels(image)
+    if self.render.getSamplesPerPixel() == 1:
+        refine[...] = False
+    batches = []
+    for tile in self.render.getTile():
+        left, top, right, bottom = tile
+        rows, cols = self.render.getPixelGrid(tile)
+        selected = refine[top:bottom, left:right]
+        if np.any(selected):
+            batches.append((tile, rows[selected], cols[selected]))
+    for (tile, rows, cols), colors in self.map_tiles('render_pixel_samples', batches):
+        image[rows, cols] = colors
+    self.render.setTile((0, 0, width, height), image)
+
+    refined = int(np.sum(refine))
+    self.render_stats = {'samples': width * height + refined * self.render.getSamplesPerPixel(), 
+                         'pixels': width * height, 'refined_pixels': refined}
+    print('adaptive: refined %d of %d pixels' % (refined, width * height))
+
+  def render_progressive(self, strides = (8, 4, 2, 1)):
+    '''
+    Progressive rendering for previews: the first pass renders every 8th 
+    pixel of every 8th row and each pixel is shown as an 8x8 block, the next
+    passes only render the pixels that are new on the grids of every 4th, 
+    2nd and finally of every pixel. If the render is supersampled a last 
+    pass renders all the tiles again with their supersampled colors (see
+    render_tile). The framebuffer of Render is updated after each finished
+    pass. The passes are rendered as in render_adaptive and they are 
+    stopped when Render.timeBudget seconds have passed, except for the first
+    one, the image is the one of the last finished pass. The finished passes
+    are kept in render_stats.
+    '''
+    start = time.time()
+    budget = self.render.timeBudget
+    width, height = self.render.camera.imageSize
+    image = np.empty((height, width, 3))
+    rendered = np.zeros((height, width), dtype = bool)
+    samples = 0
+    passes = []
+
+    def out_of_time():
+        return len(passes) > 0 and budget > 0. and time.time() - start > budget
+
+    for stride in strides:
+        # the pixels on the grid of the pass that weren't rendered before
+        selected = np.zeros((height, width), dtype = bool)
+        selected[::stride, ::stride] = True
+        selected &= ~rendered
+        # about as many pixels per batch as in a tile of the full resolution
+        batches = []
+        for tile in self.render.getTile(self.render.tileSize * stride):
+            left, top, right, bottom = tile
+            rows, cols = self.render.getPixelGrid(tile)
+            in_tile = selected[top:bottom, left:right]
+            if np.any(in_tile):
+                batches.append((tile, rows[in_tile], cols[in_tile]))
+        results = self.map_tiles('render_pixel_rays', batches)
+        try:
+            for (tile, rows, cols), colors in results:
+                if out_of_time():
+                    break
+                image[rows, cols] = colors
+                rendered[rows, cols] = True
+                samples += len(rows)
+        finally:
+            results.close()
+        if not np.all(rendered[::stride, ::stride]):
+            break
+        # each pixel gets the color of the rendered pixel at the top left of its block
+        preview = np.repeat(np.repeat(image[::stride, ::stride], stride, axis = 0), stride, axis = 1)
+        self.render.setTile((0, 0, width, height), preview[:height, :width])
+        passes.append('stride %d' % stride)
+
+    if len(passes) == len(strides) and self.render.isSupersampled():
+        results = self.map_tiles('render_tile', self.render.getTile())
+        try:
+            for tile, colors in results:
+                if out_of_time():
+                    break
+                left, top, right, bottom = tile
+                image[top:bottom, left:right] = colors
+                samples += colors.shape[0] * colors.shape[1] * self.render.getSamplesPerPixel()
+            else:
+                # only shown once all the tiles are supersampled
+                self.render.setTile((0, 0, width, height), image)
+                passes.append('supersampled')
+        finally:
+            results.close()
+
+    self.render_stats = {'samples': samples, 'passes': passes}
+    print('progressive: finished passes ' + ', '.join(passes))
+
+  def get_high_contrast_pixels(self, image):
+    '''
+    Returns the boolean array (height, width) of the pixels of the image (an
+    array of colors of shape (height, width, 3)) whose color differs from
+    the color of one of their 4 neighbours by more than Render.adaptiveThreshold
+    in one of the channels. The colors are clipped to [0, 1] as in the saved image.
+    '''
+    image = np.clip(image, 0., 1.)
+    contrast = np.zeros(image.shape[:2])
+    vertical = np.max(np.abs(image[1:] - image[:-1]), axis = 2)
+    horizontal = np.max(np.abs(image[:, 1:] - image[:, :-1]), axis = 2)
+    for difference, before, after in [(vertical, np.s_[:-1], np.s_[1:]),
+                                      (horizontal, np.s_[:, :-1], np.s_[:, 1:])]:
+        contrast[before] = np.maximum(contrast[before], difference)
+        contrast[after] = np.maximum(contrast[after], difference)
+    return contrast > self.render.adaptiveThreshold
+
+  def trace_many(self, origins, directions):
+    '''
+    Computes the colors of N rays given by the arrays origins and directions
+    of shape (N, 3). This does the same as the body of the render_scalar loop
+    but each step is done for all the rays at once.
+    '''
+    colors = np.empty((len(origins), 3))
+    colors[:] = self.render.bgcolor
+
+    isects = self.get_nearest_object_intersections(origins, directions)
+    hit = np.nonzero(isects.is_valid_intersection())[0]
+    if len(hit) == 0:
+        return colors
+
+    # material properties of each intersection point
+    material_index = isects.material_index[hit]
+    materials = isects.materials
+    ambient = np.array([m.ambient[:3] for m in materials])[material_index]
+    diffuse = np.array([m.diffuse[:3] for m in materials])[material_index]
+    specular = np.array([m.specular[:3] for m in materials])[material_index]
+    hardness = np.array([m.hardness for m in materials])[material_index]
+
+    p = isects.p[hit]
+    n = GT.normalize_many(isects.n[hit])
+    viewer_directions = -directions[hit]
+
+    color = self.ambient[:3] * ambient # ambient color is used when the point is in shadow
+    visible = self.get_visible_lights_many(p)
+    for light, light_visible in zip(self.lights, visible):
+        lit = np.nonzero(light_visible)[0]
+        color[lit] += self.blinn_phong_shading_per_light_many(viewer_directions[lit], light, 
+                                                               p[lit], n[lit], diffuse[lit], 
+                                                               specular[lit], hardness[lit])
+    colors[hit] = color
+    return colors
 
 #############################################################################
 '''
@@ -4,13 +4,12 @@ Created on Fri Feb 20 20:48:59 2015
 
 @author: Fahim
 """
-from Intersectable import Sphere, Plane, Box, SceneNode
+from Intersectable import Sphere, Plane, Box, SceneNode, MaterialOverride
 from HelperClasses import Material, Light, Camera, Render
 from Scene import Scene
 import GeomTransform as GT
 import numpy as np
 from xml.dom import minidom
-import copy
 
 '''
 Scene file requirements:
@@ -28,6 +27,9 @@ Scene file requirements:
 + A node (SceneNode) can refer to another node by name using "ref=" E.g. 
 <node name="base">...</node>
 <node name="ref_example" ref="base"></node>
+The ref node shares the children of the referred node instead of copying
+them, a <material> or <material2> inside the ref node only overrides the
+material of the last child for this node (see MaterialOverride).
 + SceneParser process each XML element and generates a dictionary containing
 all the parameters of a relevant class. The class's __init__ method takes
 the dictionary and does all the necessary processing. 
@@ -74,6 +76,7 @@ class SceneParser:
         self.Materials = dict() # used for storing ref to materials
         self.Nodes = dict()     # used for storing ref to nodes
         self.NodeStack = []
+        self.SharedNodes = set() # ids of the ref nodes that share the children list of another node
         self.scene = Scene()
         xml = minidom.parse(filename)
         self.parse(xml)
@@ -145,6 +148,7 @@ class SceneParser:
         for e in node.childNodes:
             self.parse(e)
         #self.scene.surfaces.append(self.NodeStack.pop())
+        self.scene.build_accelerator()
         
     def process_light(self, node):
         ''' <light name="myLight" color="1 1 1" from="0 0 0 " power="1.0" type="point" /> '''
@@ -192,14 +196,17 @@ class SceneParser:
                 transformation of the ref node? The orig transformation gets
                 overridden'''
                 print('Found ref node : ' + params['ref'])
-                self.NodeStack[-1].children = copy.deepcopy(self.Nodes[params['ref']].children)
+                refNode = self.NodeStack[-1]
+                refNode.children = self.Nodes[params['ref']].children
+                self.SharedNodes.add(id(refNode))
                 for e in node.childNodes: # what sort of things can be in the childnode of ref nodes?
                     val = self.parse(e)
-                    if val is not None: #Handle plane i.e. material2
+                    if val is not None and len(refNode.children) > 0: #Handle plane i.e. material2
                         if e.tagName == 'material':
-                            self.NodeStack[-1].children[-1].material = val
+                            self.override_last_child(refNode, material = val)
                         elif e.tagName == 'material2':
-                            self.NodeStack[-1].children[-1].material2 = val
+                            self.override_last_child(refNode, material2 = val)
+                self.SharedNodes.discard(id(refNode))
         else: # for non ref nodes do the usual processing
             for e in node.childNodes:
                 self.parse(e)
@@ -207,20 +214,44 @@ class SceneParser:
         topNode = self.NodeStack.pop()
         if len(self.NodeStack) == 0:
             print('adding node to scene')
-            self.scene.surfaces.append(topNode)
-        else:
-            # add to the current node
-            self.NodeStack[-1].children.append(topNode)
+        self.add_surface(topNode)
         # add to node table for future reference
         nodeName = params.get('name')
         if nodeName is not None:
             self.Nodes[nodeName] = topNode
         print('end process_node')
      
+    def get_own_children(self, sceneNode):
+        '''
+        The children list of the scene node, copied first if the node still
+        shares it with the node it refers to (copy-on-write).
+        '''
+        if id(sceneNode) in self.SharedNodes:
+            sceneNode.children = list(sceneNode.children)
+            self.SharedNodes.discard(id(sceneNode))
+        return sceneNode.children
+
+    def override_last_child(self, sceneNode, material = None, material2 = None):
+        ''' replaces the materials of the last child of the scene node '''
+        if isinstance(sceneNode.children[-1], SceneNode):
+            return # the materials of scene nodes are not used
+        children = self.get_own_children(sceneNode)
+        children[-1] = MaterialOverride(children[-1], material, material2)
+
+    def add_surface(self, surface):
+        ''' adds the surface to the scene or to the current scene node '''
+        if len(self.NodeStack) == 0:
+            self.scene.surfaces.append(surface)
+        else:
+            # add to the current node
+            self.get_own_children(self.NodeStack[-1]).append(surface)
+
     def process_render(self, node):
         params = self.create_params(node.attributes)
         params = self.create_params_from_child(node, params)
         self.scene.render = Render(params)        
+        if self.scene.render.mode not in Scene.MODES:
+            raise ValueError('Unknown render mode ' + self.scene.render.mode)
         
     def process_camera(self, node):
         camera = Camera(self.create_params(node.attributes))
@@ -233,10 +264,7 @@ class SceneParser:
         print('create_geom_object: ' + str(geom_obj))
         # decide if the object is going to be in the SceneNode or appended to the
         # scene directly
-        if len(self.NodeStack) == 0:
-            self.scene.surfaces.append(geom_obj)
-        else:
-            self.NodeStack[-1].children.append(geom_obj)
+        self.add_surface(geom_obj)
         return geom_obj
         
     def process_sphere(self, node):
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Test the bounding volume hierarchy by comparing its intersections with the
+intersections found by testing all the objects one by one.
+"""
+
+import unittest
+import numpy as np
+import numpy.testing as nptest
+from Intersectable import Plane, Sphere, Box, SceneNode
+from HelperClasses import Material
+from Ray import Ray, IntersectionPacket
+from BVH import BVH
+from TestIntersectMany import random_rays
+import GeomTransform as GT
+
+def create_random_objects(N, seed = 4321):
+    ''' N small spheres, boxes and scene nodes placed randomly around the origin '''
+    np.random.seed(seed)
+    objects = []
+    for i in range(N):
+        center = np.random.uniform(-3, 3, 3)
+        size = np.random.uniform(0.05, 0.4)
+        kind = i % 3
+        if kind == 0:
+            objects.append(Sphere({'center': center, 'radius': size, 'material': Material()}))
+        elif kind == 1:
+            objects.append(Box({'min': center - size, 'max': center + size, 'material': Material()}))
+        else:
+            node = SceneNode(params = {'translation': center, 
+                                       'rotation': np.random.uniform(0, 90, 3),
+                                       'scale': [size, 2 * size, size]})
+            node.children.append(Box({'min': [-1., -1., -1.], 'max': [1., 1., 1.]}))
+            node.children.append(Sphere({'center': [1., 0., 0.], 'radius': 0.5}))
+            objects.append(node)
+    return objects
+
+def nearest_intersection(objects, ray):
+    ''' linear search for the nearest intersection '''
+    nearest = None
+    for obj in objects:
+        isect = obj.intersect(ray)
+        if nearest is None or isect.t < nearest.t:
+            nearest = isect
+    return nearest
+
+class TestBVHBounds(unittest.TestCase):
+    def test_sphere_bounds(self):
+        minPoint, maxPoint = Sphere({'center': [1., 2., 3.], 'radius': 0.5}).bounds()
+        nptest.assert_array_equal(minPoint, [0.5, 1.5, 2.5])
+        nptest.assert_array_equal(maxPoint, [1.5, 2.5, 3.5])
+
+    def test_plane_is_unbounded(self):
+        self.assertIsNone(Plane().bounds())
+
+    def test_scene_node_bounds(self):
+        node = SceneNode(params = {'translation': [1., 0., 0.], 'scale': [2., 1., 1.]})
+        node.children.append(Box({'min': [-1., -1., -1.], 'max': [1., 1., 1.]}))
+        minPoint, maxPoint = node.bounds()
+        nptest.assert_array_almost_equal(minPoint, [-1., -1., -1.])
+        nptest.assert_array_almost_equal(maxPoint, [3., 1., 1.])
+
+    def test_rotated_sphere_bounds_are_tight(self):
+        node = SceneNode(params = {'rotation': [30., 45., 60.], 'translation': [0., 2., 0.]})
+        node.children.append(Sphere({'center': [0., 0., 0.], 'radius': 1.}))
+        minPoint, maxPoint = node.bounds()
+        nptest.assert_array_almost_equal(minPoint, [-1., 1., -1.])
+        nptest.assert_array_almost_equal(maxPoint, [1., 3., 1.])
+
+    def test_rotated_box_bounds_are_tight(self):
+        node = SceneNode(params = {'rotation': [0., 0., 45.]})
+        node.children.append(Box({'min': [-1., -1., -5.], 'max': [1., 1., 5.]}))
+        minPoint, maxPoint = node.bounds()
+        nptest.assert_array_almost_equal(minPoint, [-np.sqrt(2), -np.sqrt(2), -5.])
+        nptest.assert_array_almost_equal(maxPoint, [np.sqrt(2), np.sqrt(2), 5.])
+
+    def test_nested_scene_node_bounds(self):
+        child = SceneNode(params = {'scale': [1., 3., 1.]})
+        child.children.append(Sphere({'center': [0., 0., 0.], 'radius': 1.}))
+        node = SceneNode(params = {'rotation': [0., 0., 90.]})
+        node.children.append(child)
+        minPoint, maxPoint = node.bounds()
+        nptest.assert_array_almost_equal(minPoint, [-3., -1., -1.])
+        nptest.assert_array_almost_equal(maxPoint, [3., 1., 1.])
+
+    def test_scene_node_bounds_cache(self):
+        node = SceneNode()
+        node.children.append(Sphere({'center': [0., 0., 0.], 'radius': 1.}))
+        self.assertIs(node.bounds(), node.bounds())
+        node.children.append(Sphere({'center': [2., 0., 0.], 'radius': 1.}))
+        nptest.assert_array_almost_equal(node.bounds()[1], [3., 1., 1.])
+        node.M = GT.translate([0., 1., 0.]).getA()
+        node.Minv = np.linalg.inv(node.M)
+        nptest.assert_array_almost_equal(node.bounds()[1], [3., 2., 1.])
+        node.children[1].radius = 2.
+        node.invalidate_bounds()
+        nptest.assert_array_almost_equal(node.bounds()[1], [4., 3., 2.])
+
+    def test_scene_node_rejects_rays_outside_bounds(self):
+        node = SceneNode(params = {'translation': [5., 0., 0.]})
+        node.children.append(Sphere({'center': [0., 0., 0.], 'radius': 1.}))
+        self.assertTrue(node.is_missed_by(Ray([0., 0., 10.], [0., 0., -1.])))
+        self.assertFalse(node.is_missed_by(Ray([5., 0., 10.], [0., 0., -1.])))
+        self.assertEqual(node.intersect(Ray([0., 0., 10.], [0., 0., -1.])).t, np.inf)
+
+    def test_scene_node_with_plane_is_unbounded(self):
+        node = SceneNode()
+        node.children.append(Plane())
+        self.assertIsNone(node.bounds())
+
+class TestBVHIntersection(unittest.TestCase):
+    def setUp(self):
+        self.objects = create_random_objects(60)
+        self.bvh = BVH(self.objects)
+        self.origins, self.directions = random_rays(200)
+
+    def test_all_objects_in_tree(self):
+        def leaf_objects(node):
+            if node.is_leaf():
+                return list(node.objects)
+            return leaf_objects(node.left) + leaf_objects(node.right)
+        objects = leaf_objects(self.bvh.root)
+        self.assertEqual(len(objects), len(self.objects))
+        self.assertEqual(set(map(id, objects)), set(map(id, self.objects)))
+
+    def test_same_as_linear_search(self):
+        hits = 0
+        for origin, direction in zip(self.origins, self.directions):
+            ray = Ray(origin, direction)
+            expected = nearest_intersection(self.objects, ray)
+            isect = self.bvh.intersect(ray)
+            nptest.assert_almost_equal(isect.t, expected.t)
+            if expected.t < np.inf:
+                hits += 1
+                nptest.assert_array_almost_equal(isect.p, expected.p)
+                self.assertIs(isect.material, expected.material)
+        self.assertGreater(hits, 20)
+
+    def test_packet_same_as_linear_search(self):
+        isects = self.bvh.intersect_many(self.origins, self.directions)
+        expected = IntersectionPacket(len(self.origins))
+        for obj in self.objects:
+            expected.update(obj.intersect_many(self.origins, self.directions))
+        nptest.assert_array_almost_equal(isects.t, expected.t)
+        nptest.assert_array_almost_equal(isects.p, expected.p)
+        nptest.assert_array_almost_equal(isects.n, expected.n)
+
+    def test_scene_node_accelerator(self):
+        node = SceneNode(params = {'rotation': [10., 20., 30.], 'translation': [0., 1., 0.]})
+        node.children.extend(self.objects)
+        node.children.append(Plane({'normal': [0., 1., 0.]}))
+        expected = [node.intersect(Ray(o, d)) for o, d in zip(self.origins, self.directions)]
+        node.build_accelerator()
+        self.assertIsNotNone(node.accelerator)
+        self.assertEqual(len(node.unbounded_children), 1)
+        for (origin, direction), result in zip(zip(self.origins, self.directions), expected):
+            isect = node.intersect(Ray(origin, direction))
+            nptest.assert_almost_equal(isect.t, result.t)
+            nptest.assert_array_almost_equal(isect.n, result.n)
+
+class TestOcclusion(unittest.TestCase):
+    ''' occluded(ray, t_max) should be the same as testing the nearest intersection against t_max '''
+    def setUp(self):
+        self.objects = create_random_objects(45)
+        self.objects.append(Plane({'normal': GT.normalize([0., 1., 0.2])}))
+        self.origins, self.directions = random_rays(150)
+        np.random.seed(99)
+        self.t_max = np.random.uniform(0.5, 8., len(self.origins))
+
+    def check_occlusion(self, obj):
+        rays = [Ray(o, d) for o, d in zip(self.origins, self.directions)]
+        expected = np.array([obj.intersect(ray).t < t for ray, t in zip(rays, self.t_max)])
+        occluded = np.array([obj.occluded(ray, t) for ray, t in zip(rays, self.t_max)])
+        nptest.assert_array_equal(occluded, expected)
+        nptest.assert_array_equal(obj.occluded_many(self.origins, self.directions, self.t_max), expected)
+        return expected
+
+    def test_primitives(self):
+        for obj in self.objects:
+            self.check_occlusion(obj)
+
+    def test_bvh(self):
+        expected = self.check_occlusion(BVH(self.objects[:-1]))
+        self.assertTrue(np.any(expected) and not np.all(expected))
+
+    def test_scene_node(self):
+        node = SceneNode(params = {'rotation': [10., 20., 30.], 'scale': [1., 0.5, 1.]})
+        node.children.extend(self.objects)
+        self.check_occlusion(node)
+        node.build_accelerator()
+        self.check_occlusion(node)
+
+def main(): # to make it easier to import this file and run the tests
+    unittest.main()
+    
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Test rendering directories of scene files with BatchRender.
+"""
+
+import os
+import sys
+import json
+import shutil
+import unittest
+import tempfile
+import subprocess
+import BatchRender
+
+SCENE = '''<?xml version="1.0"?>
+<scene ambient="0.1 0.1 0.1">
+  <material name="red" diffuse="1 0 0"/>
+  <render output="%(name)s.png" show_image="true" mode="vectorized" workers="2">
+    <camera from="0 0 10" to="0 0 0" up="0 1 0" fov="45" width="%(width)d" height="16"/>
+  </render>
+  <sphere center="0 0 0" radius="2"> <material ref="red"/> </sphere>
+</scene>
+'''
+
+class TestBatchRender(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, 'more'))
+        for name, width in [('a', 16), ('more/b', 32)]:
+            with open(os.path.join(self.dir, name + '.xml'), 'w') as f:
+                f.write(SCENE % {'name': os.path.basename(name), 'width': width})
+        with open(os.path.join(self.dir, 'broken.xml'), 'w') as f:
+            f.write('<scene>')
+        self.out_dir = os.path.join(self.dir, 'images')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_find_scene_files(self):
+        files = [os.path.join(self.dir, name) for name in ['a.xml', 'broken.xml', 'more/b.xml']]
+        self.assertEqual(BatchRender.find_scene_files([self.dir]), files)
+        self.assertEqual(BatchRender.find_scene_files([os.path.join(self.dir, '*.xml'), files[0]]),
+                         files[:2])
+
+    def test_summary(self):
+        for processes in [1, 2]:
+            summary_file = os.path.join(self.dir, 'summary.json')
+            BatchRender.main([self.dir], processes, summary_file, self.out_dir, max_dim = 8)
+            with open(summary_file) as f:
+                summary = json.load(f)
+            self.assertEqual(summary['processes'], processes)
+            self.assertEqual(summary['failed'], 1)
+            a, broken, b = summary['scenes']
+            self.assertIn('error', broken)
+            self.assertEqual(a['image_size'], [8, 8])
+            self.assertEqual(b['image_size'], [8, 4])
+            for result in [a, b]:
+                self.assertNotIn('error', result)
+                self.assertEqual(result['rays'], result['image_size'][0] * result['image_size'][1])
+                self.assertGreater(result['rays_per_second'], 0)
+                self.assertGreater(result['parse_seconds'], 0)
+                self.assertTrue(os.path.exists(result['output']))
+
+    def test_matplotlib_not_imported(self):
+        script = ('import sys, BatchRender; BatchRender.main([%r], 1, None, %r); '
+                  'sys.stderr.write(str("matplotlib" in sys.modules))' % (self.dir, self.out_dir))
+        process = subprocess.Popen([sys.executable, '-c', script], stdout = subprocess.PIPE,
+                                   stderr = subprocess.PIPE, cwd = os.path.dirname(os.path.abspath(__file__)))
+        out, err = process.communicate()
+        self.assertEqual(err.strip().splitlines()[-1], 'False')
+        self.assertTrue(os.path.exists(os.path.join(self.out_dir, 'batch_summary.json')))
+
+def main(): # to make it easier to import this file and run the tests
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
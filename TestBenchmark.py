@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Test the synthetic scenes and the regression check of Benchmark.
+"""
+
+import os
+import json
+import shutil
+import unittest
+import tempfile
+import numpy as np
+import Benchmark
+from SceneParser import SceneParser
+from Intersectable import Sphere, Box, Plane, SceneNode
+
+def count_surfaces(surfaces, depth = 0):
+    ''' returns the number of spheres, boxes and planes and the number of nested node levels '''
+    counts = {Sphere: 0, Box: 0, Plane: 0}
+    max_depth = depth
+    for surface in surfaces:
+        if isinstance(surface, SceneNode):
+            child_counts, child_depth = count_surfaces(surface.children, depth + 1)
+            for kind in counts:
+                counts[kind] += child_counts[kind]
+            max_depth = max(max_depth, child_depth)
+        else:
+            counts[[kind for kind in counts if isinstance(surface, kind)][0]] += 1
+    return counts, max_depth
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def parse(self, xml):
+        filename = os.path.join(self.dir, 'scene.xml')
+        with open(filename, 'w') as f:
+            f.write(xml)
+        return SceneParser(filename).scene
+
+    def test_synthetic_scene(self):
+        xml = Benchmark.generate_scene_xml(250, 3, width = 20, height = 10)
+        self.assertEqual(xml, Benchmark.generate_scene_xml(250, 3, width = 20, height = 10))
+        scene = self.parse(xml)
+        counts, depth = count_surfaces(scene.surfaces)
+        self.assertEqual(counts, {Sphere: 125, Box: 125, Plane: 1})
+        self.assertEqual(depth, 2) # 250 objects in 25 nodes in 3 nodes
+        self.assertEqual(len(scene.lights), 3)
+        self.assertEqual(scene.render.camera.imageSize, (20, 10))
+
+    def test_node_translations(self):
+        ''' the objects are at the same place as without the nodes '''
+        nested = self.parse(Benchmark.generate_scene_xml(20, 1, group_size = 4))
+        flat = self.parse(Benchmark.generate_scene_xml(20, 1, group_size = 20))
+        self.assertEqual(len(flat.surfaces), 21)
+        origins, directions = flat.create_rays()
+        for scene in [nested, flat]:
+            scene.build_accelerator('none')
+        nested_hits = nested.get_nearest_object_intersections(origins.reshape(-1, 3), directions.reshape(-1, 3))
+        flat_hits = flat.get_nearest_object_intersections(origins.reshape(-1, 3), directions.reshape(-1, 3))
+        self.assertGreater(np.sum(np.isfinite(flat_hits.t) & (flat_hits.p[:, 1] > 1e-6)), 0)
+        # up to the rounding of the coordinates in the xml
+        np.testing.assert_allclose(nested_hits.t, flat_hits.t, rtol = 1e-3)
+
+    def test_find_regressions(self):
+        baseline = {'a': {'rays_per_second': 1000.}, 'b': {'rays_per_second': 1000.}}
+        results = {'a': {'rays_per_second': 850.}, 'b': {'rays_per_second': 750.},
+                   'c': {'rays_per_second': 1.}}
+        self.assertEqual(Benchmark.find_regressions(results, baseline, 0.2), [('b', 750., 1000.)])
+        self.assertEqual(Benchmark.find_regressions(results, baseline, 0.3), [])
+
+    def test_baseline(self):
+        baseline_file = os.path.join(self.dir, 'baseline.json')
+        self.assertEqual(Benchmark.main(['objects-1'], baseline_file, save_baseline = True, repeat = 1), [])
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        result = baseline['objects-1']
+        self.assertEqual(result['rays'], 64 * 48)
+        for stage in ['parse_seconds', 'build_seconds', 'render_seconds']:
+            self.assertGreaterEqual(result[stage], 0.)
+        # a much faster baseline makes the run fail
+        result['rays_per_second'] *= 100.
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f)
+        regressions = Benchmark.main(['objects-1'], baseline_file, repeat = 1)
+        self.assertEqual([name for name, rays_per_second, expected in regressions], ['objects-1'])
+
+def main(): # to make it easier to import this file and run the tests
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Test the compiled (struct-of-arrays) scene by comparing its intersections with
+the intersections found by testing all the objects one by one.
+"""
+
+import unittest
+import numpy as np
+import numpy.testing as nptest
+from Intersectable import Plane, Sphere, Box
+from HelperClasses import Material
+from Ray import Ray
+from CompiledScene import CompiledScene
+import CompiledScene as CS
+from TestBVH import create_random_objects, nearest_intersection
+from TestIntersectMany import random_rays
+from TesterCommon import check_intersect_many_same_as_intersect
+import GeomTransform as GT
+
+class TestCompiledScene(unittest.TestCase):
+    def setUp(self):
+        self.objects = create_random_objects(60)
+        self.objects.append(Plane({'normal': GT.normalize([0., 1., 0.2]),
+                                   'material': [Material(), Material()]}))
+        self.compiled = CompiledScene(self.objects)
+        self.primitives = [obj for obj in self.objects if obj not in self.compiled.others]
+        self.origins, self.directions = random_rays(200)
+
+    def test_arrays(self):
+        self.assertEqual(self.compiled.sphereCenters.shape, (20, 3))
+        self.assertEqual(self.compiled.boxMinPoints.shape, (20, 3))
+        self.assertEqual(self.compiled.planeNormals.shape, (1, 3))
+        self.assertEqual(len(self.compiled.others), 20)
+        self.assertEqual(len(self.compiled.materials), 42)
+        self.assertEqual(self.compiled.diffuse.shape, (42, 3))
+        self.assertEqual(self.compiled.diffuse.dtype, np.float64)
+
+    def test_shared_materials(self):
+        material = Material()
+        compiled = CompiledScene([Sphere({'material': material}), Box({'material': material})])
+        self.assertEqual(len(compiled.materials), 1)
+        nptest.assert_array_equal(compiled.boxMaterials, [0])
+
+    def test_same_as_linear_search(self):
+        hits = 0
+        for origin, direction in zip(self.origins, self.directions):
+            ray = Ray(origin, direction)
+            expected = nearest_intersection(self.primitives, ray)
+            isect = self.compiled.intersect(ray)
+            nptest.assert_almost_equal(isect.t, expected.t)
+            if expected.t < np.inf:
+                hits += 1
+                nptest.assert_array_almost_equal(isect.p, expected.p)
+                nptest.assert_array_almost_equal(isect.n, expected.n)
+                self.assertIs(isect.material, expected.material)
+        self.assertGreater(hits, 20)
+
+    def test_packet_same_as_intersect(self):
+        check_intersect_many_same_as_intersect(self.compiled, self.origins, self.directions)
+
+    def test_packet_split_in_chunks(self):
+        expected = self.compiled.intersect_many(self.origins, self.directions)
+        chunk_size = CS.MAX_PAIRS_PER_CHUNK
+        CS.MAX_PAIRS_PER_CHUNK = 7
+        try:
+            isects = self.compiled.intersect_many(self.origins, self.directions)
+        finally:
+            CS.MAX_PAIRS_PER_CHUNK = chunk_size
+        nptest.assert_array_equal(isects.t, expected.t)
+        nptest.assert_array_equal(isects.material_index, expected.material_index)
+
+    def test_occlusion(self):
+        np.random.seed(99)
+        t_max = np.random.uniform(0.5, 8., len(self.origins))
+        expected = np.array([nearest_intersection(self.primitives, Ray(o, d)).t < t
+                             for o, d, t in zip(self.origins, self.directions, t_max)])
+        nptest.assert_array_equal(self.compiled.occluded_many(self.origins, self.directions, t_max), expected)
+        occluded, occluders = self.compiled.get_occluders_many(self.origins, self.directions, t_max)
+        for i in np.nonzero(expected)[0]:
+            ray = Ray(self.origins[i], self.directions[i])
+            self.assertTrue(self.compiled.occluded(ray, t_max[i]))
+            self.assertIn(occluders[i], self.primitives)
+            self.assertLess(occluders[i].intersect(ray).t, t_max[i])
+
+    def test_empty(self):
+        compiled = CompiledScene([])
+        isects = compiled.intersect_many(self.origins, self.directions)
+        self.assertTrue(np.all(isects.t == np.inf))
+        self.assertEqual(compiled.intersect(Ray()).t, np.inf)
+
+def main(): # to make it easier to import this file and run the tests
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -15,6 +15,7 @@ the actual intersection point. If the camera is too far away this error will
 get larger.
 '''
 
+import pickle
 import unittest
 import numpy as np
 import numpy.testing as nptest
@@ -143,7 +144,29 @@ class RayCreationFromPixelBaseTests(object):
         
         # check fov
         nptest.assert_approx_equal(cos_theta, np.cos(np.deg2rad(camera.fov)))
-        
+
+    def test_create_rays_same_as_create_ray(self):
+        ''' the vectorized rays should be the same as the per pixel rays '''
+        camera = self.scene.render.camera
+        np.random.seed(3421)
+        R = np.random.permutation(range(camera.imageHeight))[:100]
+        C = np.random.permutation(range(camera.imageWidth))[:100]
+        origins, directions = self.scene.create_rays(R, C)
+        self.assertEqual(directions.shape, (100, 3))
+        for row, col, origin, direction in zip(R, C, origins, directions):
+            ray = self.scene.create_ray(row, col)
+            nptest.assert_array_equal(origin, ray.eyePoint)
+            nptest.assert_array_almost_equal(direction, ray.viewDirection, decimal=12)
+
+    def test_create_rays_for_tile(self):
+        ''' rays for a tile have the shape of the tile '''
+        tile = (10, 20, 17, 23) # (left, top, right, bottom)
+        origins, directions = self.scene.create_rays(*self.scene.render.getPixelGrid(tile))
+        self.assertEqual(origins.shape, (3, 7, 3))
+        self.assertEqual(directions.shape, (3, 7, 3))
+        ray = self.scene.create_ray(21, 15)
+        nptest.assert_array_almost_equal(directions[1, 5], ray.viewDirection, decimal=12)
+
 ################# Derived classes with different camera configuration
 class TestRayCreationFromPixelCamOnPosZ(RayCreationFromPixelBaseTests, unittest.TestCase):
     
@@ -225,7 +248,65 @@ class TestRayCreationFromPixelArbitraryCamPosOrientation(RayCreationFromPixelBas
         scene.render = render
  
 
-                                  
+class TestCameraRayDirections(unittest.TestCase):
+    ''' the ray directions cached by the camera '''
+    params = {'from': np.array([1., 4., -2.]), 'to': np.array([1., -2., 4.]),
+              'up': np.array([0., 1., 0.]), 'fov': 45, 'width': 64, 'height': 48}
+
+    def setUp(self):
+        self.scene = Scene()
+        self.camera = Camera(self.params)
+        self.scene.render = Render({'camera': self.camera})
+
+    def check_same_as_new_camera(self, params):
+        scene = Scene()
+        scene.render = Render({'camera': Camera(params)})
+        nptest.assert_array_almost_equal(self.scene.create_rays()[1], scene.create_rays()[1], decimal = 12)
+        nptest.assert_array_almost_equal(self.scene.create_ray(5, 7).viewDirection,
+                                         scene.create_ray(5, 7).viewDirection, decimal = 12)
+
+    def test_directions_are_reused(self):
+        origins, directions = self.scene.create_rays()
+        self.assertEqual(directions.shape, (48, 64, 3))
+        table = self.camera.rayDirections
+        self.assertIsNotNone(table)
+        nptest.assert_array_equal(self.scene.create_rays()[1], directions)
+        self.assertIs(self.camera.rayDirections, table)
+        nptest.assert_array_equal(self.scene.create_ray(10, 20).viewDirection, directions[10, 20])
+
+    def test_invalidated_when_camera_changes(self):
+        self.scene.create_rays()
+        params = dict(self.params)
+        for name, key, value in [('pointFrom', 'from', np.array([2., 3., -2.])), ('fov', 'fov', 30.),
+                                 ('imageWidth', 'width', 80)]:
+            setattr(self.camera, name, value)
+            params[key] = value
+            self.check_same_as_new_camera(params)
+        self.assertEqual(self.camera.imageSize, (80, 48))
+
+    def test_directions_not_pickled(self):
+        self.scene.create_rays()
+        camera = pickle.loads(pickle.dumps(self.camera, pickle.HIGHEST_PROTOCOL))
+        self.assertIsNotNone(self.camera.rayDirections)
+        self.assertIsNone(camera.rayDirections)
+        nptest.assert_array_equal(camera.get_ray_directions(10, 20), self.camera.get_ray_directions(10, 20))
+
+    def test_subpixel_rays(self):
+        ''' rays not going through the pixel corners are not looked up '''
+        rows, cols = np.array([0.5, 10.25, 47.9]), np.array([63.5, 0.75, 32.])
+        origins, directions = self.scene.create_rays(rows, cols)
+        for row, col, direction in zip(rows, cols, directions):
+            nptest.assert_array_almost_equal(direction, self.scene.create_ray(row, col).viewDirection, decimal = 12)
+        self.assertIsNone(self.camera.rayDirections)
+
+    def test_large_images_use_the_basis(self):
+        self.camera.imageWidth = self.camera.imageHeight = 4096
+        origins, directions = self.scene.create_rays(*self.scene.render.getPixelGrid((0, 0, 8, 8)))
+        self.assertIsNone(self.camera.rayDirections)
+        rowVectors, colVectors = self.camera.get_ray_basis()
+        self.assertEqual((rowVectors.shape, colVectors.shape), ((4096, 3), (4096, 3)))
+        nptest.assert_array_almost_equal(directions[3, 4], self.scene.create_ray(3.0, 4.0).viewDirection)
+
 def main(): # to make it easier to import this file and run the tests
     unittest.main()
     
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Test the packet intersection (intersect_many) of the intersectable objects
+by comparing it with the intersection of the rays one at a time.
+"""
+
+import unittest
+import numpy as np
+from Intersectable import Plane, Sphere, Box, SceneNode
+from HelperClasses import Material
+from TesterCommon import check_intersect_many_same_as_intersect
+import GeomTransform as GT
+
+def random_rays(N, seed = 1234):
+    ''' N rays starting around the origin with random directions '''
+    np.random.seed(seed)
+    origins = np.random.uniform(-4, 4, (N, 3))
+    # aim most of the rays at the origin so that there are enough hits
+    targets = np.random.uniform(-1.5, 1.5, (N, 3))
+    return origins, GT.normalize_many(targets - origins)
+
+class TestIntersectManyPrimitives(unittest.TestCase):
+    def setUp(self):
+        self.origins, self.directions = random_rays(300)
+        
+    def test_sphere(self):
+        sphere = Sphere({'center': [0.2, -0.1, 0.3], 'radius': 1.2})
+        check_intersect_many_same_as_intersect(sphere, self.origins, self.directions)
+        
+    def test_sphere_ray_on_surface(self):
+        sphere = Sphere({'center': [0., 0., 0.], 'radius': 1.})
+        origins = [[1., 0., 0.], [1., 0., 0.], [0., 0., 1.], [0., 0., 3.]]
+        directions = [[1., 0., 0.], GT.normalize([-1., 1., 0.]), [0., 0., -1.], [0., 0., -1.]]
+        check_intersect_many_same_as_intersect(sphere, origins, directions)
+        
+    def test_plane(self):
+        plane = Plane({'normal': [0., 1., 0.]})
+        check_intersect_many_same_as_intersect(plane, self.origins, self.directions)
+        
+    def test_checkerboard_plane(self):
+        plane = Plane({'normal': GT.normalize([0.1, 1., 0.]), 
+                       'material': [Material(), Material({'diffuse': [0., 1., 0.]})]})
+        check_intersect_many_same_as_intersect(plane, self.origins, self.directions)
+        
+    def test_box(self):
+        box = Box({'min': [-1., -0.5, -0.7], 'max': [0.8, 1., 0.6]})
+        check_intersect_many_same_as_intersect(box, self.origins, self.directions)
+        
+    def test_box_axis_aligned_rays(self):
+        box = Box({'min': [-.5, -.5, -.5], 'max': [.5, .5, .5]})
+        origins = [[0., 10., 0.], [0., .5, 0.], [.5, .5, .5], [0., 0., 10.], [0.5, 0., 10.], [0.7, 0., 10.]]
+        directions = [[0., -1., 0.], [0., 1., 0.], [1., 0., 0.], [0., 0., -1.], [0., 0., -1.], [0., 0., -1.]]
+        check_intersect_many_same_as_intersect(box, origins, directions)
+        
+class TestIntersectManySceneNode(unittest.TestCase):
+    def setUp(self):
+        self.origins, self.directions = random_rays(300)
+        self.scene_node = SceneNode(params = {'rotation': [30., 45., 10.], 
+                                              'translation': [0.5, 0., -0.5],
+                                              'scale': [1., 2., 0.5]})
+        self.scene_node.children.append(Sphere({'center': [0.5, 0., 0.], 'radius': 0.6}))
+        self.scene_node.children.append(Box({'min': [-1., -0.5, -0.5], 'max': [0., 0.5, 0.5]}))
+        
+    def test_scene_node(self):
+        check_intersect_many_same_as_intersect(self.scene_node, self.origins, self.directions)
+        
+    def test_nested_scene_node(self):
+        parent = SceneNode(params = {'rotation': [0., 0., 60.], 'scale': [0.8, 0.8, 0.8]})
+        parent.children.append(self.scene_node)
+        parent.children.append(Plane({'normal': [0., 1., 0.]}))
+        check_intersect_many_same_as_intersect(parent, self.origins, self.directions)
+        
+def main(): # to make it easier to import this file and run the tests
+    unittest.main()
+    
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Test the lazy IntersectionResult: the point, normal and material of a hit are
+only computed when they are used, i.e. for the nearest hit.
+"""
+
+import unittest
+import numpy as np
+import numpy.testing as nptest
+from Intersectable import Plane, Sphere, Box, SceneNode, MaterialOverride
+from HelperClasses import Material
+from Ray import Ray, IntersectionResult
+
+class CountingSphere(Sphere):
+    ''' counts the calls to get_normal and get_material '''
+    def __init__(self, params):
+        Sphere.__init__(self, params)
+        self.normals = 0
+        self.materials = 0
+
+    def get_normal(self, isect):
+        self.normals += 1
+        return Sphere.get_normal(self, isect)
+
+    def get_material(self, isect):
+        self.materials += 1
+        return Sphere.get_material(self, isect)
+
+class TestIntersectionResult(unittest.TestCase):
+    def test_slots(self):
+        for obj in [Ray(), IntersectionResult()]:
+            self.assertFalse(hasattr(obj, '__dict__'))
+            self.assertRaises(AttributeError, setattr, obj, 'unknown', 1)
+
+    def test_no_intersection(self):
+        isect = IntersectionResult()
+        self.assertEqual(isect.t, np.inf)
+        self.assertIsNone(isect.material)
+        nptest.assert_array_equal(isect.n, [0., 0., 0.])
+        self.assertRaises(ValueError, isect.p.__setitem__, 0, 1.)
+
+    def test_assigned_values(self):
+        material = Material()
+        isect = IntersectionResult(2., p = np.array([1., 2., 3.]))
+        isect.n = np.array([0., 1., 0.])
+        isect.material = material
+        nptest.assert_array_equal(isect.p, [1., 2., 3.])
+        nptest.assert_array_equal(isect.n, [0., 1., 0.])
+        self.assertIs(isect.material, material)
+
+    def test_only_nearest_hit_is_computed(self):
+        spheres = [CountingSphere({'center': [0., 0., -z], 'radius': 0.5}) for z in [3., 5., 7.]]
+        node = SceneNode(params = {'translation': [1., 0., 0.]})
+        node.children.extend(spheres)
+        ray = Ray([1., 0., 0.], [0., 0., -1.])
+        isects = [node.intersect(ray), spheres[1].intersect(ray)]
+        self.assertEqual([s.normals + s.materials for s in spheres], [0, 0, 0])
+        isect = min(isects, key = lambda isect: isect.t)
+        nptest.assert_almost_equal(isect.t, 2.5)
+        nptest.assert_array_almost_equal(isect.p, [1., 0., -2.5])
+        nptest.assert_array_almost_equal(isect.n, [0., 0., 1.])
+        self.assertIs(isect.material, spheres[0].material)
+        # the values are computed once
+        nptest.assert_array_almost_equal(isect.n, [0., 0., 1.])
+        self.assertIs(isect.material, spheres[0].material)
+        self.assertEqual([(s.normals, s.materials) for s in spheres], [(1, 1), (0, 0), (0, 0)])
+
+    def test_lazy_materials(self):
+        red, blue, green = Material(), Material(), Material()
+        plane = Plane({'normal': [0., 1., 0.], 'material': [red, blue]})
+        override = MaterialOverride(plane, material2 = green)
+        for x, expected in [(0.5, red), (1.5, green)]:
+            ray = Ray([x, 1., 0.5], [0., -1., 0.])
+            self.assertIs(override.intersect(ray).material, expected)
+            self.assertIs(plane.intersect(ray).material, red if expected is red else blue)
+
+    def test_box_normal(self):
+        box = Box({'min': [-1., -1., -1.], 'max': [1., 1., 1.]})
+        isect = box.intersect(Ray([0.2, 5., 0.1], [0., -1., 0.]))
+        nptest.assert_almost_equal(isect.t, 4.)
+        nptest.assert_array_equal(isect.n, [0., 1., 0.])
+        # the exit point for rays starting inside
+        isect = box.intersect(Ray([0.2, 0., 0.1], [0., -1., 0.]))
+        nptest.assert_array_equal(isect.n, [0., -1., 0.])
+
+def main(): # to make it easier to import this file and run the tests
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
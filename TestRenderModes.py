@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Test the different rendering modes of Scene.renderScene by comparing the
+rendered images with the image rendered pixel by pixel (render_scalar).
+"""
+
+import time
+import unittest
+import tempfile
+import numpy as np
+from Scene import Scene, ShadowCache
+from Intersectable import Plane, Sphere, Box, SceneNode
+from HelperClasses import Camera, Render, Light, Material
+
+def create_test_scene(width = 48, height = 36, render_params = {}):
+    ''' small scene containing all the kinds of intersectable objects '''
+    scene = Scene()
+    red = Material({'diffuse': [0.8, 0.1, 0.1], 'hardness': 20.})
+    green = Material({'diffuse': [0.1, 0.8, 0.1], 'specular': [0.2, 0.2, 0.2]})
+    blue = Material({'diffuse': [0.1, 0.1, 0.9], 'ambient': [0.2, 0.2, 0.5]})
+    white = Material({'diffuse': [0.9, 0.9, 0.9], 'specular': [0., 0., 0.]})
+
+    scene.lights.append(Light({'color': [1., 1., 1.], 'from': [-3., 6., 4.], 'power': 0.6}))
+    scene.lights.append(Light({'color': [0.8, 0.8, 0.4], 'from': [4., 5., -2.], 'power': 0.5}))
+
+    scene.surfaces.append(Plane({'normal': [0., 1., 0.], 'material': [white, blue]}))
+    scene.surfaces.append(Sphere({'center': [-1., 1., 0.], 'radius': 1., 'material': red}))
+    scene.surfaces.append(Box({'min': [0.5, 0., -1.], 'max': [1.5, 1.5, 0.], 'material': green}))
+    node = SceneNode(params = {'rotation': [0., 30., 0.], 'translation': [0.5, 0.5, 1.5], 
+                               'scale': [0.5, 0.5, 0.5]})
+    node.children.append(Box({'min': [-1., -1., -1.], 'max': [1., 1., 1.], 'material': blue}))
+    node.children.append(Sphere({'center': [0., 1.5, 0.], 'radius': 0.6, 'material': green}))
+    scene.surfaces.append(node)
+
+    camera = Camera({'from': [0., 3., 7.], 'to': [0., 0.5, 0.], 'up': [0., 1., 0.], 
+                     'fov': 45, 'width': width, 'height': height})
+    params = {'camera': camera, 'bgcolor': [0.1, 0.2, 0.3], 'show_image': 'false', 
+              'out_dir_rel_path': tempfile.gettempdir() + '/', 'tileSize': '16'}
+    params.update(render_params)
+    scene.render = Render(params)
+    return scene
+
+def render_image(scene, mode):
+    ''' renders the scene with the given mode and returns the image as an array '''
+    render = scene.render
+    render.init(render.camera.imageWidth, render.camera.imageHeight)
+    getattr(scene, 'render_' + mode)()
+    return np.asarray(render.getImage(), dtype = int)
+
+class TestVectorizedRender(unittest.TestCase):
+    def setUp(self):
+        self.scene = create_test_scene()
+        self.expected = render_image(self.scene, 'scalar')
+
+    def test_same_as_scalar(self):
+        image = render_image(self.scene, 'vectorized')
+        self.assertEqual(image.shape, (36, 48, 3))
+        self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+
+    def test_tile_size_larger_than_image(self):
+        self.scene.render.tileSize = 100
+        image = render_image(self.scene, 'vectorized')
+        self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+
+    def test_parallel_same_as_scalar(self):
+        self.scene.render.workers = 2
+        image = render_image(self.scene, 'vectorized')
+        self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+
+    def test_accelerated_same_as_scalar(self):
+        self.scene.build_accelerator()
+        self.assertIsNotNone(self.scene.accelerator)
+        for mode in ['scalar', 'vectorized']:
+            image = render_image(self.scene, mode)
+            self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+
+    def test_grid_same_as_scalar(self):
+        self.scene.build_accelerator('grid')
+        self.assertIsNotNone(self.scene.accelerator)
+        for mode in ['scalar', 'vectorized']:
+            image = render_image(self.scene, mode)
+            self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+
+    def test_compiled_same_as_scalar(self):
+        self.scene.build_accelerator('compiled')
+        self.assertEqual(len(self.scene.other_surfaces), 1)
+        for mode in ['scalar', 'vectorized']:
+            image = render_image(self.scene, mode)
+            self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+
+    def test_flattened_same_as_scalar(self):
+        self.scene.render.flatten = True
+        for kind in ['bvh', 'compiled', 'none']:
+            self.scene.build_accelerator(kind)
+            self.assertEqual(len(self.scene.get_surfaces()), 5)
+            for mode in ['scalar', 'vectorized']:
+                image = render_image(self.scene, mode)
+                self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+
+    def test_unknown_accelerator(self):
+        self.assertRaises(ValueError, self.scene.build_accelerator, 'octree')
+
+    def test_shadow_cache_same_as_scalar(self):
+        self.scene.build_accelerator()
+        for mode in ['scalar', 'vectorized']:
+            self.scene.shadow_cache = ShadowCache()
+            image = render_image(self.scene, mode)
+            self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+            stats = self.scene.shadow_cache.stats()
+            self.assertGreater(stats['lookups'], 0)
+            self.assertGreater(stats['hits'], 0)
+            self.assertLessEqual(stats['hits'], stats['lookups'])
+
+    def test_shadow_cache_stats_of_workers(self):
+        self.scene.shadow_cache = ShadowCache()
+        render_image(self.scene, 'vectorized')
+        lookups = self.scene.shadow_cache.lookups
+        self.scene.render.workers = 2
+        self.scene.shadow_cache = ShadowCache()
+        image = render_image(self.scene, 'vectorized')
+        self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+        self.assertEqual(self.scene.shadow_cache.lookups, lookups)
+
+    def test_unknown_mode(self):
+        # the helpers of the render methods aren't modes
+        for mode in ['unknown', 'tile', 'pixel_rays', 'pixel_samples']:
+            self.assertRaises(ValueError, self.scene.renderScene, mode)
+
+class TestFramebuffer(unittest.TestCase):
+    def setUp(self):
+        self.render = Render({'out_dir_rel_path': tempfile.gettempdir() + '/'})
+        self.render.init(4, 2)
+
+    def test_pixels_and_tiles(self):
+        self.render.setPixel([3, 1], np.array([0.5, 1., 0.]))
+        self.render.setTile((0, 0, 2, 2), np.full((2, 2, 3), 0.25))
+        self.assertEqual(self.render.framebuffer.dtype, np.float32)
+        image = np.asarray(self.render.getImage())
+        self.assertEqual(image.shape, (2, 4, 3))
+        np.testing.assert_array_equal(image[1, 3], [127, 255, 0])
+        np.testing.assert_array_equal(image[:, :2], np.full((2, 2, 3), 63))
+        np.testing.assert_array_equal(image[:, 2], np.zeros((2, 3)))
+
+    def test_clamping_and_gamma(self):
+        self.render.setTile((0, 0, 4, 1), [[[-1., 0., 0.25], [1., 2., 0.5], [0.04, 0.09, 0.81], [0.5, 0.5, 0.5]]])
+        np.testing.assert_array_equal(np.asarray(self.render.getImage())[0, :2], [[0, 0, 63], [255, 255, 127]])
+        self.render.gamma = 2.
+        np.testing.assert_array_equal(np.asarray(self.render.getImage())[0, :3], 
+                                      [[0, 0, 127], [255, 255, 180], [51, 76, 229]])
+
+class TestSupersampling(unittest.TestCase):
+    def setUp(self):
+        self.scene = create_test_scene(24, 18)
+        self.expected = render_image(self.scene, 'scalar')
+
+    def test_jitter_parsed(self):
+        self.assertTrue(Render({'jitter': 'true'}).jitter)
+        self.assertFalse(Render({'jitter': 'false'}).jitter)
+        self.assertFalse(Render().isSupersampled())
+
+    def test_stratified_sample_offsets(self):
+        render = self.scene.render
+        render.samples = 3
+        for jitter in [False, True]:
+            render.jitter = jitter
+            row_offsets, col_offsets = render.getSampleOffsets((3, 4), np.random.RandomState(1))
+            self.assertEqual(row_offsets.shape, (3, 4, 9))
+            # one sample in each of the 3x3 cells of the pixel
+            strata = np.floor((row_offsets + 0.5) * 3) * 3 + np.floor((col_offsets + 0.5) * 3)
+            np.testing.assert_array_equal(np.sort(strata, axis = 2), np.tile(np.arange(9.), (3, 4, 1)))
+
+    def test_sample_rays(self):
+        render = self.scene.render
+        render.samples = 3
+        render.jitter = True
+        rows, cols = render.getPixelGrid((2, 4, 6, 7))
+        origins, directions = self.scene.create_sample_rays(rows, cols, np.random.RandomState(1))
+        self.assertEqual(directions.shape, (3, 4, 9, 3))
+        # the rays through the jittered sample positions
+        row_offsets, col_offsets = render.getSampleOffsets(rows.shape, np.random.RandomState(1))
+        expected_origins, expected_directions = self.scene.create_rays(rows[..., np.newaxis] + row_offsets,
+                                                                       cols[..., np.newaxis] + col_offsets)
+        np.testing.assert_allclose(origins, expected_origins)
+        np.testing.assert_allclose(directions, expected_directions)
+
+    def test_vectorized_same_as_scalar(self):
+        self.scene.render.samples = 2
+        image = render_image(self.scene, 'scalar')
+        self.assertGreater(np.max(np.abs(image - self.expected)), 10)
+        self.assertLessEqual(np.max(np.abs(render_image(self.scene, 'vectorized') - image)), 1)
+        self.scene.render.workers = 2
+        self.assertLessEqual(np.max(np.abs(render_image(self.scene, 'vectorized') - image)), 1)
+
+    def test_jittered_render(self):
+        self.scene.render.jitter = True
+        self.scene.render.samples = 2
+        image = render_image(self.scene, 'vectorized')
+        self.assertTrue(np.all(image == render_image(self.scene, 'vectorized')))
+        self.scene.render.jitter = False
+        supersampled = render_image(self.scene, 'vectorized')
+        self.assertFalse(np.all(image == supersampled))
+        # the pixels are averages over the same area
+        self.assertLess(np.abs(np.mean(image) - np.mean(supersampled)), 1.)
+
+    def test_high_contrast_pixels(self):
+        image = np.zeros((5, 6, 3))
+        image[2, 3] = [0., 0.5, 0.]
+        image[:, 5] = [0.05, 0.05, 0.05]
+        refine = self.scene.get_high_contrast_pixels(image)
+        expected = np.zeros((5, 6), dtype = bool)
+        expected[2, 2:5] = expected[1:4, 3] = True
+        np.testing.assert_array_equal(refine, expected)
+
+    def test_adaptive(self):
+        self.scene.render.samples = 3
+        supersampled = render_image(self.scene, 'vectorized')
+        rows, cols = self.scene.render.getPixelGrid((0, 0, 24, 18))
+        refine = self.scene.get_high_contrast_pixels(self.scene.render_pixel_rays(((0, 0, 24, 18), rows, cols)))
+        # the checkerboard squares get smaller than the pixels at the horizon
+        self.assertTrue(0 < np.sum(refine) < 24 * 18)
+        for workers in [1, 2]:
+            self.scene.render.workers = workers
+            image = render_image(self.scene, 'adaptive')
+            stats = self.scene.render_stats
+            self.assertEqual(stats['pixels'], 24 * 18)
+            self.assertEqual(stats['refined_pixels'], np.sum(refine))
+            self.assertEqual(stats['samples'], 24 * 18 + 9 * stats['refined_pixels'])
+            self.assertLessEqual(np.max(np.abs(image[refine] - supersampled[refine])), 1)
+            self.assertLessEqual(np.max(np.abs(image[~refine] - self.expected[~refine])), 1)
+
+    def test_adaptive_without_samples(self):
+        image = render_image(self.scene, 'adaptive')
+        self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+        self.assertEqual(self.scene.render_stats['refined_pixels'], 0)
+
+    def test_lens_offsets(self):
+        render = Render({'eyepoints': '5', 'lensSize': '0.5'})
+        self.assertTrue(render.isDepthOfField())
+        self.assertEqual(render.getSamplesPerPixel(), 5)
+        for jitter in [False, True]:
+            render.jitter = jitter
+            x, y = render.getLensOffsets((3, 4), np.random.RandomState(1))
+            self.assertEqual(x.shape, (3, 4, 5))
+            # one eyepoint in each of the 5 rings of the same area on the lens
+            rings = np.floor((x * x + y * y) / 0.25 ** 2 * 5)
+            np.testing.assert_array_equal(rings, np.tile(np.arange(5.), (3, 4, 1)))
+        self.assertFalse(Render({'eyepoints': '5', 'lensSize': '0'}).isDepthOfField())
+
+    def test_rays_meet_at_focal_plane(self):
+        self.scene.render.eyepoints = 6
+        self.scene.render.lensSize = 0.5
+        camera = self.scene.render.camera
+        origins, directions = self.scene.create_sample_rays(np.array([9]), np.array([4]))
+        self.assertEqual(origins.shape, (1, 6, 3))
+        self.assertTrue(np.all(np.abs(np.dot(origins - camera.pointFrom, camera.lookat)) < 1e-12))
+        # all the rays go through the point of the pinhole ray on the focal plane
+        pinhole = self.scene.create_ray(9, 4).viewDirection
+        focal_distance = np.linalg.norm(camera.pointTo - camera.pointFrom)
+        focus = camera.pointFrom + pinhole * focal_distance / np.dot(pinhole, camera.lookat)
+        t = np.sum((focus - origins) * directions, axis = -1)
+        np.testing.assert_array_almost_equal(origins + t[..., np.newaxis] * directions, 
+                                             np.tile(focus, (1, 6, 1)))
+
+    def test_depth_of_field(self):
+        self.scene.render.eyepoints = 4
+        self.scene.render.lensSize = 0.5
+        image = render_image(self.scene, 'scalar')
+        self.assertGreater(np.max(np.abs(image - self.expected)), 10)
+        self.assertLessEqual(np.max(np.abs(render_image(self.scene, 'vectorized') - image)), 1)
+        self.scene.render.mode = 'vectorized'
+        self.scene.renderScene()
+        self.assertEqual(self.scene.render_stats['samples'], 24 * 18 * 4)
+
+    def test_progressive(self):
+        for workers in [1, 2]:
+            self.scene.render.workers = workers
+            image = render_image(self.scene, 'progressive')
+            self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+            stats = self.scene.render_stats
+            self.assertEqual(stats['passes'], ['stride 8', 'stride 4', 'stride 2', 'stride 1'])
+            self.assertEqual(stats['samples'], 24 * 18)
+
+    def test_progressive_supersampled(self):
+        self.scene.render.samples = 2
+        supersampled = render_image(self.scene, 'vectorized')
+        image = render_image(self.scene, 'progressive')
+        self.assertLessEqual(np.max(np.abs(image - supersampled)), 1)
+        self.assertEqual(self.scene.render_stats['passes'][-1], 'supersampled')
+        self.assertEqual(self.scene.render_stats['samples'], 24 * 18 * 5)
+
+    def test_progressive_time_budget(self):
+        self.scene.render.timeBudget = 1e-9
+        image = render_image(self.scene, 'progressive')
+        # only the first pass is finished
+        self.assertEqual(self.scene.render_stats['passes'], ['stride 8'])
+        self.assertEqual(self.scene.render_stats['samples'], 3 * 3)
+        coarse = np.repeat(np.repeat(self.expected[::8, ::8], 8, axis = 0), 8, axis = 1)[:18, :24]
+        self.assertLessEqual(np.max(np.abs(image - coarse)), 1)
+
+    def test_progressive_unfinished_supersampling(self):
+        self.scene.render.samples = 2
+        self.scene.render.tileSize = 8
+        self.scene.render.timeBudget = 1.
+        render_tile = self.scene.render_tile
+        def slow_render_tile(tile):
+            time.sleep(1.)
+            return render_tile(tile)
+        self.scene.render_tile = slow_render_tile
+        try:
+            image = render_image(self.scene, 'progressive')
+        finally:
+            del self.scene.render_tile
+        # the supersampled tiles aren't shown when the pass isn't finished
+        self.assertEqual(self.scene.render_stats['passes'][-1], 'stride 1')
+        self.assertLessEqual(np.max(np.abs(image - self.expected)), 1)
+
+    def test_samples_per_second(self):
+        self.scene.render.samples = 2
+        self.scene.render.mode = 'vectorized'
+        self.scene.renderScene()
+        stats = self.scene.render_stats
+        self.assertEqual(stats['samples'], 24 * 18 * 4)
+        self.assertAlmostEqual(stats['samples_per_second'], stats['samples'] / stats['seconds'])
+
+def main(): # to make it easier to import this file and run the tests
+    unittest.main()
+    
+if __name__ == '__main__':
+    main()
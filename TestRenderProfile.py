@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+Test the counters and timings collected by RenderProfile during a render and
+the per-pixel cost heatmap.
+"""
+
+import os
+import json
+import pstats
+import unittest
+import numpy as np
+from PIL import Image
+from Intersectable import Sphere, SceneNode
+from TestRenderModes import create_test_scene
+from RenderProfile import RenderProfile
+from Scene import Scene
+
+class BrokenSphere(Sphere):
+    ''' a sphere whose intersection test fails, at module level so that it can be sent to the workers '''
+    def intersect_many(self, origins, directions):
+        raise RuntimeError('broken sphere')
+
+class TestRenderProfile(unittest.TestCase):
+    def setUp(self):
+        self.scene = create_test_scene(24, 18, {'mode': 'vectorized', 'profile': 'json',
+                                                'output': 'profile_test.png', 'tileSize': '8'})
+        self.filename = self.scene.render.OUTDIR_REL_PATH + 'profile_test.png'
+
+    def render(self):
+        self.scene.renderScene()
+        with open(self.filename + '.profile.json') as f:
+            return json.load(f)
+
+    def test_counters(self):
+        stats = self.render()
+        self.assertEqual(stats['rays']['camera'], 24 * 18)
+        # one shadow ray per light for each hit
+        self.assertGreater(stats['rays']['shadow'], 0)
+        self.assertEqual(stats['rays']['shadow'] % 2, 0)
+        self.assertLessEqual(stats['rays']['shadow'], 2 * 24 * 18)
+        # each camera ray is tested against the top level surfaces
+        for name in ['Plane', 'Sphere', 'Box', 'SceneNode']:
+            self.assertGreaterEqual(stats['intersection_tests'][name], 24 * 18)
+        for stage, seconds in stats['stages'].items():
+            self.assertGreater(seconds, 0., stage)
+        self.assertEqual(sorted(tuple(tile['tile']) for tile in stats['tiles']),
+                         sorted(self.scene.render.getTile()))
+        names = [function['name'] for function in stats['functions']]
+        for name in ['Scene.create_rays', 'Sphere.intersect_many', 'Render.save']:
+            self.assertIn(name, names)
+
+    def test_same_counts_in_all_modes(self):
+        rays, tests = None, None
+        for mode, workers in [('vectorized', 1), ('vectorized', 2), ('scalar', 1)]:
+            self.scene.render.mode = mode
+            self.scene.render.workers = workers
+            stats = self.render()
+            self.assertEqual(stats['rays']['camera'], 24 * 18)
+            if rays is None:
+                rays, tests = stats['rays'], stats['intersection_tests']
+            elif mode == 'vectorized':
+                self.assertEqual(stats['rays'], rays)
+                self.assertEqual(stats['intersection_tests'], tests)
+            else:
+                # the scalar renderer tests each ray separately
+                self.assertEqual(stats['rays'], rays)
+                self.assertEqual(sorted(stats['intersection_tests']), sorted(tests))
+
+    def test_counts_of_several_passes(self):
+        # the workers of the second pass don't send back the counts of the first one
+        self.scene.render.samples = 2
+        self.scene.render.mode = 'adaptive'
+        counts = []
+        for workers in [1, 2]:
+            self.scene.render.workers = workers
+            stats = self.render()
+            counts.append((stats['rays'], stats['intersection_tests']))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_only_own_scene_counted(self):
+        methods = [Sphere.__dict__['intersect_many'], Scene.__dict__['render_tile']]
+        other = create_test_scene(16, 8, {'mode': 'vectorized', 'output': 'profile_test.png'})
+        profile = RenderProfile()
+        profile.instrument(other)
+        try:
+            # the scene's own profile is instrumented on top of the other one
+            stats = self.render()
+            self.assertEqual((profile.rays['camera'], profile.get_test_count()), (0, 0))
+            other.renderScene()
+            self.assertEqual(profile.rays['camera'], 16 * 8)
+        finally:
+            profile.restore()
+        self.assertEqual(stats['rays']['camera'], 24 * 18)
+        self.assertEqual([Sphere.__dict__['intersect_many'], Scene.__dict__['render_tile']], methods)
+
+    def test_restored_in_any_order(self):
+        methods = [Sphere.__dict__['intersect_many'], Scene.__dict__['render_tile']]
+        first, second = RenderProfile(), RenderProfile()
+        first.instrument(create_test_scene(16, 8))
+        second.instrument(self.scene)
+        first.restore()
+        self.scene.render.profile = 'none'
+        self.scene.renderScene()
+        self.assertEqual(second.rays['camera'], 24 * 18)
+        second.restore()
+        self.assertEqual([Sphere.__dict__['intersect_many'], Scene.__dict__['render_tile']], methods)
+
+    def test_pstats(self):
+        self.scene.render.profile = 'pstats'
+        self.scene.renderScene()
+        stats = pstats.Stats(self.filename + '.prof')
+        names = dict((name, value) for (filename, line, name), value in stats.stats.items())
+        calls, primitive_calls, seconds, cumulative, callers = names['Scene.create_rays']
+        self.assertEqual(calls, len(list(self.scene.render.getTile())))
+        self.assertGreaterEqual(cumulative, seconds)
+        self.assertTrue(any(name == 'Scene.render_pixel_rays' for filename, line, name in callers))
+
+    def test_methods_restored(self):
+        methods = [Sphere.__dict__['intersect'], SceneNode.__dict__['intersect_many'],
+                   self.scene.__class__.__dict__['create_rays']]
+        self.render()
+        self.assertEqual([Sphere.__dict__['intersect'], SceneNode.__dict__['intersect_many'],
+                          self.scene.__class__.__dict__['create_rays']], methods)
+        self.scene.render.profile = 'none'
+        self.scene.renderScene()
+        self.assertIsNone(self.scene.profile)
+
+    def test_methods_restored_after_error(self):
+        methods = [Sphere.__dict__['intersect_many'], self.scene.__class__.__dict__['render_tile']]
+        self.scene.surfaces.append(BrokenSphere({'center': [1., 1., 0.], 'radius': 1.}))
+        for workers in [1, 2]:
+            self.scene.render.workers = workers
+            self.assertRaises(RuntimeError, self.scene.renderScene)
+            self.assertEqual([Sphere.__dict__['intersect_many'], self.scene.__class__.__dict__['render_tile']],
+                             methods)
+            self.assertEqual(self.scene.profile.originals, dict())
+
+    def tearDown(self):
+        for extension in ['', '.profile.json', '.prof']:
+            if os.path.exists(self.filename + extension):
+                os.remove(self.filename + extension)
+
+class TestCostHeatmap(unittest.TestCase):
+    def setUp(self):
+        self.scene = create_test_scene(24, 18, {'mode': 'scalar', 'heatmap': 'true',
+                                                'output': 'heatmap_test.png'})
+        self.filename = self.scene.render.OUTDIR_REL_PATH + 'heatmap_test.png'
+        self.base = self.scene.render.OUTDIR_REL_PATH + 'heatmap_test_cost'
+
+    def test_heatmap_files(self):
+        self.scene.renderScene()
+        costs = np.load(self.base + '.npy')
+        self.assertEqual(costs.shape, (18, 24, 2))
+        # the camera ray of each pixel is tested against the 4 top level surfaces
+        self.assertTrue(np.all(costs[..., 0] >= 4))
+        self.assertTrue(np.all(costs[..., 1] > 0.))
+        # the pixels don't all cost the same
+        self.assertGreater(len(np.unique(costs[..., 0])), 4)
+        for name in ['_tests.png', '_time.png']:
+            self.assertEqual(np.asarray(Image.open(self.base + name)).shape, (18, 24, 3))
+
+    def test_same_tests_as_profile(self):
+        # the costs are recorded by the render itself
+        self.scene.render.profile = 'json'
+        for samples in [1, 2]:
+            self.scene.render.samples = samples
+            self.scene.renderScene()
+            costs = np.load(self.base + '.npy')
+            self.assertEqual(np.sum(costs[..., 0]), self.scene.profile.get_test_count())
+            # at least the camera rays tested against the 4 top level surfaces
+            self.assertTrue(np.all(costs[..., 0] >= 4 * samples * samples))
+
+    def test_packet_modes_rejected(self):
+        for mode in ['vectorized', 'adaptive', 'progressive']:
+            self.assertRaises(ValueError, self.scene.renderScene, mode)
+            self.assertFalse(os.path.exists(self.base + '.npy'))
+
+    def test_heatmap_without_profile(self):
+        self.scene.renderScene()
+        self.assertFalse(os.path.exists(self.filename + '.profile.json'))
+        self.assertEqual(self.scene.profile.originals, dict())
+
+    def test_false_color(self):
+        self.scene.render.saveFalseColor([[0., 1., 2.], [4., 3., 2.]], self.base + '_tests.png')
+        image = np.asarray(Image.open(self.base + '_tests.png'))
+        np.testing.assert_array_equal(image[0, 0], [0, 0, 127])
+        np.testing.assert_array_equal(image[1, 0], [255, 0, 0])
+        self.assertEqual(image[0, 2, 1], 255) # green
+
+    def tearDown(self):
+        for filename in [self.filename, self.filename + '.profile.json'] + \
+                        [self.base + name for name in ['.npy', '_tests.png', '_time.png']]:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+def main(): # to make it easier to import this file and run the tests
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Test the flattening of the scene node hierarchy into instances (see
+SceneNode.flatten). The scene node tests of TestSceneNodeIntersection.py are
+run again with the scene node replaced by its flattened instances.
+"""
+
+import unittest
+import numpy as np
+import numpy.testing as nptest
+from Intersectable import Plane, Sphere, SceneNode, Instance
+from HelperClasses import Material
+from Ray import Ray
+from TestBVH import create_random_objects, nearest_intersection
+from TestIntersectMany import random_rays
+from TesterCommon import check_intersect_many_same_as_intersect
+import TestSceneNodeIntersection
+import GeomTransform as GT
+
+class FlattenedSceneNode:
+    '''
+    Intersects the instances of a flattened scene node, the other attributes
+    are the ones of the scene node. The node is put below two more nodes
+    whose transformations cancel out to test the composite transformation.
+    '''
+    def __init__(self, node):
+        self.node = node
+        outer = SceneNode(params = {'translation': [1., -2., 3.], 'rotation': [30., 0., 60.]})
+        inner = SceneNode(M = outer.Minv)
+        inner.children.append(node)
+        outer.children.append(inner)
+        self.instances = outer.flatten()
+
+    def __getattr__(self, name):
+        return getattr(self.node, name)
+
+    def intersect(self, ray):
+        return nearest_intersection(self.instances, ray)
+
+def flattened_test_case(test_case):
+    ''' same test case as test_case using a FlattenedSceneNode '''
+    def setUp(self):
+        test_case.setUp(self)
+        self.scene_node = FlattenedSceneNode(self.scene_node)
+    return type(test_case.__name__ + 'Flattened', (test_case,), {'setUp': setUp})
+
+for name, test_case in vars(TestSceneNodeIntersection).items():
+    if isinstance(test_case, type) and issubclass(test_case, unittest.TestCase):
+        globals()[name + 'Flattened'] = flattened_test_case(test_case)
+
+class TestFlatten(unittest.TestCase):
+    def setUp(self):
+        self.node = SceneNode(params = {'rotation': [10., 20., 30.], 'translation': [0., 1., 0.],
+                                        'scale': [1., 0.5, 1.]})
+        child = SceneNode(params = {'rotation': [0., 45., 0.], 'scale': [2., 1., 1.]})
+        child.children.extend(create_random_objects(30))
+        self.node.children.append(child)
+        self.node.children.append(Sphere({'center': [0., 0., 0.], 'radius': 0.5, 'material': Material()}))
+        self.node.children.append(Plane({'normal': GT.normalize([0., 1., 0.2]),
+                                         'material': [Material(), Material()]}))
+        self.instances = self.node.flatten()
+        self.origins, self.directions = random_rays(150)
+
+    def test_one_instance_per_primitive(self):
+        # 10 of the random objects are scene nodes with 2 children
+        self.assertEqual(len(self.instances), 10 + 10 + 20 + 2)
+        self.assertTrue(all(isinstance(instance, Instance) for instance in self.instances))
+        sphere = self.instances[-2]
+        self.assertIs(sphere.primitive, self.node.children[1])
+        nptest.assert_array_equal(sphere.M, self.node.M)
+        box = self.instances[1]
+        self.assertIs(box.primitive, self.node.children[0].children[1])
+        nptest.assert_array_almost_equal(box.M, np.dot(self.node.M, self.node.children[0].M))
+        nptest.assert_array_almost_equal(np.dot(box.M, box.Minv), np.eye(4))
+
+    def test_same_as_scene_node(self):
+        hits = 0
+        for origin, direction in zip(self.origins, self.directions):
+            ray = Ray(origin, direction)
+            expected = self.node.intersect(ray)
+            isect = nearest_intersection(self.instances, ray)
+            nptest.assert_almost_equal(isect.t, expected.t)
+            if expected.t < np.inf:
+                hits += 1
+                nptest.assert_array_almost_equal(isect.p, expected.p)
+                nptest.assert_array_almost_equal(isect.n, expected.n)
+                self.assertIs(isect.material, expected.material)
+        self.assertGreater(hits, 20)
+
+    def test_packet_same_as_intersect(self):
+        for instance in self.instances:
+            check_intersect_many_same_as_intersect(instance, self.origins, self.directions)
+
+    def test_bounds(self):
+        children_bounds = [child.bounds(self.node.M) for child in self.node.children[:2]]
+        instance_bounds = [instance.bounds() for instance in self.instances[:-1]]
+        for i, union in [(0, np.min), (1, np.max)]:
+            nptest.assert_array_almost_equal(union([b[i] for b in instance_bounds], axis = 0),
+                                             union([b[i] for b in children_bounds], axis = 0))
+        self.assertIsNone(self.instances[-1].bounds())
+
+    def test_occlusion(self):
+        np.random.seed(99)
+        t_max = np.random.uniform(0.5, 8., len(self.origins))
+        for instance in self.instances:
+            expected = instance.intersect_many(self.origins, self.directions).t < t_max
+            nptest.assert_array_equal(instance.occluded_many(self.origins, self.directions, t_max), expected)
+            for i in range(0, len(self.origins), 10):
+                ray = Ray(self.origins[i], self.directions[i])
+                self.assertEqual(instance.occluded(ray, t_max[i]), expected[i])
+
+def main(): # to make it easier to import this file and run the tests
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
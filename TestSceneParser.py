@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Test the parsing of the scene nodes that refer to other nodes (ref nodes).
+"""
+
+import os
+import unittest
+import tempfile
+import numpy as np
+import numpy.testing as nptest
+from SceneParser import SceneParser
+from Intersectable import Plane, MaterialOverride
+from Ray import Ray
+
+SCENE = '''<?xml version="1.0"?>
+<scene ambient="0.1 0.1 0.1">
+  <material name="red" diffuse="1 0 0"/>
+  <material name="green" diffuse="0 1 0"/>
+  <material name="blue" diffuse="0 0 1"/>
+  <render output="test.png" show_image="false" out_dir_rel_path="%(outdir)s">
+    <camera from="0 0 10" to="0 0 0" up="0 1 0" fov="45" width="8" height="8"/>
+  </render>
+  <node name="base" translation="-4 0 0">
+    <sphere center="0 1 0" radius="0.5"> <material ref="green"/> </sphere>
+    <plane normal="0 0 1"> <material ref="red"/> <material2 ref="blue"/> </plane>
+  </node>
+  %(refs)s
+</scene>
+'''
+
+def parse_scene(refs):
+    ''' parses SCENE with the given xml for the ref nodes '''
+    handle, filename = tempfile.mkstemp(suffix = '.xml')
+    os.close(handle)
+    try:
+        with open(filename, 'w') as f:
+            f.write(SCENE % {'outdir': tempfile.gettempdir() + '/', 'refs': refs})
+        return SceneParser(filename).scene
+    finally:
+        os.remove(filename)
+
+class TestRefNodes(unittest.TestCase):
+    def test_children_are_shared(self):
+        refs = ''.join('<node ref="base" translation="%d 0 0"/>' % i for i in range(200))
+        scene = parse_scene(refs)
+        self.assertEqual(len(scene.surfaces), 201)
+        base = scene.surfaces[0]
+        for node in scene.surfaces[1:]:
+            self.assertIs(node.children, base.children)
+        nptest.assert_array_equal(scene.surfaces[-1].M[:3,3], [199., 0., 0.])
+
+    def test_ref_node_transform(self):
+        scene = parse_scene('<node ref="base" translation="4 0 0"/>')
+        isect = scene.surfaces[1].intersect(Ray([4., 1., 5.], [0., 0., -1.]))
+        nptest.assert_array_almost_equal(isect.p, [4., 1., 0.5])
+        self.assertIs(isect.material, scene.surfaces[0].children[0].material)
+
+    def check_materials(self, base, node, replaced, x = 4.):
+        '''
+        the materials of the node translated by x (instead of -4 for base) are
+        the materials of base replaced according to the replaced dictionary
+        '''
+        for dx in [-0.5, 0.5]:
+            expected = base.intersect(Ray([-4. + dx, 0.5, 5.], [0., 0., -1.])).material
+            isect = node.intersect(Ray([x + dx, 0.5, 5.], [0., 0., -1.]))
+            self.assertIs(isect.material, replaced.get(expected, expected))
+            isects = node.intersect_many(np.array([[x + dx, 0.5, 5.]]), np.array([[0., 0., -1.]]))
+            self.assertIs(isects.materials[isects.material_index[0]], replaced.get(expected, expected))
+
+    def test_material_override(self):
+        scene = parse_scene('<node ref="base" translation="4 0 0">' +
+                            '<material ref="green"/><material2 ref="red"/></node>')
+        base, ref = scene.surfaces
+        plane = base.children[1]
+        self.assertIsInstance(plane, Plane)
+        self.assertIsInstance(ref.children[-1], MaterialOverride)
+        self.assertIs(ref.children[0], base.children[0])
+        green = base.children[0].material
+        self.assertIsNot(plane.material, green)
+        self.check_materials(base, ref, {plane.material: green, plane.material2: plane.material})
+
+    def test_ref_of_ref_node(self):
+        scene = parse_scene('<node name="copy" ref="base" translation="0 0 0"><material2 ref="green"/></node>' +
+                            '<node ref="copy" translation="4 0 0"><material ref="blue"/></node>')
+        base, copy, ref = scene.surfaces
+        self.assertIs(ref.children[0], base.children[0])
+        plane = base.children[1]
+        green, blue = base.children[0].material, plane.material2
+        self.check_materials(base, copy, {plane.material2: green}, x = 0.)
+        self.check_materials(base, ref, {plane.material: blue, plane.material2: green})
+
+    def test_geometry_added_to_ref_node(self):
+        scene = parse_scene('<node ref="base"><sphere center="0 3 0" radius="0.5"/></node>')
+        base, ref = scene.surfaces
+        self.assertEqual(len(base.children), 2)
+        self.assertEqual(len(ref.children), 3)
+        self.assertIs(ref.children[0], base.children[0])
+
+    def test_ref_nodes_share_accelerator(self):
+        refs = '<node name="pair"><sphere center="0 0 0" radius="0.5"/><box min="1 0 0" max="2 1 1"/></node>'
+        refs += ''.join('<node ref="pair" translation="0 %d 0"/>' % i for i in range(20))
+        scene = parse_scene(refs)
+        pair = scene.surfaces[1]
+        self.assertIsNotNone(pair.accelerator)
+        for node in scene.surfaces[2:]:
+            self.assertIs(node.accelerator, pair.accelerator)
+        # the top level BVH is over the nodes, the base node contains a plane
+        self.assertEqual(scene.other_surfaces, [scene.surfaces[0]])
+        isect = scene.get_nearest_object_intersection(Ray([0., 7., 5.], [0., 0., -1.]))
+        nptest.assert_array_almost_equal(isect.p, [0., 7., 0.5])
+
+    def test_flattened_ref_nodes(self):
+        scene = parse_scene('<node ref="base" translation="4 0 0"><material ref="green"/></node>')
+        # only keep the ref node since the planes of both nodes are the same
+        base, ref = scene.surfaces
+        scene.surfaces = [ref]
+        scene.render.flatten = True
+        scene.build_accelerator()
+        for dx in [-0.5, 0.5]:
+            ray = Ray([4. + dx, 0.5, 5.], [0., 0., -1.])
+            self.assertIs(scene.get_nearest_object_intersection(ray).material, ref.intersect(ray).material)
+
+def main(): # to make it easier to import this file and run the tests
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Test the uniform grid by comparing its intersections with the intersections
+found by testing all the objects one by one.
+"""
+
+import unittest
+import numpy as np
+import numpy.testing as nptest
+from Intersectable import Sphere, Box
+from HelperClasses import Material
+from Ray import Ray, IntersectionPacket
+from UniformGrid import UniformGrid
+import UniformGrid as UG
+from TestBVH import create_random_objects, nearest_intersection
+from TestIntersectMany import random_rays
+
+class CountingObject:
+    ''' counts the intersection tests of the wrapped object '''
+    def __init__(self, obj):
+        self.obj = obj
+        self.count = 0
+
+    def bounds(self, M = None):
+        return self.obj.bounds(M)
+
+    def intersect(self, ray):
+        self.count += 1
+        return self.obj.intersect(ray)
+
+    def intersect_many(self, origins, directions):
+        self.count += len(origins)
+        return self.obj.intersect_many(origins, directions)
+
+class TestUniformGrid(unittest.TestCase):
+    def setUp(self):
+        self.objects = create_random_objects(60)
+        self.grid = UniformGrid(self.objects)
+        self.origins, self.directions = random_rays(200)
+
+    def test_resolution(self):
+        nptest.assert_array_less(0, self.grid.resolution)
+        cells = np.prod(self.grid.resolution)
+        # about GRID_DENSITY cells per object
+        self.assertGreater(cells, UG.GRID_DENSITY * len(self.objects) / 2.)
+        self.assertLess(cells, UG.GRID_DENSITY * len(self.objects) * 2.)
+
+    def test_flat_scene_resolution(self):
+        objects = [Box({'min': [i, 0., 0.], 'max': [i + 0.5, 0., 0.5]}) for i in range(50)]
+        grid = UniformGrid(objects)
+        self.assertEqual(grid.resolution[1], 1)
+        self.assertLessEqual(np.max(grid.resolution), UG.MAX_RESOLUTION)
+
+    def test_all_objects_in_cells(self):
+        self.assertEqual(set(self.grid.cellObjects), set(range(len(self.objects))))
+        self.assertEqual(self.grid.cellStart[-1], len(self.grid.cellObjects))
+
+    def test_same_as_linear_search(self):
+        hits = 0
+        for origin, direction in zip(self.origins, self.directions):
+            ray = Ray(origin, direction)
+            expected = nearest_intersection(self.objects, ray)
+            isect = self.grid.intersect(ray)
+            nptest.assert_almost_equal(isect.t, expected.t)
+            if expected.t < np.inf:
+                hits += 1
+                nptest.assert_array_almost_equal(isect.p, expected.p)
+                self.assertIs(isect.material, expected.material)
+        self.assertGreater(hits, 20)
+
+    def test_packet_same_as_linear_search(self):
+        isects = self.grid.intersect_many(self.origins, self.directions)
+        expected = IntersectionPacket(len(self.origins))
+        for obj in self.objects:
+            expected.update(obj.intersect_many(self.origins, self.directions))
+        nptest.assert_array_almost_equal(isects.t, expected.t)
+        nptest.assert_array_almost_equal(isects.p, expected.p)
+        nptest.assert_array_almost_equal(isects.n, expected.n)
+
+    def test_rays_starting_inside_and_axis_aligned(self):
+        origins = np.array([[0., 0., 0.], [0., 0., 10.], [0.3, -0.2, 0.1], [10., 0.5, 0.5]])
+        directions = np.array([[0., 0., 1.], [0., 0., -1.], [1., 0., 0.], [-1., 0., 0.]])
+        isects = self.grid.intersect_many(origins, directions)
+        for i, (origin, direction) in enumerate(zip(origins, directions)):
+            expected = nearest_intersection(self.objects, Ray(origin, direction))
+            nptest.assert_almost_equal(self.grid.intersect(Ray(origin, direction)).t, expected.t)
+            nptest.assert_almost_equal(isects.t[i], expected.t)
+
+    def test_mailboxing(self):
+        ''' objects spanning many cells are only tested once per ray '''
+        np.random.seed(7)
+        objects = [CountingObject(Sphere({'center': c, 'radius': 0.1, 'material': Material()}))
+                   for c in np.random.uniform(-3, 3, (100, 3))]
+        objects.append(CountingObject(Box({'min': [-3., -0.5, -3.], 'max': [3., -0.4, 3.]})))
+        grid = UniformGrid(objects)
+        self.assertGreater(np.sum(grid.cellObjects == len(objects) - 1), 1)
+        # ray just above the box, going through many of its cells
+        ray = Ray([-3.5, -0.38, 0.05], [1., 0., 0.])
+        box_cells = [cell for cell, t_exit in grid.traverse(list(ray.eyePoint), list(ray.viewDirection))
+                     if len(objects) - 1 in grid.cellObjects[grid.cellStart[cell]:grid.cellStart[cell + 1]]]
+        self.assertGreater(len(box_cells), 1)
+        for obj in objects:
+            obj.count = 0
+        self.assertEqual(grid.intersect(ray).t, np.inf)
+        self.assertEqual(objects[-1].count, 1)
+        self.assertTrue(all(obj.count <= 1 for obj in objects))
+        grid.intersect_many(self.origins, self.directions)
+        self.assertLessEqual(objects[-1].count, 1 + len(self.origins))
+
+    def test_occlusion(self):
+        np.random.seed(99)
+        t_max = np.random.uniform(0.5, 8., len(self.origins))
+        rays = [Ray(o, d) for o, d in zip(self.origins, self.directions)]
+        expected = np.array([nearest_intersection(self.objects, ray).t < t for ray, t in zip(rays, t_max)])
+        self.assertTrue(np.any(expected) and not np.all(expected))
+        occluded = np.array([self.grid.occluded(ray, t) for ray, t in zip(rays, t_max)])
+        nptest.assert_array_equal(occluded, expected)
+        occluded, occluders = self.grid.get_occluders_many(self.origins, self.directions, t_max)
+        nptest.assert_array_equal(occluded, expected)
+        for i in np.nonzero(expected)[0]:
+            self.assertLess(occluders[i].intersect(rays[i]).t, t_max[i])
+
+def main(): # to make it easier to import this file and run the tests
+    unittest.main()
+
+if __name__ == '__main__':
+    main()
@@ -26,4 +26,16 @@ def test_intersection_with_result(obj, origin, direction, isect_pt, isect_normal
     
 def test_no_intersection(obj, origin, direction):
     test_intersection_with_result(obj, origin, direction, 
-                                  [0.,0.,0.], [0.,0.,0.], np.inf)
\ No newline at end of file
+                                  [0.,0.,0.], [0.,0.,0.], np.inf)
+def check_intersect_many_same_as_intersect(obj, origins, directions):
+    '''test if the packet intersection gives the same result as intersecting the rays one by one'''
+    isects = obj.intersect_many(np.array(origins, dtype=float), np.array(directions, dtype=float))
+    for i, (origin, direction) in enumerate(zip(origins, directions)):
+        result = obj.intersect(Ray(origin, direction))
+        nptest.assert_almost_equal(isects.t[i], result.t)
+        if result.t < np.inf:
+            nptest.assert_array_almost_equal(isects.p[i], result.p)
+            nptest.assert_array_almost_equal(isects.n[i], result.n)
+            assert isects.materials[isects.material_index[i]] is result.material
+        else:
+            assert isects.material_index[i] == -1
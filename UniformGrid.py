@@ -0,0 +1,306 @@
+'''
+Uniform grid used for finding the nearest intersection without testing every
+object, an alternative to the BVH (see BVH.py) for scenes made of many
+objects of similar size.
+
+The bounding box of the objects is divided into nx x ny x nz cells of the
+same size and each cell stores the objects whose bounds overlap it. A ray
+visits the cells it passes through in front-to-back order using a 3D-DDA
+(Amanatides and Woo) and stops as soon as the nearest intersection found so
+far lies inside the current cell. An object overlapping several cells is
+only tested once per ray (mailboxing).
+
+The resolution is chosen automatically: with N objects in a box of volume V
+the cells have the size of a cube of volume V / (GRID_DENSITY * N), i.e.
+about GRID_DENSITY cells per object.
+'''
+
+from __future__ import division
+from Ray import IntersectionResult, IntersectionPacket
+from BVH import BOUNDS_PADDING, TINY_DIRECTION, safe_directions, ray_box_interval, rays_box_interval
+import numpy as np
+
+# number of cells per object used for choosing the resolution
+GRID_DENSITY = 4.
+
+# maximum number of cells along an axis
+MAX_RESOLUTION = 128
+
+# maximum number of (ray, object) flags in the mailbox of a packet, larger
+# packets are traversed in parts, see split_packet
+MAILBOX_SIZE = 1 << 24
+
+
+class UniformGrid:
+  """
+
+  UniformGrid class
+
+  Built from a list of intersectable objects which all have bounds. It has
+  the same methods as the BVH and returns the nearest intersection with any
+  of its objects. The cells are stored in compressed form: the indices of the
+  objects of cell i are cellObjects[cellStart[i]:cellStart[i+1]], the index
+  of cell (x, y, z) is x + nx * (y + ny * z).
+
+  """
+  def __init__(self, objects):
+    objects = list(objects)
+    assert(len(objects) > 0)
+    bounds = [obj.bounds() for obj in objects]
+    assert(all(b is not None for b in bounds))
+    minPoints = np.array([b[0] for b in bounds], dtype = float) - BOUNDS_PADDING
+    maxPoints = np.array([b[1] for b in bounds], dtype = float) + BOUNDS_PADDING
+    self.objects = objects
+    self.minPoint = np.min(minPoints, axis = 0)
+    self.maxPoint = np.max(maxPoints, axis = 0)
+    self.resolution = self.choose_resolution(len(objects), self.maxPoint - self.minPoint)
+    self.cellSize = (self.maxPoint - self.minPoint) / self.resolution
+    self.build(minPoints, maxPoints)
+
+    # python floats and ints are faster than small numpy arrays for the scalar traversal
+    self.minList = [float(x) for x in self.minPoint]
+    self.maxList = [float(x) for x in self.maxPoint]
+    self.cellSizeList = [float(x) for x in self.cellSize]
+    self.resolutionList = [int(n) for n in self.resolution]
+    self.cellStartList = [int(i) for i in self.cellStart]
+    self.cellObjectsList = [int(i) for i in self.cellObjects]
+    # mailbox[i] is the id of the last ray tested against object i
+    self.mailbox = [0] * len(objects)
+    self.rayId = 0
+
+  def choose_resolution(self, N, extent):
+    ''' number of cells along each axis for N objects in a box of the given extent '''
+    # flat scenes would give a volume close to 0
+    extent = np.maximum(extent, np.max(extent) * 1e-3)
+    cells_per_unit = (GRID_DENSITY * N / np.prod(extent)) ** (1. / 3)
+    return np.clip(np.round(extent * cells_per_unit), 1, MAX_RESOLUTION).astype(int)
+
+  def cell_coordinates(self, points):
+    ''' (x, y, z) coordinates of the cells containing the points, clamped to the grid '''
+    cells = np.floor((points - self.minPoint) / self.cellSize).astype(int)
+    return np.clip(cells, 0, self.resolution - 1)
+
+  def build(self, minPoints, maxPoints):
+    ''' stores the index of each object in all the cells overlapped by its bounds '''
+    nx, ny, nz = self.resolution
+    low = self.cell_coordinates(minPoints)
+    high = self.cell_coordinates(maxPoints)
+    cells = []
+    indices = []
+    for i in range(len(self.objects)):
+      x, y, z = np.mgrid[low[i,0]:high[i,0] + 1, low[i,1]:high[i,1] + 1, low[i,2]:high[i,2] + 1]
+      object_cells = (x + nx * (y + ny * z)).ravel()
+      cells.append(object_cells)
+      indices.append(np.full(len(object_cells), i, dtype = int))
+    cells = np.concatenate(cells)
+    order = np.argsort(cells, kind = 'mergesort')
+    self.cellObjects = np.concatenate(indices)[order]
+    self.cellStart = np.zeros(nx * ny * nz + 1, dtype = int)
+    self.cellStart[1:] = np.cumsum(np.bincount(cells, minlength = nx * ny * nz))
+
+  def bounds(self):
+    return self.minPoint, self.maxPoint
+
+  def traverse(self, origin, direction):
+    '''
+    Generator of the cells visited by a single ray (python sequences of 3
+    floats) in front-to-back order. Yields (cell, t_exit) where t_exit is
+    the distance at which the ray leaves the cell.
+    '''
+    inv_direction = [1. / (d if d != 0 else TINY_DIRECTION) for d in direction]
+    t_enter, t_exit = ray_box_interval(self.minList, self.maxList, origin, inv_direction)
+    if t_enter > t_exit or t_exit < 0:
+      return
+    t = max(t_enter, 0.)
+    cell = [0, 0, 0]
+    step = [0, 0, 0]
+    t_max = [0., 0., 0.]
+    t_delta = [0., 0., 0.]
+    for axis in range(3):
+      size = self.cellSizeList[axis]
+      c = int((origin[axis] + t * direction[axis] - self.minList[axis]) / size)
+      cell[axis] = min(max(c, 0), self.resolutionList[axis] - 1)
+      step[axis] = 1 if inv_direction[axis] > 0 else -1
+      boundary = self.minList[axis] + (cell[axis] + (1 if step[axis] > 0 else 0)) * size
+      t_max[axis] = (boundary - origin[axis]) * inv_direction[axis]
+      t_delta[axis] = size * abs(inv_direction[axis])
+    nx, ny, nz = self.resolutionList
+    while True:
+      axis = 0
+      if t_max[1] < t_max[axis]:
+        axis = 1
+      if t_max[2] < t_max[axis]:
+        axis = 2
+      yield cell[0] + nx * (cell[1] + ny * cell[2]), t_max[axis]
+      cell[axis] += step[axis]
+      if cell[axis] < 0 or cell[axis] >= self.resolutionList[axis]:
+        return
+      t_max[axis] += t_delta[axis]
+
+  def next_ray_id(self):
+    self.rayId += 1
+    return self.rayId
+
+  def intersect(self, ray):
+    '''
+    Returns the IntersectionResult of the nearest intersection of the ray
+    with the objects of the grid.
+    '''
+    isect = IntersectionResult()
+    ray_id = self.next_ray_id()
+    origin = [float(x) for x in ray.eyePoint]
+    direction = [float(x) for x in ray.viewDirection]
+    for cell, t_exit in self.traverse(origin, direction):
+      for k in range(self.cellStartList[cell], self.cellStartList[cell + 1]):
+        i = self.cellObjectsList[k]
+        if self.mailbox[i] == ray_id: # already tested in a previous cell
+          continue
+        self.mailbox[i] = ray_id
+        result = self.objects[i].intersect(ray)
+        if result.t < isect.t:
+          isect = result
+      # intersections beyond the cell may still be hidden by objects of the next cells
+      if isect.t <= t_exit:
+        break
+    return isect
+
+  def occluded(self, ray, t_max):
+    '''
+    Any-hit query: True if any object of the grid is intersected at a distance
+    t with EPS_DISTANCE < t < t_max. The traversal stops at the first such object.
+    '''
+    return self.get_occluder(ray, t_max) is not None
+
+  def get_occluder(self, ray, t_max):
+    ''' Same as occluded but returns the occluding object (or None) '''
+    ray_id = self.next_ray_id()
+    origin = [float(x) for x in ray.eyePoint]
+    direction = [float(x) for x in ray.viewDirection]
+    for cell, t_exit in self.traverse(origin, direction):
+      for k in range(self.cellStartList[cell], self.cellStartList[cell + 1]):
+        i = self.cellObjectsList[k]
+        if self.mailbox[i] == ray_id:
+          continue
+        self.mailbox[i] = ray_id
+        if self.objects[i].occluded(ray, t_max):
+          return self.objects[i]
+      if t_exit >= t_max:
+        break
+    return None
+
+  def start_traversal_many(self, origins, directions):
+    '''
+    Sets up the 3D-DDA for a packet of rays. Returns the indices of the rays
+    that hit the grid, their current cells (M, 3), step (M, 3), t_max (M, 3)
+    and t_delta (M, 3) arrays, see traverse.
+    '''
+    inv_directions = 1. / safe_directions(directions)
+    t_enter, t_exit = rays_box_interval(self.minPoint, self.maxPoint, origins, inv_directions)
+    rays = np.nonzero((t_enter <= t_exit) & (t_exit >= 0))[0]
+    t = np.maximum(t_enter[rays], 0)[:, np.newaxis]
+    points = origins[rays] + t * directions[rays]
+    cells = np.clip(((points - self.minPoint) / self.cellSize).astype(int), 0, self.resolution - 1)
+    step = np.where(inv_directions[rays] > 0, 1, -1)
+    boundary = self.minPoint + (cells + (step > 0)) * self.cellSize
+    t_max = (boundary - origins[rays]) * inv_directions[rays]
+    t_delta = self.cellSize * np.abs(inv_directions[rays])
+    return rays, cells, step, t_max, t_delta
+
+  def split_packet(self, n):
+    '''
+    Slices of a packet of n rays that are traversed separately so that the
+    mailbox of each part (see new_pairs) has at most MAILBOX_SIZE flags.
+    '''
+    size = max(MAILBOX_SIZE // len(self.objects), 1)
+    return [slice(start, min(start + size, n)) for start in range(0, n, size)]
+
+  def new_pairs(self, rays, cells, mailbox, first):
+    '''
+    The (ray, object) pairs for the objects in the given cells of the rays
+    that were not tested yet. mailbox is the boolean array of the pairs
+    tested so far of shape (number of rays, number of objects) for the rays
+    starting at index first, it is updated. Returns the rays and the objects
+    of the new pairs sorted by object.
+    '''
+    nx, ny, nz = self.resolution
+    index = cells[:,0] + nx * (cells[:,1] + ny * cells[:,2])
+    start = self.cellStart[index]
+    counts = self.cellStart[index + 1] - start
+    pair_rays = np.repeat(rays, counts)
+    # position of each pair inside its cell
+    offsets = np.arange(len(pair_rays)) - np.repeat(np.cumsum(counts) - counts, counts)
+    pair_objects = self.cellObjects[np.repeat(start, counts) + offsets]
+    # the objects of a cell are distinct so a ray has no duplicate pairs in one step
+    new = ~mailbox[pair_rays - first, pair_objects]
+    pair_rays, pair_objects = pair_rays[new], pair_objects[new]
+    mailbox[pair_rays - first, pair_objects] = True
+    order = np.argsort(pair_objects, kind = 'mergesort')
+    return pair_rays[order], pair_objects[order]
+
+  def group_by_object(self, pair_rays, pair_objects):
+    ''' yields (object, rays) for each object of the pairs sorted by object '''
+    boundaries = np.nonzero(np.diff(pair_objects))[0] + 1
+    for start, end in zip(np.concatenate([[0], boundaries]), np.concatenate([boundaries, [len(pair_rays)]])):
+      if end > start:
+        yield self.objects[pair_objects[start]], pair_rays[start:end]
+
+  def step_many(self, cells, step, t_max, t_delta):
+    '''
+    Moves each ray to its next cell, updates the arrays in place and returns
+    a boolean array telling which rays are still inside the grid.
+    '''
+    rows = np.arange(len(cells))
+    axis = np.argmin(t_max, axis = 1)
+    cells[rows, axis] += step[rows, axis]
+    t_max[rows, axis] += t_delta[rows, axis]
+    return (cells[rows, axis] >= 0) & (cells[rows, axis] < self.resolution[axis])
+
+  def intersect_many(self, origins, directions):
+    '''
+    Packet version of intersect. All the rays advance one cell per step, the
+    objects of the visited cells that were not tested yet are intersected
+    with all the rays that reached them in that step at once. Rays are done
+    when their nearest intersection lies inside the current cell.
+    '''
+    isects = IntersectionPacket(len(origins))
+    for part in self.split_packet(len(origins)):
+      rays, cells, step, t_max, t_delta = self.start_traversal_many(origins[part], directions[part])
+      rays += part.start
+      mailbox = np.zeros((part.stop - part.start, len(self.objects)), dtype = bool)
+      while len(rays) > 0:
+        pair_rays, pair_objects = self.new_pairs(rays, cells, mailbox, part.start)
+        for obj, obj_rays in self.group_by_object(pair_rays, pair_objects):
+          isects.update(obj.intersect_many(origins[obj_rays], directions[obj_rays]), obj_rays)
+        done = isects.t[rays] <= np.min(t_max, axis = 1)
+        keep = self.step_many(cells, step, t_max, t_delta) & ~done
+        rays, cells, step, t_max, t_delta = rays[keep], cells[keep], step[keep], t_max[keep], t_delta[keep]
+    return isects
+
+  def occluded_many(self, origins, directions, t_max):
+    ''' Packet version of occluded, t_max is an array of shape (N,) '''
+    return self.get_occluders_many(origins, directions, t_max)[0]
+
+  def get_occluders_many(self, origins, directions, t_max):
+    '''
+    Packet version of get_occluder. Returns a boolean array telling whether
+    each ray is occluded and an object array with the occluding objects.
+    '''
+    occluded = np.zeros(len(origins), dtype = bool)
+    occluders = np.empty(len(origins), dtype = object)
+    for part in self.split_packet(len(origins)):
+      rays, cells, step, cell_t_max, t_delta = self.start_traversal_many(origins[part], directions[part])
+      rays += part.start
+      mailbox = np.zeros((part.stop - part.start, len(self.objects)), dtype = bool)
+      while len(rays) > 0:
+        pair_rays, pair_objects = self.new_pairs(rays, cells, mailbox, part.start)
+        for obj, obj_rays in self.group_by_object(pair_rays, pair_objects):
+          obj_rays = obj_rays[~occluded[obj_rays]]
+          if len(obj_rays) == 0:
+            continue
+          hit = obj.occluded_many(origins[obj_rays], directions[obj_rays], t_max[obj_rays])
+          occluded[obj_rays[hit]] = True
+          occluders[obj_rays[hit]] = obj
+        done = occluded[rays] | (np.min(cell_t_max, axis = 1) >= t_max[rays])
+        keep = self.step_many(cells, step, cell_t_max, t_delta) & ~done
+        rays, cells, step, cell_t_max, t_delta = rays[keep], cells[keep], step[keep], cell_t_max[keep], t_delta[keep]
+    return occluded, occluders